@@ -3,25 +3,44 @@ import os
 from collections.abc import AsyncIterator
 from typing import Any
 
-from sqlalchemy import create_engine
+from sqlalchemy import DateTime
 from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
 from sqlalchemy.ext.asyncio.engine import create_async_engine
 from sqlalchemy.ext.asyncio.session import async_sessionmaker
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm.decl_api import DeclarativeBase
+from sqlalchemy.sql.functions import FunctionElement
 
 SQLALCHEMY_DATABASE_URL = os.getenv("SQLALCHEMY_DATABASE_URL")
 
 if not SQLALCHEMY_DATABASE_URL:
     raise ValueError("SQLALCHEMY_DATABASE_URL is not set")
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL,
-)
-
 Base: DeclarativeBase = declarative_base()
 
 
+class clock_now(FunctionElement):
+    """
+    Current time when the statement runs. `func.now()` is when the
+    transaction began, so a long transaction could date its changes before
+    ones committed in the meantime.
+    """
+
+    type = DateTime()
+    inherit_cache = True
+
+
+@compiles(clock_now)
+def _clock_now(element, compiler, **kw):
+    return "CURRENT_TIMESTAMP"
+
+
+@compiles(clock_now, "postgresql")
+def _clock_now_postgresql(element, compiler, **kw):
+    return "clock_timestamp()"
+
+
 class DatabaseSessionManager:
     def __init__(self, host: str, engine_kwargs: dict[str, Any] | None = None):
         if engine_kwargs is None:
@@ -38,6 +57,11 @@ class DatabaseSessionManager:
             autoflush=False, expire_on_commit=False, bind=self._engine
         )
 
+    async def create_all(self):
+        """Create missing tables for every model registered on `Base`"""
+        async with self.connect() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+
     async def close(self):
         if self._engine is None:
             raise Exception("DatabaseSessionManager is not initialized")
@@ -2,9 +2,10 @@ import enum
 
 from pydantic import BaseModel
 from pydantic.types import UUID4
-from sqlalchemy import Column, Enum, Float, String, Uuid
+from sqlalchemy import Column, DateTime, Enum, Float, String, Uuid
+from sqlalchemy.sql import func
 
-from ..database import Base
+from ..database import Base, clock_now
 
 
 class StatusEnum(enum.Enum):
@@ -16,10 +17,18 @@ class Audio(Base):
     __tablename__ = "audios"
 
     id = Column(Uuid, primary_key=True, index=True)
-    url = Column(String, nullable=True, unique=True)
+    # Not unique, deduplicated audios share their content-addressed object
+    url = Column(String, nullable=True, index=True)
     file_name = Column(String, nullable=False)
     audio_length = Column(Float, nullable=True)
     audio_status = Column(Enum(StatusEnum), default=StatusEnum.waiting)
+    preview_url = Column(String, nullable=True)
+    created_at = Column(DateTime, nullable=True, default=func.now())
+    # Bumped by every change, incremental exports refetch audio changed since
+    updated_at = Column(
+        DateTime, nullable=True, default=clock_now(), onupdate=clock_now()
+    )
+    content_hash = Column(String, nullable=True, index=True)
 
 
 class AudioModel(BaseModel):
@@ -28,6 +37,8 @@ class AudioModel(BaseModel):
     file_name: str
     audio_length: float | None
     audio_status: StatusEnum
+    preview_url: str | None = None
+    content_hash: str | None = None
 
     class Config:
         from_attributes = True
@@ -1,6 +1,6 @@
 from pydantic import BaseModel
 from pydantic.types import UUID4
-from sqlalchemy import Column, ForeignKey, Uuid
+from sqlalchemy import Column, DateTime, ForeignKey, Uuid
 from sqlalchemy.orm import relationship
 
 from database_handle.models.audios import AudioModel
@@ -8,7 +8,7 @@ from database_handle.models.categories import CategoryModel
 from database_handle.models.pagination import Paginated
 from database_handle.models.texts import TextModel
 
-from ..database import Base
+from ..database import Base, clock_now
 
 
 class Binding(Base):
@@ -30,6 +30,9 @@ class Binding(Base):
         ForeignKey("texts.id", ondelete="CASCADE", onupdate="CASCADE"),
         nullable=False,
     )
+    updated_at = Column(
+        DateTime, nullable=True, default=clock_now(), onupdate=clock_now()
+    )
     category = relationship("Category")
     audio = relationship("Audio")
     text = relationship("Text")
@@ -0,0 +1,27 @@
+from sqlalchemy import JSON, BigInteger, Column, DateTime, ForeignKey, String, Uuid
+from sqlalchemy.sql import func
+
+from ..database import Base
+
+
+class ExportCheckpoint(Base):
+    """
+    Point an export's archive was durably written up to, a retry carries on
+    from the latest one instead of starting over
+    """
+
+    __tablename__ = "export_checkpoints"
+
+    id = Column(Uuid, primary_key=True, index=True)
+    export_id = Column(
+        Uuid, ForeignKey("exports.id", ondelete="CASCADE"), nullable=False, index=True
+    )
+    # Bytes of the archive written when the checkpoint was taken
+    size = Column(BigInteger, nullable=False)
+    # What the storage writer needs to reopen the unfinished upload
+    writer = Column(JSON, nullable=False)
+    # Archive members written since the previous checkpoint
+    members = Column(JSON, nullable=False)
+    # Last member written, e.g. to tell how far a failed export got
+    last_entry = Column(String, nullable=True, default=None)
+    created_at = Column(DateTime, nullable=True, default=func.now())
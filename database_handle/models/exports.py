@@ -1,7 +1,16 @@
 import enum
 
 from pydantic import UUID4, BaseModel, NaiveDatetime
-from sqlalchemy import Column, DateTime, Enum, String, Uuid
+from sqlalchemy import (
+    JSON,
+    BigInteger,
+    Column,
+    DateTime,
+    Enum,
+    Integer,
+    String,
+    Uuid,
+)
 from sqlalchemy.sql import func
 
 from ..database import Base
@@ -12,6 +21,7 @@ class ExportStatus(enum.Enum):
     IN_PROGRESS = 1
     COMPLETED = 2
     FAILED = 3
+    CANCELLED = 4
 
 
 class Exports(Base):
@@ -22,6 +32,18 @@ class Exports(Base):
     created_at = Column(DateTime, nullable=True, default=func.now())
     updated_at = Column(DateTime, nullable=True, default=func.now())
     archive_url = Column(String, nullable=True, default=None)
+    # `FinaliseConfigModel` the export was scheduled with
+    config = Column(JSON, nullable=True, default=None)
+    # Completed export whose archive an incremental export reuses entries of
+    base_export_id = Column(Uuid, nullable=True, default=None)
+    # Progress of the running or last run, audio files and archive bytes
+    files_total = Column(Integer, nullable=True, default=None)
+    files_done = Column(Integer, nullable=True, default=None)
+    bytes_written = Column(BigInteger, nullable=True, default=None)
+    # Estimated seconds until the archive is complete
+    eta_seconds = Column(Integer, nullable=True, default=None)
+    # Hash of what the archive is built from, identical exports share it
+    fingerprint = Column(String, nullable=True, default=None, index=True)
 
 
 class ExportModel(BaseModel):
@@ -32,3 +54,10 @@ class ExportModel(BaseModel):
     created_at: NaiveDatetime
     updated_at: NaiveDatetime
     archive_url: str | None
+    config: dict | None = None
+    base_export_id: UUID4 | None = None
+    files_total: int | None = None
+    files_done: int | None = None
+    bytes_written: int | None = None
+    eta_seconds: int | None = None
+    fingerprint: str | None = None
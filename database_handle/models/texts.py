@@ -1,8 +1,8 @@
 from pydantic import BaseModel
 from pydantic.types import UUID4
-from sqlalchemy import Column, String, Uuid
+from sqlalchemy import Column, DateTime, String, Uuid
 
-from ..database import Base
+from ..database import Base, clock_now
 
 
 class Text(Base):
@@ -10,6 +10,9 @@ class Text(Base):
 
     id = Column(Uuid, primary_key=True, index=True)
     text = Column(String, nullable=False)
+    updated_at = Column(
+        DateTime, nullable=True, default=clock_now(), onupdate=clock_now()
+    )
 
 
 class TextModel(BaseModel):
@@ -1,14 +1,19 @@
+import datetime
+from collections.abc import Iterable
 from dataclasses import dataclass
 from typing import Annotated
 
 from fastapi import Depends
 from pydantic import UUID4
-from sqlalchemy import select
+from sqlalchemy import delete, exists, func, insert, or_, select
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 from sqlalchemy.sql.expression import update
 
 from database_handle.database import get_db
 from database_handle.models.audios import Audio, StatusEnum
+from database_handle.models.bindings import Binding
+from database_handle.models.texts import Text
 
 
 @dataclass
@@ -21,21 +26,125 @@ class AudioQueries:
         status: StatusEnum,
         audio_length: float | None = None,
         url: str | None = None,
+        content_hash: str | None = None,
     ):
         args: dict[str, str | float | StatusEnum] = {"audio_status": status}
         if audio_length is not None:
             args["audio_length"] = audio_length
         if url is not None:
             args["url"] = url
+        if content_hash is not None:
+            args["content_hash"] = content_hash
         await self.session.execute(
             update(Audio).where(Audio.id == audio_id).values(**args)
         )
 
+    async def get_waiting_id_by_url(self, url: str) -> UUID4 | None:
+        stmt = (
+            select(Audio.id)
+            .where(Audio.url == url, Audio.audio_status == StatusEnum.waiting)
+            .limit(1)
+        )
+        return await self.session.scalar(stmt)
+
+    async def get_waiting_with_url(self) -> list[tuple[UUID4, str]]:
+        stmt = select(Audio.id, Audio.url).where(
+            Audio.audio_status == StatusEnum.waiting, Audio.url.is_not(None)
+        )
+        return [(row.id, row.url) for row in await self.session.execute(stmt)]
+
+    async def get_waiting_before(
+        self, before: datetime.datetime
+    ) -> list[tuple[UUID4, str | None]]:
+        """
+        Audios still waiting for their upload since before `before`, unless
+        a binding gives them a transcript. Rows without `created_at` predate
+        the column and are left alone.
+        """
+        transcribed = exists().where(
+            Binding.audio_id == Audio.id,
+            Binding.text_id == Text.id,
+            Text.text != "",
+        )
+        stmt = select(Audio.id, Audio.url).where(
+            Audio.audio_status == StatusEnum.waiting,
+            Audio.created_at < before,
+            ~transcribed,
+        )
+        return [(row.id, row.url) for row in await self.session.execute(stmt)]
+
+    async def referenced_urls(self, urls: list[str]) -> set[str]:
+        """Subset of `urls` some audio uses as its object or its preview"""
+        if not urls:
+            return set()
+        stmt = select(Audio.url, Audio.preview_url).where(
+            or_(Audio.url.in_(urls), Audio.preview_url.in_(urls))
+        )
+        referenced = {
+            url for row in await self.session.execute(stmt) for url in row if url
+        }
+        return referenced & set(urls)
+
+    async def is_referenced(self, url: str) -> bool:
+        """Whether any audio still uses the object, deduplicated ones share it"""
+        stmt = select(Audio.id).where(Audio.url == url).limit(1)
+        return await self.session.scalar(stmt) is not None
+
+    async def lock_objects(self, urls: Iterable[str]):
+        """
+        Serialise transactions that start using or delete the objects, so a
+        deduplicated object isn't deleted under an audio about to share it.
+        Locks are held until the transaction ends.
+        """
+        if self.session.get_bind().dialect.name != "postgresql":
+            return
+        for url in sorted(set(urls)):
+            await self.session.execute(
+                select(func.pg_advisory_xact_lock(func.hashtext(url)))
+            )
+
+    async def copy_preview_urls(self, urls: list[str]):
+        """Give audios sharing an object the preview already made for it"""
+        if not urls:
+            return
+        source = aliased(Audio)
+        await self.session.execute(
+            update(Audio)
+            .where(Audio.url.in_(urls), Audio.preview_url.is_(None))
+            .values(
+                preview_url=select(func.max(source.preview_url))
+                .where(source.url == Audio.url)
+                .scalar_subquery()
+            )
+        )
+
+    async def set_preview_url(self, url: str, preview_url: str):
+        await self.session.execute(
+            update(Audio).where(Audio.url == url).values(preview_url=preview_url)
+        )
+
     async def exists(self, name: str) -> bool:
         stmt = select(Audio).filter_by(file_name=name).limit(1)
         result = await self.session.scalar(stmt)
         return result is not None
 
+    async def existing_names(self, names: list[str]) -> set[str]:
+        stmt = select(Audio.file_name).where(Audio.file_name.in_(names))
+        return set(await self.session.scalars(stmt))
+
+    async def create_many(self, audios: list[dict]):
+        if audios:
+            await self.session.execute(insert(Audio), audios)
+
+    async def update_many(self, audios: list[dict]):
+        """Bulk update by primary key, every dict must contain `id`"""
+        if audios:
+            await self.session.execute(update(Audio), audios)
+
+    async def remove_many(self, ids: list[UUID4]):
+        if ids:
+            await self.session.execute(delete(Audio).where(Audio.id.in_(ids)))
+
 
 def get_audio_queries(db: Annotated[AsyncSession, Depends(get_db)]) -> AudioQueries:
     return AudioQueries(session=db)
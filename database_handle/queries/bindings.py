@@ -1,11 +1,13 @@
+import datetime
+from collections.abc import AsyncIterator
 from dataclasses import dataclass
-from typing import Annotated
+from typing import Annotated, NamedTuple
 
 from fastapi import Depends
 from pydantic.types import UUID4
-from sqlalchemy import func, select
+from sqlalchemy import Select, false, func, or_, select
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.sql.expression import delete, update
+from sqlalchemy.sql.expression import delete, insert, update
 
 from database_handle.database import get_db
 from database_handle.models.audios import Audio, StatusEnum
@@ -18,6 +20,33 @@ from database_handle.models.categories import Category
 from database_handle.models.texts import Text
 from database_handle.utils.pagination import with_paginated
 
+# Rows fetched per round trip when streaming export rows
+STREAM_BATCH_SIZE = 1000
+
+
+class ExportRow(NamedTuple):
+    category_id: UUID4 | None
+    category_name: str | None
+    file_name: str
+    url: str
+    text: str
+    audio_length: float | None
+    audio_updated_at: datetime.datetime | None
+
+
+def _filter_export_rows[S: Select](
+    stmt: S, category_ids: list[UUID4 | str | None] | None, skip_empty: bool
+) -> S:
+    if category_ids is not None:
+        ids = [id for id in category_ids if id is not None]
+        conditions = [Category.id.in_(ids)] if ids else []
+        if None in category_ids:
+            conditions.append(Category.id.is_(None))
+        stmt = stmt.where(or_(*conditions) if conditions else false())
+    if skip_empty:
+        stmt = stmt.where(func.trim(Text.text) != "")
+    return stmt
+
 
 @dataclass
 class BindingsQueries:
@@ -64,6 +93,61 @@ class BindingsQueries:
             for row in result
         ]
 
+    async def stream_export_rows(
+        self,
+        category_ids: list[UUID4 | str | None] | None = None,
+        skip_empty: bool = False,
+    ) -> AsyncIterator[ExportRow]:
+        """
+        Everything an export needs, ordered by category and file name, from a
+        server-side cursor so rows are never all held at once. `None` in
+        `category_ids` selects uncategorized bindings, no list selects all.
+        """
+        stmt = (
+            select(
+                Category.id,
+                Category.name,
+                Audio.file_name,
+                Audio.url,
+                Text.text,
+                Audio.audio_length,
+                Audio.updated_at,
+            )
+            .select_from(Binding)
+            .outerjoin(Category)
+            .join(Audio)
+            .join(Text)
+            .where(Audio.audio_status != StatusEnum.waiting)
+            .order_by(
+                Category.name.asc().nulls_last(),
+                Category.id,
+                Audio.file_name,
+            )
+            .execution_options(yield_per=STREAM_BATCH_SIZE)
+        )
+        stmt = _filter_export_rows(stmt, category_ids, skip_empty)
+
+        result = await self.session.stream(stmt)
+        async for row in result:
+            yield ExportRow(*row)
+
+    async def count_export_rows(
+        self,
+        category_ids: list[UUID4 | str | None] | None = None,
+        skip_empty: bool = False,
+    ) -> int:
+        """How many rows `stream_export_rows` yields for the same arguments"""
+        stmt = (
+            select(func.count())
+            .select_from(Binding)
+            .outerjoin(Category)
+            .join(Audio)
+            .join(Text)
+            .where(Audio.audio_status != StatusEnum.waiting)
+        )
+        stmt = _filter_export_rows(stmt, category_ids, skip_empty)
+        return await self.session.scalar(stmt) or 0
+
     async def get_paginated(self, page: int = 0, limit: int = 20):
         stmt = (
             select(Binding, Category, Audio, Text)
@@ -89,13 +173,51 @@ class BindingsQueries:
 
         return await with_paginated(self.session, stmt, page, limit, transform_row)
 
+    async def get_audio_urls(
+        self, ids: list[UUID4]
+    ) -> list[tuple[UUID4, UUID4, str, str | None]]:
+        """
+        (binding id, audio id, object name, preview object name) of every
+        uploaded audio in `ids`
+        """
+        stmt = (
+            select(Binding.id, Binding.audio_id, Audio.url, Audio.preview_url)
+            .join(Audio)
+            .where(Binding.id.in_(ids), Audio.url.is_not(None))
+        )
+        return [tuple(row) for row in (await self.session.execute(stmt)).all()]
+
     async def create(self, binding: Binding):
         self.session.add(binding)
 
+    async def create_many(self, bindings: list[dict]):
+        if bindings:
+            await self.session.execute(insert(Binding), bindings)
+
     async def remove(self, id: UUID4):
         stmt = delete(Binding).where(Binding.id == id)
         await self.session.execute(stmt)
 
+    async def update_many(self, bindings: list[dict]):
+        """Bulk update by primary key, every dict must contain `id`"""
+        if bindings:
+            await self.session.execute(update(Binding), bindings)
+
+    async def remove_many(self, ids: list[UUID4]):
+        if ids:
+            await self.session.execute(delete(Binding).where(Binding.id.in_(ids)))
+
+    async def remove_for_audios(self, audio_ids: list[UUID4]) -> list[UUID4]:
+        """Remove bindings of the given audios, returns their text ids"""
+        if not audio_ids:
+            return []
+        result = await self.session.execute(
+            delete(Binding)
+            .where(Binding.audio_id.in_(audio_ids))
+            .returning(Binding.text_id)
+        )
+        return list(result.scalars())
+
     async def update_category(self, binding_id: UUID4, category_id: UUID4 | None):
         stmt = (
             update(Binding)
@@ -40,6 +40,26 @@ class CategoriesQueries:
         result = await self.session.execute(stmt)
         return result.scalar_one()
 
+    async def get_or_create_many(self, names: set[str]) -> dict[str, UUID4]:
+        if not names:
+            return {}
+        stmt = (
+            insert(Category)
+            .values(
+                [
+                    {"id": uuid4(), "name": name, "visibility": Visibility.PUBLIC}
+                    for name in names
+                ]
+            )
+            .on_conflict_do_update(
+                index_elements=["name"],
+                set_={"visibility": Visibility.PUBLIC},
+            )
+            .returning(Category.name, Category.id)
+        )
+        result = await self.session.execute(stmt)
+        return {name: id for name, id in result.all()}
+
     async def get_count(self):
         count_func = func.count(Category.id)
         entry = (
@@ -1,28 +1,46 @@
 import datetime
+import json
 from dataclasses import dataclass
-from typing import Annotated
+from typing import Annotated, NamedTuple
 from uuid import uuid4
 
 from fastapi import Depends
-from pydantic import BaseModel
-from sqlalchemy import delete, select, update
+from pydantic import UUID4, BaseModel
+from sqlalchemy import delete, func, select, update
 from sqlalchemy.ext.asyncio.session import AsyncSession
 
 from database_handle.database import get_db
+from database_handle.models.audios import Audio
+from database_handle.models.bindings import Binding
+from database_handle.models.categories import Category
+from database_handle.models.export_checkpoints import ExportCheckpoint
 from database_handle.models.exports import Exports, ExportStatus
 from database_handle.models.exports_categories import ExportsCategories
 from database_handle.models.pagination import Paginated
+from database_handle.models.texts import Text
 from database_handle.utils.pagination import with_paginated
 
 
 class ExportStatusMessage(BaseModel):
     id: str
     status: int
+    # Only sent while the export is in progress
+    files_total: int | None = None
+    files_done: int | None = None
+    bytes_written: int | None = None
+    eta_seconds: int | None = None
 
     def to_json(self) -> str:
         return self.model_dump_json()
 
 
+class ExportJob(NamedTuple):
+    config: dict | None
+    categories: list[UUID4 | None]
+    base_export_id: UUID4 | None
+    status: ExportStatus
+
+
 @dataclass
 class ExportsQueries:
     session: AsyncSession
@@ -39,8 +57,23 @@ class ExportsQueries:
         )
         return Paginated(items=items, pagination=pagination)
 
-    async def schedule(self, id: str, categories: list[str | None] | None = None):
-        self.session.add(Exports(id=id, status=ExportStatus.PENDING))
+    async def schedule(
+        self,
+        id: str,
+        categories: list[str | None] | None = None,
+        config: dict | None = None,
+        base_export_id: UUID4 | None = None,
+        fingerprint: str | None = None,
+    ):
+        self.session.add(
+            Exports(
+                id=id,
+                status=ExportStatus.PENDING,
+                config=config,
+                base_export_id=base_export_id,
+                fingerprint=fingerprint,
+            )
+        )
         entries = (
             [
                 ExportsCategories(id=str(uuid4()), export_id=id, category_id=category)
@@ -51,6 +84,50 @@ class ExportsQueries:
         )
         self.session.add_all(entries)
 
+    async def get(self, id: str | UUID4) -> Exports | None:
+        return await self.session.scalar(select(Exports).where(Exports.id == id))
+
+    async def find_by_fingerprint(self, fingerprint: str) -> Exports | None:
+        """Latest export with the fingerprint that is completed or on its way"""
+        stmt = (
+            select(Exports)
+            .where(
+                Exports.fingerprint == fingerprint,
+                Exports.status.in_(
+                    [
+                        ExportStatus.PENDING,
+                        ExportStatus.IN_PROGRESS,
+                        ExportStatus.COMPLETED,
+                    ]
+                ),
+            )
+            .order_by(Exports.created_at.desc())
+            .limit(1)
+        )
+        return await self.session.scalar(stmt)
+
+    async def get_data_version(self) -> str:
+        """
+        Changes whenever something an export is built from does: bindings,
+        texts and audios are counted and dated, categories listed by name
+        """
+        counts = (
+            await self.session.execute(
+                select(
+                    select(func.count(Binding.id)).scalar_subquery(),
+                    select(func.max(Binding.updated_at)).scalar_subquery(),
+                    select(func.max(Audio.updated_at)).scalar_subquery(),
+                    select(func.max(Text.updated_at)).scalar_subquery(),
+                )
+            )
+        ).one()
+        categories = await self.session.execute(
+            select(Category.id, Category.name).order_by(Category.id)
+        )
+        return json.dumps(
+            [list(counts), [list(category) for category in categories]], default=str
+        )
+
     async def set_status(self, id: str, status: ExportStatus):
         await self.session.execute(
             update(Exports)
@@ -61,6 +138,22 @@ class ExportsQueries:
             )
         )
 
+    async def get_status(self, id: str | UUID4) -> ExportStatus | None:
+        return await self.session.scalar(select(Exports.status).where(Exports.id == id))
+
+    async def complete(self, id: str, url: str) -> bool:
+        """Mark an export completed with its archive, False if it was cancelled"""
+        result = await self.session.execute(
+            update(Exports)
+            .where(Exports.id == id, Exports.status != ExportStatus.CANCELLED)
+            .values(
+                archive_url=url,
+                status=ExportStatus.COMPLETED,
+                updated_at=datetime.datetime.now(datetime.UTC),
+            )
+        )
+        return result.rowcount > 0
+
     async def set_archive_url(self, id: str, url: str):
         await self.session.execute(
             update(Exports)
@@ -71,13 +164,127 @@ class ExportsQueries:
             )
         )
 
+    async def set_progress(
+        self,
+        id: str,
+        files_total: int,
+        files_done: int,
+        bytes_written: int,
+        eta_seconds: int | None,
+    ):
+        await self.session.execute(
+            update(Exports)
+            .where(Exports.id == id)
+            .values(
+                files_total=files_total,
+                files_done=files_done,
+                bytes_written=bytes_written,
+                eta_seconds=eta_seconds,
+                updated_at=datetime.datetime.now(datetime.UTC),
+            )
+        )
+
     async def get_archive(self, id: str):
         res = await self.session.execute(select(Exports).where(Exports.id == id))
         return str(res.scalar_one().archive_url)
 
+    async def get_job(self, id: str | UUID4) -> ExportJob | None:
+        """What an export was scheduled with, None once it's deleted"""
+        export = await self.session.scalar(select(Exports).where(Exports.id == id))
+        if export is None:
+            return None
+        categories = await self.session.scalars(
+            select(ExportsCategories.category_id).where(
+                ExportsCategories.export_id == id
+            )
+        )
+        return ExportJob(
+            export.config, list(categories), export.base_export_id, export.status
+        )
+
+    async def get_unfinished_before(self, before: datetime.datetime) -> list[UUID4]:
+        """Exports still pending or in progress that last changed before"""
+        stmt = select(Exports.id).where(
+            Exports.status.in_([ExportStatus.PENDING, ExportStatus.IN_PROGRESS]),
+            Exports.updated_at < before,
+        )
+        return list(await self.session.scalars(stmt))
+
+    async def get_completed_archive(
+        self, id: str | UUID4
+    ) -> tuple[str, datetime.datetime] | None:
+        """Archive of a completed export and when the export was scheduled"""
+        stmt = select(Exports.archive_url, Exports.created_at).where(
+            Exports.id == id,
+            Exports.status == ExportStatus.COMPLETED,
+            Exports.archive_url.is_not(None),
+        )
+        row = (await self.session.execute(stmt)).first()
+        return (row.archive_url, row.created_at) if row is not None else None
+
+    async def add_checkpoint(
+        self,
+        id: str | UUID4,
+        size: int,
+        writer: dict,
+        members: list[dict],
+        last_entry: str | None,
+    ):
+        self.session.add(
+            ExportCheckpoint(
+                id=uuid4(),
+                export_id=id,
+                size=size,
+                writer=writer,
+                members=members,
+                last_entry=last_entry,
+            )
+        )
+
+    async def get_checkpoints(self, id: str | UUID4) -> list[ExportCheckpoint]:
+        """Checkpoints of an export, oldest first"""
+        stmt = (
+            select(ExportCheckpoint)
+            .where(ExportCheckpoint.export_id == id)
+            .order_by(ExportCheckpoint.size)
+        )
+        return list(await self.session.scalars(stmt))
+
+    async def clear_checkpoints(self, id: str | UUID4):
+        await self.session.execute(
+            delete(ExportCheckpoint).where(ExportCheckpoint.export_id == id)
+        )
+
     async def delete_export(self, id: str):
         await self.session.execute(delete(Exports).where(Exports.id == id))
 
+    async def get_failed_before(
+        self, before: datetime.datetime
+    ) -> list[tuple[UUID4, str | None]]:
+        """Exports that failed or were cancelled, last changed before"""
+        stmt = select(Exports.id, Exports.archive_url).where(
+            Exports.status.in_([ExportStatus.FAILED, ExportStatus.CANCELLED]),
+            Exports.updated_at < before,
+        )
+        return [(row.id, row.archive_url) for row in await self.session.execute(stmt)]
+
+    async def delete_many(self, ids: list[UUID4]):
+        if ids:
+            await self.session.execute(
+                delete(ExportsCategories).where(ExportsCategories.export_id.in_(ids))
+            )
+            await self.session.execute(
+                delete(ExportCheckpoint).where(ExportCheckpoint.export_id.in_(ids))
+            )
+            await self.session.execute(delete(Exports).where(Exports.id.in_(ids)))
+
+    async def referenced_archives(self, urls: list[str]) -> set[str]:
+        """Subset of `urls` some export points to as its archive"""
+        if not urls:
+            return set()
+        stmt = select(Exports.archive_url).where(Exports.archive_url.in_(urls))
+        return set(await self.session.scalars(stmt))
+
 
 def get_exports_queries(db: Annotated[AsyncSession, Depends(get_db)]) -> ExportsQueries:
     """Dependency function to inject ExportsQueries with database session."""
@@ -4,7 +4,7 @@ from typing import Annotated
 from fastapi import Depends
 from pydantic import UUID4
 from sqlalchemy.ext.asyncio.session import AsyncSession
-from sqlalchemy.sql.expression import select, update
+from sqlalchemy.sql.expression import delete, insert, select, update
 
 from database_handle.database import get_db
 from database_handle.models.texts import Text
@@ -24,6 +24,19 @@ class TextsQueries:
     async def create(self, text: Text):
         self.session.add(text)
 
+    async def create_many(self, texts: list[dict]):
+        if texts:
+            await self.session.execute(insert(Text), texts)
+
+    async def update_many(self, texts: list[dict]):
+        """Bulk update by primary key, every dict must contain `id`"""
+        if texts:
+            await self.session.execute(update(Text), texts)
+
+    async def remove_many(self, ids: list[UUID4]):
+        if ids:
+            await self.session.execute(delete(Text).where(Text.id.in_(ids)))
+
 
 def get_texts_queries(db: Annotated[AsyncSession, Depends(get_db)]) -> TextsQueries:
     return TextsQueries(session=db)
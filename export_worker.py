@@ -0,0 +1,43 @@
+import asyncio
+import signal
+
+from database_handle.database import sessionmanager
+
+# Registers every table on `Base.metadata` before `create_all` runs
+from database_handle.models import (  # noqa: F401
+    audios,
+    bindings,
+    categories,
+    export_checkpoints,
+    exports,
+    exports_categories,
+    texts,
+)
+from services.export_queue import ExportWorker
+from services.object_cache import object_cache
+from services.storage import storage_service
+
+
+async def main():
+    """Build queued exports until SIGINT or SIGTERM"""
+    await sessionmanager.create_all()
+    await storage_service.start()
+    await object_cache.start()
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    worker = ExportWorker()
+    worker.start()
+    print(f"Export worker {worker.worker_id} started")
+    await stopping.wait()
+    # Exports in progress go back to the queue for another worker
+    await worker.stop()
+    storage_service.shutdown()
+    await sessionmanager.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,13 +1,19 @@
+import os
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from sqlalchemy import text
 
-from database_handle.database import engine, sessionmanager
-from database_handle.models import (
+from database_handle.database import sessionmanager
+
+# Registers every table on `Base.metadata` before `create_all` runs
+from database_handle.models import (  # noqa: F401
     audios,
     bindings,
     categories,
+    export_checkpoints,
     exports,
     exports_categories,
     texts,
@@ -24,24 +30,56 @@ from routes import (
 from routes import (
     dashboard as r_dashboard,
 )
+from routes import (
+    imports as r_imports,
+)
+from routes import (
+    storage as r_storage,
+)
 from routes import (
     texts as r_texts,
 )
 from routes.finalize import (
     routes as r_finalise,
 )
-
-texts.Base.metadata.create_all(engine)
-audios.Base.metadata.create_all(engine)
-categories.Base.metadata.create_all(engine)
-bindings.Base.metadata.create_all(engine)
-exports.Base.metadata.create_all(engine)
-exports_categories.Base.metadata.create_all(engine)
+from services.audio_jobs import cancel_jobs
+from services.audio_processing import shutdown_executor
+from services.export_queue import ExportWorker
+from services.object_cache import object_cache
+from services.storage import storage_service
+from services.storage_gc import GarbageCollector
+from services.upload_listener import LISTEN_UPLOADS, UploadListener
 
 origins = "https?://localhost:.+"
 
+# Build exports in the web app too, for single-container deployments without
+# dedicated `export_worker.py` processes
+EXPORT_WORKER_IN_APP = os.getenv("EXPORT_WORKER_IN_APP", "false").lower() == "true"
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await sessionmanager.create_all()
+    await storage_service.start()
+    await object_cache.start()
+    upload_listener = UploadListener()
+    if LISTEN_UPLOADS and storage_service.supports_notifications:
+        upload_listener.start()
+    garbage_collector = GarbageCollector()
+    garbage_collector.start()
+    export_worker = ExportWorker()
+    if EXPORT_WORKER_IN_APP:
+        export_worker.start()
+    yield
+    await export_worker.stop()
+    await garbage_collector.stop()
+    await upload_listener.stop()
+    await cancel_jobs()
+    shutdown_executor()
+    storage_service.shutdown()
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -56,6 +94,8 @@ app.include_router(r_audios.router)
 app.include_router(r_bindings.router)
 app.include_router(r_finalise.router)
 app.include_router(r_dashboard.router)
+app.include_router(r_imports.router)
+app.include_router(r_storage.router)
 
 
 @app.get("/health")
@@ -63,10 +103,15 @@ async def health():
     try:
         async with sessionmanager.connect() as conn:
             await conn.execute(text("SELECT 1"))
-        return {"status": "ok"}
+        return {"status": "ok", "storage": storage_service.stats()}
     except Exception as e:
         return JSONResponse(
-            status_code=503, content={"status": "unavailable", "detail": str(e)}
+            status_code=503,
+            content={
+                "status": "unavailable",
+                "detail": str(e),
+                "storage": storage_service.stats(),
+            },
         )
 
 
@@ -1,27 +1,70 @@
-from io import BytesIO
+import hashlib
+import json
+from enum import StrEnum
+from pathlib import Path
 from typing import Annotated
 
-import librosa
-from fastapi import APIRouter, Depends, HTTPException, UploadFile
-from fastapi.responses import StreamingResponse
-from pydantic import UUID4
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, UploadFile
+from fastapi.responses import (
+    FileResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
+from pydantic import UUID4, BaseModel, Field
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from database_handle.database import get_db
 from database_handle.models.audios import Audio, StatusEnum
 from database_handle.queries.audios import AudioQueries
-from services.minio_service import minio_service
+from database_handle.queries.bindings import BindingsQueries, get_bindings_queries
+from services.audio_jobs import (
+    generate_peaks,
+    on_audio_available,
+    peaks_object_name,
+    preview_object_name,
+)
+from services.audio_processing import extract_metadata
+from services.object_cache import object_cache
+from services.storage import storage_service
+from services.storage_service import (
+    AUDIO_FOLDER,
+    DEDUPLICATE_AUDIO,
+    MAX_URL_EXPIRES,
+    MIN_URL_EXPIRES,
+    StoredContent,
+)
 
 router = APIRouter(prefix="/audio", tags=["audio"])
 
 
+class Rendition(StrEnum):
+    ORIGINAL = "original"
+    PREVIEW = "preview"
+
+
+def rendition_object(
+    url: str, preview_url: str | None, rendition: Rendition
+) -> tuple[str, bool]:
+    """
+    Object name serving `rendition` and whether it's the preview. Falls back
+    to the original while no preview has been generated.
+    """
+    if rendition == Rendition.PREVIEW and preview_url:
+        return preview_url, True
+    return url, False
+
+
+PEAKS_MAX_AGE = 30 * 24 * 3600
+
+
 @router.post("/upload")
 async def upload_audio(
     db: Annotated[AsyncSession, Depends(get_db)],
     file: UploadFile,
     uuid: UUID4,
-    folder: str = "audio",
+    folder: str = AUDIO_FOLDER,
 ):
     """Upload audio file to MinIO and save metadata to database"""
     if file.content_type is None:
@@ -31,76 +74,271 @@ async def upload_audio(
     if not file.content_type.startswith("audio/"):
         raise HTTPException(status_code=400, detail="Only audio files are allowed")
 
-    file_content = await file.read()
-    file_size = len(file_content)
-    file_name = file.filename
-    content_type = file.content_type
-
-    object_name = await minio_service.upload_file(
-        file_data=BytesIO(file_content),
-        size=file_size,
-        filename=file_name,
-        content_type=content_type,
-        folder=folder,
-        metadata={"uuid": str(uuid)},
-    )
+    # Stream straight from the spooled upload instead of reading it into memory
+    await file.seek(0)
+    if DEDUPLICATE_AUDIO:
+        stored = await storage_service.upload_content(
+            file_data=file.file,
+            filename=file.filename,
+            content_type=file.content_type,
+            folder=folder,
+        )
+    else:
+        object_name = await storage_service.upload_stream(
+            file_data=file.file,
+            filename=file.filename,
+            content_type=file.content_type,
+            folder=folder,
+            metadata={"uuid": str(uuid)},
+        )
+        stored = StoredContent(object_name, content_hash="", created=True)
 
-    y, sr = librosa.load(BytesIO(file_content), sr=None)
-    audio_length = librosa.get_duration(y=y, sr=sr)
+    await file.seek(0)
+    metadata = await extract_metadata(file.file)
 
     async with db.begin() as session:
         queries = AudioQueries(session=session.session)
+        if not stored.created:
+            # The shared object may have been deleted since it was found
+            await queries.lock_objects([stored.object_name])
+            stored = await storage_service.restore_content(
+                file.file, stored, content_type=file.content_type
+            )
         await queries.update_audio(
             audio_id=uuid,
-            url=object_name,
-            audio_length=audio_length,
+            url=stored.object_name,
+            audio_length=metadata.duration,
             status=StatusEnum.available,
+            content_hash=stored.content_hash or None,
+        )
+        if not stored.created:
+            await queries.copy_preview_urls([stored.object_name])
+    if stored.created:
+        on_audio_available(stored.object_name)
+
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """
+    Parse a single `bytes=` range into an inclusive (start, end) pair.
+
+    Returns None for headers that aren't a single byte range, those are
+    answered with the whole file. Raises 416 for unsatisfiable ranges.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first == "":
+            start, end = max(0, size - int(last)), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"},
         )
+    return start, end
 
 
 @router.get("/download/{audio_id}")
-async def download_audio(audio_id: UUID4, db: Annotated[AsyncSession, Depends(get_db)]):
-    """Download audio file by UUID"""
+async def download_audio(
+    audio_id: UUID4,
+    request: Request,
+    db: Annotated[AsyncSession, Depends(get_db)],
+    redirect: bool = False,
+    rendition: Rendition = Rendition.ORIGINAL,
+):
+    """
+    Download audio file by UUID.
+
+    Supports `Range` and `If-None-Match` so players can seek without fetching
+    the whole file. With `redirect` the client is sent to a presigned URL and
+    the bytes don't pass through the API at all. `rendition=preview` serves
+    the small Opus playback rendition when one exists. Objects are served
+    from the local object cache once it holds them, a miss is streamed from
+    the storage while the cache is filled in the background.
+    """
     audio_record = (
         await db.scalars(select(Audio).where(Audio.id == audio_id).limit(1))
     ).first()
     if not audio_record:
         raise HTTPException(status_code=404, detail="Audio file not found")
 
-    object_name = str(audio_record.url)
+    object_name, is_preview = rendition_object(
+        str(audio_record.url), audio_record.preview_url, rendition
+    )
+    file_name = (
+        Path(audio_record.file_name).with_suffix(".ogg").name
+        if is_preview
+        else audio_record.file_name
+    )
+
+    if redirect:
+        url = await storage_service.get_file_url(object_name)
+        return RedirectResponse(url, status_code=302)
 
-    file_data = await minio_service.download_file(object_name)
+    stat = await storage_service.stat_file(object_name)
+    size = stat.size or 0
+    etag = f'"{stat.etag}"'
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Content-Disposition": f"attachment; filename={file_name}",
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and (
+        if_none_match.strip() == "*"
+        or etag in (tag.strip() for tag in if_none_match.split(","))
+    ):
+        return Response(status_code=304, headers=headers)
+
+    # A miss is streamed from the storage while the cache fills behind it
+    cached = await object_cache.peek(object_name, stat.etag, stat.size)
+    if cached is not None:
+        # Handles Range/If-Range itself and lets the server use sendfile
+        return FileResponse(
+            cached,
+            media_type=stat.content_type or "application/octet-stream",
+            headers=headers,
+        )
+
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header is not None and (if_range is None or if_range == etag):
+        byte_range = parse_range(range_header, size)
+
+    status_code = 200
+    offset, length = 0, size
+    if byte_range is not None:
+        start, end = byte_range
+        offset, length = start, end - start + 1
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(length)
+
+    stream = await storage_service.get_object_stream(object_name, offset, length)
 
     return StreamingResponse(
-        BytesIO(file_data),
-        media_type="audio/wav",
-        headers={
-            "Content-Disposition": f"attachment; filename={audio_record.file_name}"
-        },
+        stream,
+        status_code=status_code,
+        media_type=stat.content_type or "application/octet-stream",
+        headers=headers,
     )
 
 
 @router.get("/download/{audio_id}/url")
 async def download_url(audio_id: str):
-    return await minio_service.get_file_url(audio_id)
+    return await storage_service.get_file_url(audio_id)
 
 
 @router.get("/url/{audio_id}")
 async def get_audio_url(
     db: Annotated[AsyncSession, Depends(get_db)],
     audio_id: UUID4,
-    expires: int = 3600,
+    expires: Annotated[int, Query(ge=MIN_URL_EXPIRES, le=MAX_URL_EXPIRES)] = 3600,
+    rendition: Rendition = Rendition.ORIGINAL,
 ):
     """Get presigned URL for audio file access"""
     audio_record = await db.scalar(select(Audio).where(Audio.id == audio_id).limit(1))
     if not audio_record:
         raise HTTPException(status_code=404, detail="Audio file not found")
 
-    object_name = audio_record.url.split(f"{minio_service.bucket_name}/")[-1]
+    object_name, _ = rendition_object(
+        audio_record.url, audio_record.preview_url, rendition
+    )
+    object_name = object_name.split(f"{storage_service.bucket_name}/")[-1]
 
-    url = await minio_service.get_file_url(object_name, expires)
+    # Cached URLs have less of their lifetime left than asked for
+    urls = await storage_service.get_file_urls([object_name], expires)
+    url, expires_in = urls[object_name]
 
-    return {"url": url, "expires_in": expires}
+    return {"url": url, "expires_in": expires_in}
+
+
+MAX_BATCH_URLS = 500
+
+
+class AudioUrlsRequest(BaseModel):
+    binding_ids: list[UUID4]
+    expires: int = Field(3600, ge=MIN_URL_EXPIRES, le=MAX_URL_EXPIRES)
+    rendition: Rendition = Rendition.ORIGINAL
+
+
+class AudioUrlModel(BaseModel):
+    binding_id: UUID4
+    audio_id: UUID4
+    url: str
+    expires_in: int
+
+
+@router.post("/urls", response_model=list[AudioUrlModel])
+async def get_audio_urls(
+    params: AudioUrlsRequest,
+    queries: Annotated[BindingsQueries, Depends(get_bindings_queries)],
+):
+    """Get presigned URLs for a page of bindings in one request"""
+    if len(params.binding_ids) > MAX_BATCH_URLS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_BATCH_URLS} bindings can be requested at once",
+        )
+    rows = [
+        (binding_id, audio_id, rendition_object(url, preview_url, params.rendition)[0])
+        for binding_id, audio_id, url, preview_url in await queries.get_audio_urls(
+            params.binding_ids
+        )
+    ]
+    urls = await storage_service.get_file_urls(
+        [object_name for _, _, object_name in rows], params.expires
+    )
+    return [
+        AudioUrlModel(
+            binding_id=binding_id,
+            audio_id=audio_id,
+            url=urls[object_name][0],
+            expires_in=urls[object_name][1],
+        )
+        for binding_id, audio_id, object_name in rows
+    ]
+
+
+@router.get("/{audio_id}/peaks")
+async def get_audio_peaks(
+    audio_id: UUID4, db: Annotated[AsyncSession, Depends(get_db)]
+):
+    """
+    Get precomputed min/max waveform peaks of an audio at a few resolutions.
+
+    Peaks missing for audio uploaded before they were introduced are computed
+    on the first request.
+    """
+    audio_record = await db.scalar(select(Audio).where(Audio.id == audio_id).limit(1))
+    if not audio_record or audio_record.audio_status != StatusEnum.available:
+        raise HTTPException(status_code=404, detail="Audio file not found")
+
+    object_name = str(audio_record.url)
+    try:
+        data = await storage_service.download_file(peaks_object_name(object_name))
+    except HTTPException:
+        data = json.dumps(
+            await generate_peaks(object_name), separators=(",", ":")
+        ).encode()
+
+    return Response(
+        content=data,
+        media_type="application/json",
+        headers={
+            "Cache-Control": f"public, max-age={PEAKS_MAX_AGE}",
+            "ETag": f'"{hashlib.md5(data).hexdigest()}"',
+        },
+    )
 
 
 @router.delete("/{audio_id}")
@@ -110,13 +348,31 @@ async def delete_audio(audio_id: UUID4, db: Annotated[AsyncSession, Depends(get_
     if not audio_record:
         raise HTTPException(status_code=404, detail="Audio file not found")
 
-    object_name = str(audio_record.url).split(f"{minio_service.bucket_name}/")[-1]
+    object_name = str(audio_record.url).split(f"{storage_service.bucket_name}/")[-1]
 
-    success = await minio_service.delete_file(object_name)
-
-    if success:
-        async with db.begin() as session:
-            await session.session.delete(audio_record)
+    # The lookup above already began the session's transaction
+    queries = AudioQueries(session=db)
+    await queries.lock_objects([object_name])
+    await db.delete(audio_record)
+    await db.flush()
+    if await queries.is_referenced(object_name):
+        # Deduplicated object still used by other audios
+        await db.commit()
         return {"message": "Audio file deleted successfully"}
-    else:
-        raise HTTPException(status_code=500, detail="Failed to delete audio file")
+
+    # Derived objects go in the same request, missing ones are ignored. They're
+    # deleted before the commit releases the lock, so an upload about to
+    # share the object waits and stores it again
+    failed = await storage_service.delete_files(
+        [
+            object_name,
+            peaks_object_name(object_name),
+            preview_object_name(object_name),
+        ]
+    )
+    await db.commit()
+
+    if object_name in failed:
+        # The row is gone, so a retry would 404; storage GC removes it later
+        print(f"Audio {audio_id} deleted, its object {object_name} was left behind")
+    return {"message": "Audio file deleted successfully"}
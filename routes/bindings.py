@@ -1,7 +1,7 @@
 from typing import Annotated
 from uuid import uuid4
 
-from fastapi import APIRouter, Depends, File, HTTPException, UploadFile
+from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile
 from pydantic import BaseModel
 from pydantic.types import UUID4
 from sqlalchemy import select
@@ -14,7 +14,16 @@ from database_handle.models.texts import Text
 from database_handle.queries.audios import AudioQueries
 from database_handle.queries.bindings import BindingsQueries, get_bindings_queries
 from database_handle.queries.categories import CategoriesQueries
-from services.minio_service import minio_service
+from services.audio_jobs import peaks_object_name, preview_object_name
+from services.ingest_service import (
+    IngestFile,
+    IngestResult,
+    IngestService,
+    iter_archive_audio,
+    iter_batches,
+)
+from services.storage import storage_service
+from services.storage_service import AUDIO_FOLDER
 
 __all__ = ["router"]
 
@@ -56,25 +65,38 @@ async def get_all_bindings(
 
 class CreateResponseModel(BaseModel):
     binding_id: UUID4
+    upload_url: str | None = None
 
 
 @router.post("", response_model=CreateResponseModel)
 async def create_binding(
-    audio: Annotated[UploadFile, File()],
     db: Annotated[AsyncSession, Depends(get_db)],
+    audio: Annotated[UploadFile | None, File()] = None,
+    file_name: Annotated[str | None, Form()] = None,
     category: str | None = None,
+    presigned: bool = False,
+    expires: int = 3600,
 ):
-    if not audio.filename:
+    """
+    Create binding for an audio file.
+
+    With `presigned` the response carries an `upload_url` the client PUTs the
+    audio to directly; the upload listener makes the audio available once the
+    object lands in the bucket.
+    """
+    filename = audio.filename if audio is not None else file_name
+    if not filename:
         raise HTTPException(
             status_code=400, detail="Audio file is required to have filename"
         )
     binding_id = uuid4()
+    object_name = f"{AUDIO_FOLDER}/{filename}" if presigned else None
     try:
         async with db.begin() as session:
             bindings_queries = BindingsQueries(session=session.session)
             categories_queries = CategoriesQueries(session=session.session)
             audios_queries = AudioQueries(session=session.session)
-            audio_already_exists = await audios_queries.exists(audio.filename)
+            audio_already_exists = await audios_queries.exists(filename)
             if audio_already_exists:
                 raise HTTPException(status_code=409, detail="Audio file already exists")
 
@@ -95,7 +117,8 @@ async def create_binding(
             session.session.add(
                 Audio(
                     id=binding_id,
-                    file_name=audio.filename,
+                    url=object_name,
+                    file_name=filename,
                     audio_status=StatusEnum.waiting,
                 )
             )
@@ -105,7 +128,62 @@ async def create_binding(
     except Exception as e:
         print(e)
         raise HTTPException(status_code=500, detail="Failed to create audio file")
-    return CreateResponseModel(binding_id=binding_id)
+
+    upload_url = (
+        await storage_service.get_upload_url(object_name, expires)
+        if object_name is not None
+        else None
+    )
+    return CreateResponseModel(binding_id=binding_id, upload_url=upload_url)
+
+
+@router.post("/bulk", response_model=list[IngestResult])
+async def create_bindings_bulk(
+    db: Annotated[AsyncSession, Depends(get_db)],
+    files: Annotated[list[UploadFile] | None, File()] = None,
+    archive: Annotated[UploadFile | None, File()] = None,
+    category: str | None = None,
+):
+    """
+    Create bindings and upload audio for many files in one request.
+
+    Files can be sent as a multipart batch and/or packed in a ZIP or tar
+    `archive`. Rows are inserted in batches and objects uploaded concurrently;
+    the response holds a result per file.
+    """
+    uploads: list[IngestFile] = []
+    for file in files or []:
+        if not file.filename:
+            raise HTTPException(
+                status_code=400, detail="Audio file is required to have filename"
+            )
+        if file.content_type is None or not file.content_type.startswith("audio/"):
+            raise HTTPException(
+                status_code=400, detail=f"'{file.filename}' is not an audio file"
+            )
+        uploads.append(
+            IngestFile(
+                file_name=file.filename,
+                data=file.file,
+                content_type=file.content_type,
+                category=category,
+            )
+        )
+
+    service = IngestService(session=db)
+    results: list[IngestResult] = []
+    async for batch in iter_batches(uploads):
+        results.extend(await service.ingest(batch))
+
+    if archive is not None:
+        async for batch in iter_batches(iter_archive_audio(archive.file, category)):
+            try:
+                results.extend(await service.ingest(batch))
+            finally:
+                for file in batch:
+                    file.data.close()
+
+    return results
 
 
 @router.delete("/{binding_id}")
@@ -120,14 +198,28 @@ async def remove_binding(
         if not audio_record:
             raise HTTPException(status_code=404, detail="Audio file not found")
 
-        object_name = str(audio_record.url).split(f"{minio_service.bucket_name}/")[-1]
-        success = await minio_service.delete_file(object_name)
-        if not success:
-            raise HTTPException(status_code=500, detail="Failed to delete audio file")
+        object_name = str(audio_record.url).split(f"{storage_service.bucket_name}/")[-1]
 
+        audios_queries = AudioQueries(session=t.session)
+        await audios_queries.lock_objects([object_name])
         queries = BindingsQueries(session=t.session)
         await queries.remove(binding_id)
         await t.session.delete(audio_record)
+        await t.session.flush()
+
+        # Deduplicated objects are only deleted with the last audio using them
+        if not await audios_queries.is_referenced(object_name):
+            failed = await storage_service.delete_files(
+                [
+                    object_name,
+                    peaks_object_name(object_name),
+                    preview_object_name(object_name),
+                ]
+            )
+            if object_name in failed:
+                raise HTTPException(
+                    status_code=500, detail="Failed to delete audio file"
+                )
 
     return {"hejo": binding_id}
 
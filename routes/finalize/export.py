@@ -0,0 +1,663 @@
+import asyncio
+import concurrent.futures
+import copy
+import datetime
+import os
+import shutil
+import time
+import zipfile
+from abc import ABC, abstractmethod
+from collections import Counter, deque
+from collections.abc import AsyncIterable, AsyncIterator, Awaitable, Callable
+from contextlib import ExitStack
+from dataclasses import dataclass
+from itertools import pairwise
+from pathlib import Path
+from tempfile import TemporaryFile
+from typing import BinaryIO, Self, cast
+
+from database_handle.queries.bindings import ExportRow
+from routes.finalize.classes import FinaliseConfigModel
+from routes.finalize.constants import TranscriptFile, WavsDir
+from routes.finalize.utils import format_line
+from services.object_cache import object_cache
+from services.storage import storage_service
+from services.storage_service import STREAM_CHUNK_SIZE, ObjectWriter
+
+__all__ = [
+    "BaseArchive",
+    "Checkpoints",
+    "ExportEntry",
+    "ResumePoint",
+    "discard_upload",
+    "iter_entries",
+    "prefetch_objects",
+    "stream_archive",
+    "upload_archive",
+    "write_archive",
+    "write_entry",
+]
+
+# Objects fetched ahead of the one being written into the archive
+EXPORT_PREFETCH_DEPTH = int(os.getenv("EXPORT_PREFETCH_DEPTH", "16"))
+# Bytes of prefetched objects held in memory at once
+EXPORT_PREFETCH_BYTES = int(os.getenv("EXPORT_PREFETCH_BYTES", str(256 * 1024 * 1024)))
+# Chunks of a streamed archive buffered ahead of the client
+STREAM_QUEUE_CHUNKS = int(os.getenv("EXPORT_STREAM_QUEUE_CHUNKS", "16"))
+# Archive bytes written between checkpoints an interrupted upload resumes from
+EXPORT_CHECKPOINT_BYTES = int(
+    os.getenv("EXPORT_CHECKPOINT_BYTES", str(256 * 1024 * 1024))
+)
+
+
+@dataclass
+class ExportEntry:
+    """Archive member copied from an object, or from a local file if `file`"""
+
+    arcname: str
+    object_name: str | None = None
+    file: BinaryIO | None = None
+    # When the object last changed, None if unknown
+    updated_at: datetime.datetime | None = None
+    # Same member of the base archive, copied instead of fetching the object
+    reuse: zipfile.ZipInfo | None = None
+
+
+@dataclass
+class PrefetchedObject:
+    """Either a local file holding the object or its bytes"""
+
+    path: Path | None = None
+    data: bytes | None = None
+    file: BinaryIO | None = None
+
+    @property
+    def size_in_memory(self) -> int:
+        return len(self.data) if self.data is not None else 0
+
+
+@dataclass
+class ResumePoint:
+    """Latest checkpoint of an archive upload"""
+
+    # State of the storage writer, see `ObjectWriter.checkpoint`
+    writer: dict
+    # Every member written up to the checkpoint, see `member_record`
+    members: list[dict]
+
+
+class Checkpoints(ABC):
+    """Where an archive upload saves how far it got, so it can be resumed"""
+
+    @abstractmethod
+    async def load(self) -> ResumePoint | None: ...
+
+    @abstractmethod
+    async def save(self, writer: dict, size: int, members: list[dict], last_entry: str):
+        """Record a checkpoint with the members added since the previous one"""
+
+    @abstractmethod
+    async def clear(self): ...
+
+
+def member_record(info: zipfile.ZipInfo) -> dict:
+    """What the central directory needs of a written member"""
+    return {
+        "filename": info.filename,
+        "date_time": list(info.date_time),
+        "compress_type": info.compress_type,
+        "flag_bits": info.flag_bits,
+        "crc": info.CRC,
+        "compress_size": info.compress_size,
+        "file_size": info.file_size,
+        "header_offset": info.header_offset,
+        "external_attr": info.external_attr,
+        "create_system": info.create_system,
+        "create_version": info.create_version,
+        "extract_version": info.extract_version,
+        "extra": info.extra.hex(),
+    }
+
+
+def member_from_record(record: dict) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo(record["filename"], tuple(record["date_time"]))
+    info.compress_type = record["compress_type"]
+    info.flag_bits = record["flag_bits"]
+    info.CRC = record["crc"]
+    info.compress_size = record["compress_size"]
+    info.file_size = record["file_size"]
+    info.header_offset = record["header_offset"]
+    info.external_attr = record["external_attr"]
+    info.create_system = record["create_system"]
+    info.create_version = record["create_version"]
+    info.extract_version = record["extract_version"]
+    info.extra = bytes.fromhex(record["extra"])
+    return info
+
+
+async def iter_entries(
+    rows: AsyncIterable[ExportRow], config: FinaliseConfigModel
+) -> AsyncIterator[ExportEntry]:
+    """
+    Archive members for rows ordered by category. Transcript lines are
+    spooled to a temporary file, a category's transcript follows its last
+    audio. The consumer owns yielded files and closes them.
+    """
+    transcript: BinaryIO | None = None
+    transcript_name = TranscriptFile.name
+    category_id = None
+    indexed_categories: dict[str, int] = {}
+
+    with ExitStack() as spooled:
+
+        def take_transcript() -> ExportEntry:
+            nonlocal transcript
+            entry = ExportEntry(transcript_name, file=transcript)
+            transcript = None
+            spooled.pop_all()
+            return entry
+
+        async for row in rows:
+            category_name = (
+                row.category_name
+                if row.category_name is not None
+                else config.uncategorized_name
+            )
+            if config.divide_by_category:
+                if transcript is not None and row.category_id != category_id:
+                    yield take_transcript()
+                category_id = row.category_id
+                transcript_name = str(Path(category_name, TranscriptFile))
+                arcname = str(Path(category_name, WavsDir.name, row.file_name))
+                category_index = 0
+            else:
+                arcname = row.file_name
+                category_index = indexed_categories.setdefault(
+                    category_name, len(indexed_categories)
+                )
+
+            yield ExportEntry(arcname, row.url, updated_at=row.audio_updated_at)
+            if config.export_transcript:
+                if transcript is None:
+                    transcript = spooled.enter_context(TemporaryFile("wb+"))
+                line = format_line(
+                    config,
+                    row.file_name,
+                    row.text,
+                    row.audio_length,
+                    category_name,
+                    category_index,
+                )
+                transcript.write(line.encode())
+
+        if transcript is not None:
+            yield take_transcript()
+
+
+class BaseArchive:
+    """
+    Archive of an earlier export an incremental export copies unchanged
+    members from. Only its central directory is read.
+    """
+
+    object_name: str
+    created_at: datetime.datetime
+    members: dict[str, zipfile.ZipInfo]
+    # Header offset of a member -> offset right after it
+    ends: dict[int, int]
+
+    def __init__(
+        self, object_name: str, created_at: datetime.datetime, zf: zipfile.ZipFile
+    ):
+        self.object_name = object_name
+        self.created_at = created_at
+        infos = sorted(zf.infolist(), key=lambda info: info.header_offset)
+        self.members = {info.filename: info for info in infos}
+        self.ends = {
+            info.header_offset: following.header_offset
+            for info, following in pairwise(infos)
+        }
+        if infos:
+            self.ends[infos[-1].header_offset] = zf.start_dir
+
+    @classmethod
+    async def open(cls, object_name: str, created_at: datetime.datetime) -> Self:
+        reader = await storage_service.open_object(object_name)
+        try:
+            zf = await asyncio.to_thread(zipfile.ZipFile, reader)
+            return cls(object_name, created_at, zf)
+        finally:
+            reader.close()
+
+    async def mark_reusable(
+        self, entries: AsyncIterable[ExportEntry]
+    ) -> AsyncIterator[ExportEntry]:
+        """
+        Point entries whose audio hasn't changed since the base export was
+        scheduled at their copy in the base archive
+        """
+        async for entry in entries:
+            info = self.members.get(entry.arcname)
+            if (
+                info is not None
+                and entry.object_name is not None
+                and entry.updated_at is not None
+                and entry.updated_at <= self.created_at
+            ):
+                entry.reuse = info
+            yield entry
+
+    def follows(self, previous: zipfile.ZipInfo, info: zipfile.ZipInfo) -> bool:
+        return self.ends[previous.header_offset] == info.header_offset
+
+
+def _copy_members(
+    zf: zipfile.ZipFile, base: BaseArchive, members: list[zipfile.ZipInfo]
+):
+    """
+    Copy adjacent members of the base archive as they are stored, local
+    headers and data descriptors included, and add them to the directory
+    """
+    writer = cast(ObjectWriter, zf.fp)
+    start = members[0].header_offset
+    position = writer.tell()
+    writer.copy_range(
+        base.object_name, start, base.ends[members[-1].header_offset] - start
+    )
+    for member in members:
+        info = copy.copy(member)
+        info.header_offset = position + member.header_offset - start
+        zf.filelist.append(info)
+        zf.NameToInfo[info.filename] = info
+    zf.start_dir = writer.tell()
+
+
+class OrderedByteBudget:
+    """
+    Caps the bytes held by prefetched objects. Space is granted in archive
+    order, so a later object can never take the space the next one written
+    is waiting for. An object bigger than the whole budget is let through
+    once nothing else is held.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._turn = 0
+        self._changed = asyncio.Condition()
+
+    async def acquire(self, ticket: int, size: int):
+        async with self._changed:
+            await self._changed.wait_for(
+                lambda: (
+                    self._turn == ticket
+                    and (self.used == 0 or self.used + size <= self.limit)
+                )
+            )
+            self.used += size
+            self._turn += 1
+            self._changed.notify_all()
+
+    async def release(self, size: int):
+        async with self._changed:
+            self.used -= size
+            self._changed.notify_all()
+
+
+async def _fetch(
+    entry: ExportEntry, ticket: int, budget: OrderedByteBudget
+) -> PrefetchedObject:
+    if entry.object_name is None or entry.reuse is not None:
+        await budget.acquire(ticket, 0)
+        return PrefetchedObject(file=entry.file)
+    object_name = entry.object_name
+    path = await object_cache.get(object_name)
+    if path is not None:
+        await budget.acquire(ticket, 0)
+        return PrefetchedObject(path=path)
+    stat = await storage_service.stat_file(object_name)
+    await budget.acquire(ticket, stat.size or 0)
+    return PrefetchedObject(data=await storage_service.download_file(object_name))
+
+
+async def prefetch_objects(
+    entries: AsyncIterable[ExportEntry],
+    depth: int = EXPORT_PREFETCH_DEPTH,
+    max_bytes: int = EXPORT_PREFETCH_BYTES,
+) -> AsyncIterator[tuple[ExportEntry, PrefetchedObject]]:
+    """
+    Yield entries with their objects in order while up to `depth` of the
+    following ones are fetched concurrently, so fetching overlaps with
+    writing the archive. Memory is bounded by `max_bytes`, not the number
+    of entries. Files of entries are closed once the consumer moves on.
+    """
+    budget = OrderedByteBudget(max_bytes)
+    pending: deque[tuple[ExportEntry, asyncio.Task[PrefetchedObject]]] = deque()
+    iterator = aiter(entries)
+    ticket = 0
+    try:
+        while True:
+            while len(pending) < depth and (entry := await anext(iterator, None)):
+                task = asyncio.create_task(_fetch(entry, ticket, budget))
+                pending.append((entry, task))
+                ticket += 1
+            if not pending:
+                break
+            entry, task = pending.popleft()
+            fetched = await task
+            try:
+                yield entry, fetched
+            finally:
+                if entry.file is not None:
+                    entry.file.close()
+                await budget.release(fetched.size_in_memory)
+    finally:
+        for entry, task in pending:
+            task.cancel()
+            if entry.file is not None:
+                entry.file.close()
+        await asyncio.gather(*(task for _, task in pending), return_exceptions=True)
+
+
+async def _write_in_thread[T](fn: Callable[..., T], *args) -> T:
+    """
+    Run a write to the archive on a worker thread. Threads can't be stopped,
+    so a cancellation is only raised once the write returned and nothing
+    writes to the archive while the caller cleans up after it.
+    """
+    write = asyncio.ensure_future(asyncio.to_thread(fn, *args))
+    try:
+        return await asyncio.shield(write)
+    except asyncio.CancelledError:
+        await asyncio.wait({write})
+        # Retrieved so a failed write isn't reported as never retrieved
+        write.exception()
+        raise
+
+
+def _write_file(zf: zipfile.ZipFile, arcname: str, file: BinaryIO):
+    # Size known up front, so zipfile picks ZIP64 when the member needs it
+    size = file.seek(0, os.SEEK_END)
+    file.seek(0)
+    info = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+    info.file_size = size
+    info.compress_type = zf.compression
+    with zf.open(info, mode="w") as member:
+        shutil.copyfileobj(file, member)
+
+
+async def write_entry(
+    zf: zipfile.ZipFile, entry: ExportEntry, fetched: PrefetchedObject
+):
+    """Add a prefetched object to the archive off the event loop"""
+    if fetched.file is not None:
+        await _write_in_thread(_write_file, zf, entry.arcname, fetched.file)
+        return
+    if fetched.path is not None:
+        try:
+            await _write_in_thread(zf.write, fetched.path, entry.arcname)
+            return
+        except FileNotFoundError:
+            # Evicted from the object cache in the meantime
+            assert entry.object_name is not None
+            fetched = PrefetchedObject(
+                data=await storage_service.download_file(entry.object_name)
+            )
+    await _write_in_thread(zf.writestr, entry.arcname, fetched.data or b"")
+
+
+async def write_archive(
+    zf: zipfile.ZipFile,
+    entries: AsyncIterable[ExportEntry],
+    base: BaseArchive | None = None,
+    on_written: Callable[[ExportEntry], Awaitable[None]] | None = None,
+):
+    """
+    Write entries into the archive, `on_written` is awaited for each entry
+    once it and everything before it is in the archive
+    """
+    # Entries reused from the base archive are copied a contiguous run at once
+    run: list[ExportEntry] = []
+
+    async def copy_run():
+        if run and base is not None:
+            members = [cast(zipfile.ZipInfo, entry.reuse) for entry in run]
+            await _write_in_thread(_copy_members, zf, base, members)
+            if on_written is not None:
+                for entry in run:
+                    await on_written(entry)
+        run.clear()
+
+    async for entry, fetched in prefetch_objects(entries):
+        if entry.reuse is not None and base is not None:
+            if run and not base.follows(
+                cast(zipfile.ZipInfo, run[-1].reuse), entry.reuse
+            ):
+                await copy_run()
+            run.append(entry)
+            continue
+        await copy_run()
+        await write_entry(zf, entry, fetched)
+        if on_written is not None:
+            await on_written(entry)
+    await copy_run()
+
+
+async def _skip_written(
+    entries: AsyncIterable[ExportEntry],
+    members: list[zipfile.ZipInfo],
+    on_skipped: Callable[[ExportEntry], Awaitable[None]],
+) -> AsyncIterator[ExportEntry]:
+    """Drop entries a resumed archive already holds, repeated names included"""
+    written = Counter(info.filename for info in members)
+    async for entry in entries:
+        if written[entry.arcname] > 0:
+            written[entry.arcname] -= 1
+            if entry.file is not None:
+                entry.file.close()
+            await on_skipped(entry)
+            continue
+        yield entry
+
+
+async def _open_upload(
+    object_name: str, checkpoints: Checkpoints | None
+) -> tuple[ObjectWriter, list[zipfile.ZipInfo] | None]:
+    """Writer of the archive and its members so far when it's resumed"""
+    resume = await checkpoints.load() if checkpoints is not None else None
+    if checkpoints is not None and resume is not None:
+        try:
+            writer = await storage_service.open_writer(
+                object_name, content_type="application/zip", resume=resume.writer
+            )
+            return writer, [member_from_record(record) for record in resume.members]
+        except Exception as e:
+            print(f"Can't resume upload of {object_name}, starting over: {e}")
+            await checkpoints.clear()
+    writer = await storage_service.open_writer(
+        object_name, content_type="application/zip"
+    )
+    return writer, None
+
+
+async def upload_archive(
+    object_name: str,
+    entries: AsyncIterable[ExportEntry],
+    base: BaseArchive | None = None,
+    checkpoints: Checkpoints | None = None,
+    on_written: Callable[[ExportEntry, int, bool], Awaitable[None]] | None = None,
+):
+    """
+    Build the archive straight into storage: parts are uploaded while later
+    entries are still being fetched, and no local copy of the archive is
+    made. The object only appears once the archive is complete.
+
+    With a `base` archive, members whose audio hasn't changed are copied
+    from it inside the storage rather than fetched again.
+
+    With `checkpoints`, progress is saved every `EXPORT_CHECKPOINT_BYTES`
+    and a failed upload is kept, so the next call carries on from the last
+    checkpoint instead of fetching everything again.
+
+    `on_written` is awaited with each entry, the bytes written so far and
+    whether the entry was already in the resumed archive.
+    """
+    writer, written = await _open_upload(object_name, checkpoints)
+    resumable = written is not None
+    try:
+        # Storage writers aren't seekable, entries get data descriptors
+        zf = zipfile.ZipFile(writer, mode="w", compression=zipfile.ZIP_STORED)
+        if written is not None:
+            for info in written:
+                zf.filelist.append(info)
+                zf.NameToInfo[info.filename] = info
+
+            async def skipped(entry: ExportEntry):
+                if on_written is not None:
+                    await on_written(entry, writer.tell(), True)
+
+            entries = _skip_written(entries, written, skipped)
+        if base is not None:
+            entries = base.mark_reusable(entries)
+
+        saved = len(zf.filelist)
+        saved_size = writer.tell()
+
+        async def checkpoint(entry: ExportEntry):
+            nonlocal saved, saved_size, resumable
+            if checkpoints is None or (
+                writer.tell() - saved_size < EXPORT_CHECKPOINT_BYTES
+            ):
+                return
+            state = await _write_in_thread(writer.checkpoint)
+            if state is None:
+                return
+            await checkpoints.save(
+                state,
+                writer.tell(),
+                [member_record(info) for info in zf.filelist[saved:]],
+                entry.arcname,
+            )
+            saved = len(zf.filelist)
+            saved_size = writer.tell()
+            resumable = True
+
+        async def entry_written(entry: ExportEntry):
+            await checkpoint(entry)
+            if on_written is not None:
+                await on_written(entry, writer.tell(), False)
+
+        await write_archive(zf, entries, base, entry_written)
+        await _write_in_thread(zf.close)
+        await _write_in_thread(writer.commit)
+    except BaseException:
+        # Writes of a cancelled export have returned by now, see `_write_in_thread`
+        if not resumable:
+            await asyncio.to_thread(writer.abort)
+        raise
+
+
+async def discard_upload(object_name: str, checkpoints: Checkpoints):
+    """Abort an upload left unfinished to be resumed, and forget its progress"""
+    resume = await checkpoints.load()
+    if resume is not None:
+        try:
+            writer = await storage_service.open_writer(
+                object_name, content_type="application/zip", resume=resume.writer
+            )
+            await asyncio.to_thread(writer.abort)
+        except Exception as e:
+            print(f"Error discarding upload of {object_name}: {e}")
+    await checkpoints.clear()
+
+
+class ArchiveStream:
+    """
+    Write-only file object handing archive bytes to the event loop in
+    `STREAM_CHUNK_SIZE` chunks. Writes happen on worker threads and block
+    while the queue is full, so a slow client slows the archive down
+    instead of buffering it.
+    """
+
+    def __init__(self, queue: asyncio.Queue[bytes | None]):
+        self._queue = queue
+        self._loop = asyncio.get_running_loop()
+        self._buffer = bytearray()
+        self._position = 0
+        self._pending: concurrent.futures.Future | None = None
+        self._closed = False
+
+    def _put(self, chunk: bytes | None):
+        if self._closed:
+            raise OSError("Archive stream closed")
+        self._pending = asyncio.run_coroutine_threadsafe(
+            self._queue.put(chunk), self._loop
+        )
+        try:
+            self._pending.result()
+        except concurrent.futures.CancelledError:
+            raise OSError("Archive stream closed")
+
+    def write(self, data: bytes) -> int:
+        self._buffer += data
+        self._position += len(data)
+        if len(self._buffer) >= STREAM_CHUNK_SIZE:
+            self._put(bytes(self._buffer))
+            self._buffer.clear()
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        if self._buffer:
+            self._put(bytes(self._buffer))
+            self._buffer.clear()
+        self._put(None)
+
+    def close(self):
+        """Unblock and fail writes once nobody reads the stream anymore"""
+        self._closed = True
+        if self._pending is not None:
+            self._pending.cancel()
+
+
+async def stream_archive(
+    entries: AsyncIterable[ExportEntry],
+) -> AsyncIterator[bytes]:
+    """
+    Yield the archive as it's built, nothing is stored. Sizes of every entry
+    are known when it's written, so archives past 4 GiB switch to ZIP64.
+    """
+    queue: asyncio.Queue[bytes | None] = asyncio.Queue(maxsize=STREAM_QUEUE_CHUNKS)
+    stream = ArchiveStream(queue)
+
+    async def produce():
+        zf = zipfile.ZipFile(stream, mode="w", compression=zipfile.ZIP_STORED)
+        await write_archive(zf, entries)
+        await asyncio.to_thread(zf.close)
+        await asyncio.to_thread(stream.finish)
+
+    task = asyncio.create_task(produce())
+    get: asyncio.Future[bytes | None] | None = None
+    try:
+        while True:
+            get = asyncio.ensure_future(queue.get())
+            await asyncio.wait((get, task), return_when=asyncio.FIRST_COMPLETED)
+            if not get.done() and task.exception() is not None:
+                # Failed before finishing the archive
+                await task
+            chunk = await get
+            if chunk is None:
+                break
+            yield chunk
+        await task
+    finally:
+        if get is not None:
+            get.cancel()
+        stream.close()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
@@ -0,0 +1,248 @@
+import os
+import time
+
+from pydantic import UUID4
+
+from database_handle.database import get_sessionmanager
+from database_handle.models.exports import ExportStatus
+from database_handle.queries.bindings import BindingsQueries
+from database_handle.queries.exports import ExportsQueries, ExportStatusMessage
+from routes.finalize.classes import FinaliseConfigModel
+from routes.finalize.constants import OUTPUT_ARCHIVE
+from routes.finalize.export import (
+    BaseArchive,
+    Checkpoints,
+    ExportEntry,
+    ResumePoint,
+    discard_upload,
+    iter_entries,
+    upload_archive,
+)
+from services.listener_service import Channels, ListenerService
+from services.storage import storage_service
+
+__all__ = [
+    "ExportCheckpoints",
+    "ExportError",
+    "ExportProgress",
+    "discard_export_upload",
+    "export_is_cancelled",
+    "publish_status",
+    "run_export",
+    "set_export_status",
+]
+
+# Seconds between progress updates of a running export, each one is saved on
+# the export and published
+EXPORT_PROGRESS_INTERVAL = float(os.getenv("EXPORT_PROGRESS_INTERVAL", "0.5"))
+
+
+class ExportError(Exception):
+    """An export can't be built from what's recorded for it"""
+
+
+async def publish_status(
+    listener_service: ListenerService, id: str, status: ExportStatus
+):
+    await listener_service.publish(
+        Channels.EXPORTS.value,
+        ExportStatusMessage(id=id, status=status.value).to_json(),
+    )
+
+
+async def set_export_status(
+    listener_service: ListenerService, id: str, status: ExportStatus
+):
+    async with get_sessionmanager().session() as session:
+        await ExportsQueries(session=session).set_status(id, status)
+        await session.commit()
+    await publish_status(listener_service, id, status)
+
+
+class ExportCheckpoints(Checkpoints):
+    """
+    Checkpoints of an export's archive, kept in `export_checkpoints` and
+    committed right away in sessions of their own
+    """
+
+    def __init__(self, id: str):
+        self.id = id
+
+    async def load(self) -> ResumePoint | None:
+        async with get_sessionmanager().session() as session:
+            checkpoints = await ExportsQueries(session=session).get_checkpoints(self.id)
+        if not checkpoints:
+            return None
+        return ResumePoint(
+            writer=checkpoints[-1].writer,
+            members=[
+                member for checkpoint in checkpoints for member in checkpoint.members
+            ],
+        )
+
+    async def save(self, writer: dict, size: int, members: list[dict], last_entry: str):
+        async with get_sessionmanager().session() as session:
+            await ExportsQueries(session=session).add_checkpoint(
+                self.id, size, writer, members, last_entry
+            )
+            await session.commit()
+
+    async def clear(self):
+        async with get_sessionmanager().session() as session:
+            await ExportsQueries(session=session).clear_checkpoints(self.id)
+            await session.commit()
+
+
+class ExportProgress:
+    """
+    Audio files and archive bytes a running export has written, saved on
+    the export and published at most every `EXPORT_PROGRESS_INTERVAL`
+    seconds. The ETA assumes the files left take as long as the ones this
+    run wrote so far.
+    """
+
+    def __init__(self, id: str, listener_service: ListenerService, files_total: int):
+        self.id = id
+        self.listener_service = listener_service
+        self.files_total = files_total
+        self.files_done = 0
+        self.bytes_written = 0
+        # Files written by this run, not ones a resumed archive already had
+        self._files_written = 0
+        self._started = time.monotonic()
+        self._reported_at = 0.0
+
+    def eta_seconds(self) -> int | None:
+        if not self._files_written:
+            return None
+        rate = self._files_written / (time.monotonic() - self._started)
+        return round(max(self.files_total - self.files_done, 0) / rate)
+
+    async def written(self, entry: ExportEntry, size: int, resumed: bool):
+        if entry.object_name is not None:
+            self.files_done += 1
+            if not resumed:
+                self._files_written += 1
+        self.bytes_written = size
+        if time.monotonic() - self._reported_at >= EXPORT_PROGRESS_INTERVAL:
+            await self.report()
+
+    async def report(self):
+        """Save and publish the progress now, failures don't stop the export"""
+        self._reported_at = time.monotonic()
+        eta_seconds = self.eta_seconds()
+        try:
+            async with get_sessionmanager().session() as session:
+                await ExportsQueries(session=session).set_progress(
+                    self.id,
+                    self.files_total,
+                    self.files_done,
+                    self.bytes_written,
+                    eta_seconds,
+                )
+                await session.commit()
+            await self.listener_service.publish(
+                Channels.EXPORTS.value,
+                ExportStatusMessage(
+                    id=self.id,
+                    status=ExportStatus.IN_PROGRESS.value,
+                    files_total=self.files_total,
+                    files_done=self.files_done,
+                    bytes_written=self.bytes_written,
+                    eta_seconds=eta_seconds,
+                ).to_json(),
+            )
+        except Exception as e:
+            print(f"Error reporting progress of export {self.id}: {e}")
+
+
+def _upload_name(id: str) -> str:
+    return f"{id}_{OUTPUT_ARCHIVE}"
+
+
+async def discard_export_upload(id: str):
+    """Drop what a failed export uploaded so far, once it won't be retried"""
+    await discard_upload(_upload_name(id), ExportCheckpoints(id))
+
+
+async def export_is_cancelled(id: str) -> bool:
+    async with get_sessionmanager().session() as session:
+        status = await ExportsQueries(session=session).get_status(id)
+    return status == ExportStatus.CANCELLED
+
+
+async def _open_base(
+    exports_queries: ExportsQueries, base_export_id: UUID4
+) -> BaseArchive:
+    completed = await exports_queries.get_completed_archive(base_export_id)
+    if completed is None:
+        raise ExportError(f"Base export {base_export_id} is not available")
+    return await BaseArchive.open(*completed)
+
+
+async def run_export(id: str, listener_service: ListenerService):
+    """
+    Build the archive of a scheduled export and mark it completed. Failures
+    are raised, whether to retry or fail the export is up to the caller; a
+    retry resumes from the last checkpoint of the archive.
+    """
+    async with get_sessionmanager().session() as session:
+        exports_queries = ExportsQueries(session=session)
+        job = await exports_queries.get_job(id)
+        if job is None:
+            print(f"Export {id} was deleted before it ran")
+            return
+        if job.status == ExportStatus.CANCELLED:
+            print(f"Export {id} was cancelled before it ran")
+            # It may have left an upload while waiting for a retry
+            await discard_export_upload(id)
+            return
+        if job.status not in (ExportStatus.PENDING, ExportStatus.IN_PROGRESS):
+            # Enqueued again after it finished, its archive stays as it is
+            print(f"Export {id} has finished already")
+            return
+        if job.config is None:
+            raise ExportError(f"Export {id} has no config to run with")
+        config = FinaliseConfigModel.model_validate(job.config)
+
+        await exports_queries.set_status(id, ExportStatus.IN_PROGRESS)
+        await session.commit()
+        await publish_status(listener_service, id, ExportStatus.IN_PROGRESS)
+
+        base = (
+            await _open_base(exports_queries, job.base_export_id)
+            if job.base_export_id is not None
+            else None
+        )
+        bindings_queries = BindingsQueries(session=session)
+        category_ids = job.categories if config.divide_by_category else None
+        progress = ExportProgress(
+            id,
+            listener_service,
+            await bindings_queries.count_export_rows(
+                category_ids, skip_empty=config.omit_empty
+            ),
+        )
+        await progress.report()
+        rows = bindings_queries.stream_export_rows(
+            category_ids, skip_empty=config.omit_empty
+        )
+        upload_name = _upload_name(id)
+        checkpoints = ExportCheckpoints(id)
+        await upload_archive(
+            upload_name,
+            iter_entries(rows, config),
+            base,
+            checkpoints,
+            on_written=progress.written,
+        )
+        await checkpoints.clear()
+        await progress.report()
+
+        completed = await exports_queries.complete(id, upload_name)
+        await session.commit()
+    if not completed:
+        # Cancelled while the archive was being finished
+        await storage_service.delete_file(upload_name)
+        return
+    await publish_status(listener_service, id, ExportStatus.COMPLETED)
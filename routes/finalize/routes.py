@@ -1,19 +1,18 @@
-import zipfile
+import asyncio
+import os
 from pathlib import Path
-from tempfile import TemporaryFile
-from typing import Annotated, TypedDict
+from typing import Annotated
 from uuid import uuid4
 
-from fastapi import APIRouter, BackgroundTasks, Depends
+from fastapi import APIRouter, Depends, HTTPException
 from fastapi.responses import EventSourceResponse
 from fastapi.sse import ServerSentEvent
-from pydantic import BaseModel
+from pydantic import UUID4, BaseModel
 from sqlalchemy.ext.asyncio import AsyncSession
 from starlette.background import BackgroundTask
 from starlette.responses import StreamingResponse
 
 from database_handle.database import get_db, get_sessionmanager
-from database_handle.models.bindings import BindingModel
 from database_handle.models.exports import ExportModel, ExportStatus
 from database_handle.models.pagination import Paginated
 from database_handle.queries.bindings import BindingsQueries, get_bindings_queries
@@ -24,20 +23,20 @@ from database_handle.queries.exports import (
 )
 from routes.finalize.classes import DirectoryModel, FileModel, FinaliseConfigModel
 from routes.finalize.constants import OUTPUT_ARCHIVE, TranscriptFile, WavsDir
-from routes.finalize.utils import process_line
-from services import minio_service
+from routes.finalize.export import iter_entries, stream_archive
+from routes.finalize.export_jobs import discard_export_upload
+from routes.finalize.utils import export_fingerprint
+from services.export_queue import export_queue
 from services.listener_service import Channels, ListenerService, get_listener_service
-
-
-class CategoryData(TypedDict):
-    id: str | None
-    original_name: str
-    bindings: list[BindingModel]
-
+from services.storage import storage_service
 
 __all__ = ["router"]
 DirectoryModel.model_rebuild()
 
+# Streamed exports each hold a database connection until they're downloaded
+EXPORT_MAX_STREAMS = int(os.getenv("EXPORT_MAX_STREAMS", "4"))
+_streams = asyncio.Semaphore(EXPORT_MAX_STREAMS)
+
 router = APIRouter(
     tags=["Finalise"],
     prefix="/finalise",
@@ -50,65 +49,46 @@ async def generate_preview(
     config: FinaliseConfigModel,
     queries: Annotated[BindingsQueries, Depends(get_bindings_queries)],
 ):
-    bindings = await queries.get_all(skip_empty=config.omit_empty)
-    category_mapping: dict[str, CategoryData] = {}
-
-    for binding in bindings:
-        category_id = str(binding.category.id) if binding.category else None
-        if category_id is None:
-            if category_mapping.get(config.uncategorized_name) is None:
-                category_mapping[config.uncategorized_name] = CategoryData(
-                    id=None,
-                    original_name=config.uncategorized_name,
-                    bindings=[binding],
-                )
-            else:
-                category_mapping[config.uncategorized_name]["bindings"].append(binding)
-            continue
-        category_name = (
-            binding.category.name if binding.category else config.uncategorized_name
-        )
-
-        if category_mapping.get(category_id) is None:
-            category_mapping[category_id] = CategoryData(
-                id=category_id,
-                original_name=category_name,
-                bindings=[],
-            )
-
-        category_mapping[category_id]["bindings"].append(binding)
-
     files: list[FileModel | DirectoryModel] = []
-
-    if config.divide_by_category:
-        for data in category_mapping.values():
-            processed_name = data["original_name"].replace(" ", "_")
+    main = DirectoryModel(
+        dir_name="main",
+        files=[],
+        is_dir=True,
+        original_name=None,
+        category_id=None,
+    )
+    directory: DirectoryModel | None = None
+    wavs = main
+    category_id = None
+
+    # Rows come ordered by category, each one's directory is built in turn
+    async for row in queries.stream_export_rows(skip_empty=config.omit_empty):
+        if config.divide_by_category and (
+            directory is None or row.category_id != category_id
+        ):
+            category_id = row.category_id
+            category_name = (
+                row.category_name
+                if row.category_name is not None
+                else config.uncategorized_name
+            )
             directory = DirectoryModel(
-                dir_name=processed_name,
+                dir_name=category_name.replace(" ", "_"),
                 files=[],
                 is_dir=True,
-                original_name=data["original_name"],
-                category_id=data["id"],
+                original_name=category_name,
+                category_id=str(category_id) if category_id is not None else None,
             )
-            for binding in data["bindings"]:
-                dir = directory.get_or_create_dir(WavsDir.name)
-                dir.append(file=Path(binding.audio.file_name))
+            wavs = directory.get_or_create_dir(WavsDir.name)
             if config.export_transcript:
                 directory.append(file=TranscriptFile)
             files.append(directory)
-    else:
-        directory = DirectoryModel(
-            dir_name="main",
-            files=[],
-            is_dir=True,
-            original_name=None,
-            category_id=None,
-        )
-        for binding in bindings:
-            directory.append(file=Path(binding.audio.file_name))
+        wavs.append(file=Path(row.file_name))
+
+    if not config.divide_by_category:
         if config.export_transcript:
-            directory.append(file=TranscriptFile)
-        files.append(directory)
+            main.append(file=TranscriptFile)
+        files.append(main)
 
     base_dir = DirectoryModel(
         dir_name=WavsDir.name, files=files, is_dir=True, original_name=None
@@ -119,156 +99,208 @@ async def generate_preview(
 
 class ScheduleData(BaseModel):
     categories: list[str | None] | None = None
+    # Completed export to build an incremental export on
+    base_export_id: UUID4 | None = None
 
 
-async def schedule_task(
-    id: str,
-    config: FinaliseConfigModel,
-    categories: list[str | None] | None = None,
-):
-    listener_service = ListenerService()
-
-    if categories is None:
-        categories = []
-    try:
-        async with get_sessionmanager().session() as bg_session:
-            bindings_queries = BindingsQueries(session=bg_session)
-
-            with TemporaryFile("wb+") as temp:
-                with zipfile.ZipFile(
-                    temp, mode="w", compression=zipfile.ZIP_STORED
-                ) as zf:
-                    if config.divide_by_category:
-                        for category in categories:
-                            res = await bindings_queries.get_all(
-                                category_id=category,
-                                skip_empty=config.omit_empty,
-                                include_none=category is None,
-                            )
-                            text_lines = []
-                            category_name = config.uncategorized_name
-                            for binding in res:
-                                file = await minio_service.minio_service.download_file(
-                                    binding.audio.url
-                                )
-                                category_name = (
-                                    binding.category.name
-                                    if binding.category is not None
-                                    else config.uncategorized_name
-                                )
-                                zf.writestr(
-                                    str(
-                                        Path(
-                                            category_name,
-                                            WavsDir.name,
-                                            binding.audio.file_name,
-                                        )
-                                    ),
-                                    file,
-                                )
-                                text_lines.append(
-                                    process_line(
-                                        binding, config, indexed_categories=None
-                                    )
-                                )
-
-                            if config.export_transcript:
-                                zf.writestr(
-                                    str(Path(category_name, TranscriptFile)),
-                                    "\n".join(text_lines),
-                                )
-                    else:
-                        res = await bindings_queries.get_all(
-                            skip_empty=config.omit_empty,
-                            include_none=False,
-                        )
-
-                        text_lines = []
-                        indexed_categories = list[str]()
-                        for binding in res:
-                            file = await minio_service.minio_service.download_file(
-                                binding.audio.url
-                            )
-                            category_name = (
-                                binding.category.name
-                                if binding.category is not None
-                                else config.uncategorized_name
-                            )
-                            if category_name not in indexed_categories:
-                                indexed_categories.append(category_name)
-
-                            zf.writestr(binding.audio.file_name, file)
-                            text_lines.append(
-                                process_line(
-                                    binding,
-                                    config,
-                                    indexed_categories={
-                                        k: v for v, k in enumerate(indexed_categories)
-                                    },
-                                )
-                            )
-
-                        if config.export_transcript:
-                            zf.writestr(TranscriptFile.name, "\n".join(text_lines))
-
-                size = temp.tell()
-                temp.seek(0)
-                upload_name = f"{id}_{OUTPUT_ARCHIVE}"
-                await minio_service.minio_service.upload_file(
-                    temp, upload_name, size, content_type="application/zip"
-                )
-
-            exports_queries = ExportsQueries(session=bg_session)
-            await exports_queries.set_status(id, ExportStatus.IN_PROGRESS)
-            await listener_service.publish(
-                Channels.EXPORTS.value,
-                ExportStatusMessage(
-                    id=id, status=ExportStatus.IN_PROGRESS.value
-                ).to_json(),
-            )
-            await exports_queries.set_archive_url(id, upload_name)
-            await exports_queries.set_status(id, ExportStatus.COMPLETED)
-            await bg_session.commit()
-            await listener_service.publish(
-                Channels.EXPORTS.value,
-                ExportStatusMessage(
-                    id=id, status=ExportStatus.COMPLETED.value
-                ).to_json(),
-            )
-    except Exception:
-        async with get_sessionmanager().session() as bg_session:
-            exports_queries = ExportsQueries(session=bg_session)
-            await exports_queries.set_status(id, ExportStatus.FAILED)
-            await bg_session.commit()
-    await listener_service.publish(
-        Channels.EXPORTS.value,
-        ExportStatusMessage(id=id, status=ExportStatus.FAILED.value).to_json(),
-    )
+class ScheduledExport(BaseModel):
+    id: str
+    status: ExportStatus
+    archive_url: str | None = None
+    # An identical export was already completed or on its way
+    deduplicated: bool = False
 
 
-@router.post("/schedule", response_model=None)
+@router.post("/schedule", response_model=ScheduledExport)
 async def schedule_finalise(
-    backgroundTasks: BackgroundTasks,
     config: FinaliseConfigModel,
     listener_service: Annotated[ListenerService, Depends(get_listener_service)],
     db: Annotated[AsyncSession, Depends(get_db)],
     params: ScheduleData | None = None,
 ):
+    """
+    Queue building the export archive, an export worker picks it up. With
+    `base_export_id` the export is incremental: members of that completed
+    export's archive whose audio hasn't changed since are copied from it
+    instead of fetched again, and transcripts are regenerated.
+
+    Exports with the same config and categories over unchanged data aren't
+    built twice: an identical completed or scheduled export is returned.
+    """
     categories = params.categories if params is not None else None
+    base_export_id = params.base_export_id if params is not None else None
 
     id = str(uuid4())
 
     async with db.begin() as session:
         queries = ExportsQueries(session=session.session)
-        await queries.schedule(id, categories)
+        if (
+            base_export_id is not None
+            and await queries.get_completed_archive(base_export_id) is None
+        ):
+            raise HTTPException(
+                status_code=404, detail="Base export not found or not completed"
+            )
 
-    backgroundTasks.add_task(
-        schedule_task, id=id, categories=categories or [], config=config
-    )
+        fingerprint = export_fingerprint(
+            config, categories, await queries.get_data_version()
+        )
+        existing = await queries.find_by_fingerprint(fingerprint)
+        if existing is not None:
+            return ScheduledExport(
+                id=str(existing.id),
+                status=existing.status,
+                archive_url=existing.archive_url,
+                deduplicated=True,
+            )
+        # Identical requests racing this one attach to it
+        try:
+            owner = await export_queue.single_flight(fingerprint, id)
+        except Exception as e:
+            print(f"Error deduplicating export {id}: {e}")
+            owner = id
+        if owner != id:
+            # No row yet while the owner's transaction is still open
+            scheduled = await queries.get(owner)
+            if scheduled is None:
+                return ScheduledExport(
+                    id=owner, status=ExportStatus.PENDING, deduplicated=True
+                )
+            if scheduled.status not in (ExportStatus.FAILED, ExportStatus.CANCELLED):
+                return ScheduledExport(
+                    id=owner,
+                    status=scheduled.status,
+                    archive_url=scheduled.archive_url,
+                    deduplicated=True,
+                )
+
+        await queries.schedule(
+            id,
+            categories,
+            config.model_dump(mode="json"),
+            base_export_id=base_export_id,
+            fingerprint=fingerprint,
+        )
+    if owner == id:
+        try:
+            await export_queue.release_fingerprint(fingerprint, id)
+        except Exception as e:
+            print(f"Error releasing fingerprint of export {id}: {e}")
+
+    # If this fails the export is still picked up by the orphan recovery
+    try:
+        await export_queue.enqueue(id)
+    except Exception as e:
+        print(f"Error queueing export {id}: {e}")
     await listener_service.publish(
         Channels.EXPORTS.value,
         ExportStatusMessage(id=id, status=ExportStatus.PENDING.value).to_json(),
     )
+    return ScheduledExport(id=id, status=ExportStatus.PENDING)
+
+
+@router.post("/cancel/{export_id}", response_model=None)
+async def cancel_finalise(
+    export_id: str,
+    listener_service: Annotated[ListenerService, Depends(get_listener_service)],
+    db: Annotated[AsyncSession, Depends(get_db)],
+):
+    """
+    Stop an export that hasn't finished. A queued export never runs, a
+    running one stops fetching and its unfinished upload is discarded.
+    """
+    async with db.begin() as session:
+        queries = ExportsQueries(session=session.session)
+        status = await queries.get_status(export_id)
+        if status is None:
+            raise HTTPException(status_code=404, detail="Export not found")
+        if status not in (ExportStatus.PENDING, ExportStatus.IN_PROGRESS):
+            raise HTTPException(status_code=409, detail="Export already finished")
+        await queries.set_status(export_id, ExportStatus.CANCELLED)
+
+    # Workers also notice the status on their next heartbeat
+    try:
+        await export_queue.cancel(export_id)
+        if not await export_queue.is_leased(export_id):
+            # Nobody runs it, e.g. it waits for a retry with its upload kept
+            await discard_export_upload(export_id)
+    except Exception as e:
+        print(f"Error cancelling export {export_id}: {e}")
+    await listener_service.publish(
+        Channels.EXPORTS.value,
+        ExportStatusMessage(
+            id=export_id, status=ExportStatus.CANCELLED.value
+        ).to_json(),
+    )
+
+
+@router.post(
+    "/stream",
+    response_class=StreamingResponse,
+    responses={
+        200: {
+            "description": "ZIP archive",
+            "content": {
+                "application/zip": {
+                    "schema": {
+                        "type": "string",
+                        "format": "binary",
+                    }
+                }
+            },
+        }
+    },
+)
+async def stream_finalise(
+    config: FinaliseConfigModel,
+    params: ScheduleData | None = None,
+):
+    """
+    Build the export archive while it's being downloaded, for small or
+    ad-hoc exports. Nothing is stored and no export is recorded. Without
+    `categories`, a divided archive holds every category.
+
+    Rows are read through a server-side cursor, so the session and its
+    transaction stay open until the download ends. At most
+    `EXPORT_MAX_STREAMS` run at once, later requests get a 503.
+    """
+    if _streams.locked():
+        raise HTTPException(
+            status_code=503,
+            detail="Too many exports are being streamed, try again later",
+            headers={"Retry-After": "30"},
+        )
+    # Doesn't wait once the check above passed, nothing can take the slot first
+    await _streams.acquire()
+    released = False
+
+    def release():
+        nonlocal released
+        if not released:
+            released = True
+            _streams.release()
+
+    categories = params.categories if params is not None else None
+
+    async def stream():
+        try:
+            async with get_sessionmanager().session() as session:
+                rows = BindingsQueries(session=session).stream_export_rows(
+                    categories if config.divide_by_category else None,
+                    skip_empty=config.omit_empty,
+                )
+                async for chunk in stream_archive(iter_entries(rows, config)):
+                    yield chunk
+        finally:
+            release()
+
+    # The background task frees the slot of a response whose body never started
+    return StreamingResponse(
+        stream(),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{OUTPUT_ARCHIVE}"'},
+        background=BackgroundTask(release),
+    )
 
 
 @router.get("/status", response_model=Paginated[ExportModel])
@@ -301,14 +333,10 @@ async def download_finalized_zip(
     export_id: str,
     queries: Annotated[ExportsQueries, Depends(get_exports_queries)],
 ):
-    service = minio_service.minio_service
+    service = storage_service
     archive_url = await queries.get_archive(export_id)
-    response = service.get_object_stream(archive_url)
-    return StreamingResponse(
-        response,
-        media_type="application/zip",
-        background=BackgroundTask(response.close),
-    )
+    stream = await service.get_object_stream(archive_url)
+    return StreamingResponse(stream, media_type="application/zip")
 
 
 @router.get("/delete-zip/{export_id}")
@@ -316,7 +344,7 @@ async def delete_finalized_zip(
     export_id: str,
     db: Annotated[AsyncSession, Depends(get_db)],
 ):
-    service = minio_service.minio_service
+    service = storage_service
     async with db.begin() as session:
         queries = ExportsQueries(session=session.session)
         archive_url = await queries.get_archive(export_id)
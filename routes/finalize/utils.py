@@ -1,7 +1,9 @@
 from __future__ import annotations
 
 import asyncio
+import hashlib
 import io
+import json
 import zipfile
 from os import cpu_count
 from pathlib import Path
@@ -22,7 +24,31 @@ from routes.finalize.constants import (
     TranscriptFile,
     WavsDir,
 )
-from services import minio_service
+from services.storage import storage_service
+
+
+def export_fingerprint(
+    config: FinaliseConfigModel,
+    categories: list[str | None] | None,
+    data_version: str,
+) -> str:
+    """
+    Hash of what an export archive is built from: the config, the
+    categories a divided archive holds and the version of the data
+    """
+    selected = None
+    if config.divide_by_category:
+        selected = sorted(
+            {
+                str(category).lower() if category is not None else None
+                for category in categories or []
+            },
+            key=lambda category: (category is None, category or ""),
+        )
+    payload = json.dumps(
+        [config.model_dump(mode="json"), selected, data_version], sort_keys=True
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
 
 
 def process_category(category: str, config: FinaliseConfigModel):
@@ -32,40 +58,46 @@ def process_category(category: str, config: FinaliseConfigModel):
     return res
 
 
-def process_line(
-    binding: BindingModel,
+def format_line(
     config: FinaliseConfigModel,
-    indexed_categories: dict[str, int] | None = None,
+    file_name: str,
+    text: str,
+    duration: float | None,
+    category_name: str,
+    category_index: int | None = 0,
 ):
-    category_index = (
-        indexed_categories.get(
-            binding.category.name
-            if binding.category is not None
-            else config.uncategorized_name
-        )
-        if indexed_categories
-        else 0
-    )
     base_path = WavsDir if config.divide_by_category else Path()
     formatted_line = config.line_format.format(
-        file=Path(base_path, binding.audio.file_name),
-        text=(
-            binding.text.text
-            if str(binding.text.text).strip() != ""
-            else EMPTY_TEXT_TAG
-        ),
-        duration=binding.audio.audio_length,
-        category=process_category(
-            str(
-                binding.category.name if binding.category else config.uncategorized_name
-            ),
-            config,
-        ),
+        file=Path(base_path, file_name),
+        text=text if str(text).strip() != "" else EMPTY_TEXT_TAG,
+        duration=duration,
+        category=process_category(category_name, config),
         category_index=category_index,
     )
     return f"{formatted_line}\n"
 
 
+def process_line(
+    binding: BindingModel,
+    config: FinaliseConfigModel,
+    indexed_categories: dict[str, int] | None = None,
+):
+    category_name = str(
+        binding.category.name
+        if binding.category is not None
+        else config.uncategorized_name
+    )
+    category_index = indexed_categories.get(category_name) if indexed_categories else 0
+    return format_line(
+        config,
+        binding.audio.file_name,
+        binding.text.text,
+        binding.audio.audio_length,
+        category_name,
+        category_index,
+    )
+
+
 def process_transcript(
     bindings: list[BindingModel],
     config: FinaliseConfigModel,
@@ -140,7 +172,7 @@ def get_paths(bindings: list[BindingModel], config: FinaliseConfigModel):
 
 async def perform_copy(bindings: list[BindingModel], config: FinaliseConfigModel):
     """Copy all audio files to their destination paths with concurrency control."""
-    service = minio_service.minio_service
+    service = storage_service
     sem = asyncio.Semaphore((cpu_count() or 6) * 5)
 
     async def limited_copy(url, subdir):
@@ -157,10 +189,10 @@ async def create_zip():
     Downloads all finalized files from the temp directory as a zip file.
     """
 
-    service = minio_service.minio_service
+    service = storage_service
 
     # List all files in the temp directory
-    files = list(service.list_files(str(OUTPUT_DIR)))
+    files = await service.list_files(str(OUTPUT_DIR))
 
     # Check if there are any files to download
     if not files or len(files) == 0:
@@ -189,7 +221,7 @@ async def create_zip():
     size = zip_buffer.getbuffer().nbytes
     zip_buffer.seek(0)
 
-    await minio_service.minio_service.upload_file(zip_buffer, OUTPUT_ARCHIVE, size)
+    await storage_service.upload_file(zip_buffer, OUTPUT_ARCHIVE, size)
 
 
 async def process_and_create_zip(
@@ -197,7 +229,7 @@ async def process_and_create_zip(
     config: FinaliseConfigModel,
     indexed_categories: dict[str, int],
 ):
-    service = minio_service.minio_service
+    service = storage_service
 
     # Step 1: Perform file copying
     await perform_copy(bindings, config)
@@ -207,7 +239,7 @@ async def process_and_create_zip(
     for i in transcript_data:
         lines = "".join(i["lines"])
         path = i["path"]
-        service.append_to_text(str(path), lines)
+        await service.append_to_text(str(path), lines)
 
     # Step 3: Create zip archive
     await create_zip()
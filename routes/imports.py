@@ -0,0 +1,301 @@
+import re
+from dataclasses import dataclass
+from itertools import pairwise
+from pathlib import PurePosixPath
+from typing import Annotated, BinaryIO
+from uuid import uuid4
+
+from fastapi import (
+    APIRouter,
+    BackgroundTasks,
+    Depends,
+    File,
+    Form,
+    HTTPException,
+    UploadFile,
+)
+from fastapi.responses import EventSourceResponse
+from fastapi.sse import ServerSentEvent
+from pydantic import UUID4, BaseModel
+
+from database_handle.database import get_sessionmanager
+from database_handle.queries.bindings import BindingsQueries
+from database_handle.queries.categories import CategoriesQueries
+from database_handle.queries.texts import TextsQueries
+from routes.finalize.classes import FinaliseConfigModel
+from routes.finalize.constants import EMPTY_TEXT_TAG, TranscriptFile, WavsDir
+from services.ingest_service import (
+    IngestFile,
+    IngestService,
+    IngestStatus,
+    audio_content_type,
+    iter_archive_members,
+    iter_batches,
+)
+from services.listener_service import Channels, ListenerService, get_listener_service
+
+__all__ = ["router"]
+
+router = APIRouter(
+    tags=["Import"],
+    prefix="/import",
+    responses={404: {"description": "Not found"}},
+)
+
+# Transcript names recognised in an archive, ours and LJSpeech's
+TRANSCRIPT_NAMES = {TranscriptFile.name, "metadata.csv"}
+
+FORMAT_PATTERNS = {
+    "category_index": r"\d+",
+    "duration": r"[\d.]+",
+}
+# Keys whose values are free text, at least one character except `text`
+TEXT_KEYS = {"file": "+", "text": "*", "category": "+"}
+
+
+class ImportStatusMessage(BaseModel):
+    id: str
+    status: str
+    created: int = 0
+    exists: int = 0
+    failed: int = 0
+
+    def to_json(self) -> str:
+        return self.model_dump_json()
+
+
+class ImportResponseModel(BaseModel):
+    id: str
+
+
+@dataclass
+class TranscriptLine:
+    text: str
+    category: str | None
+
+
+def _alternatives(separators: set[str]) -> str:
+    return f"(?:{'|'.join(re.escape(separator) for separator in separators)})"
+
+
+def _value_pattern(separators: set[str]) -> str:
+    """One character of a value that can't contain the separators"""
+    if not separators:
+        return "."
+    return f"(?:(?!{_alternatives(separators)}).)"
+
+
+def compile_line_format(line_format: str) -> re.Pattern[str]:
+    """
+    Turn `FinaliseConfigModel.line_format` into a pattern parsing its lines.
+
+    Values never span the separators between keys, except for spaces in
+    `text`, and columns after the last key are ignored. LJSpeech's
+    `id|raw|normalized` lines read the raw text:
+
+    >>> match = compile_line_format("{file}|{text}").match("LJ001|Raw|Normal")
+    >>> match["file"], match["text"]
+    ('LJ001', 'Raw')
+    """
+    keys = list(re.finditer(r"\{(.*?)\}", line_format))
+    separators = {
+        line_format[previous.end() : key.start()] for previous, key in pairwise(keys)
+    } - {""}
+    # Separators that are more than whitespace, which text is full of
+    columns = {separator for separator in separators if separator.strip()}
+    values = {
+        key: _value_pattern(columns if key == "text" else separators)
+        for key in TEXT_KEYS
+    }
+
+    pattern = ""
+    position = 0
+    for match in keys:
+        key = match.group(1)
+        pattern += re.escape(line_format[position : match.start()])
+        if key in TEXT_KEYS:
+            pattern += f"(?P<{key}>{values[key]}{TEXT_KEYS[key]})"
+        else:
+            pattern += FORMAT_PATTERNS[key]
+        position = match.end()
+    pattern += re.escape(line_format[position:])
+    if columns and position == len(line_format):
+        pattern += f"(?:{_alternatives(columns)}.*)?"
+    return re.compile(f"^{pattern}$")
+
+
+def dataset_root(path: PurePosixPath) -> str:
+    """Directory a transcript and its audio share, `wavs` dirs excluded"""
+    parts = path.parent.parts
+    if parts and parts[-1] == WavsDir.name and path.name not in TRANSCRIPT_NAMES:
+        parts = parts[:-1]
+    return "/".join(parts)
+
+
+def parse_transcript(
+    data: BinaryIO, root: str, pattern: re.Pattern[str]
+) -> dict[tuple[str, str], TranscriptLine]:
+    lines: dict[tuple[str, str], TranscriptLine] = {}
+    for raw in data.read().decode("utf-8-sig").splitlines():
+        match = pattern.match(raw.rstrip("\r"))
+        if match is None:
+            continue
+        fields = match.groupdict()
+        text = fields["text"] if fields.get("text") is not None else ""
+        lines[(root, PurePosixPath(fields["file"]).stem)] = TranscriptLine(
+            text="" if text == EMPTY_TEXT_TAG else text,
+            category=fields.get("category"),
+        )
+    return lines
+
+
+async def import_task(
+    id: str,
+    archive: BinaryIO,
+    line_format: str,
+    divide_by_category: bool,
+    category: str | None,
+):
+    """
+    Import an archive laid out like our exports: audio under `wavs`, one
+    transcript per dataset root. Entries are processed as they are read, so
+    only a batch of spooled members is held at once.
+    """
+    listener_service = ListenerService()
+    message = ImportStatusMessage(id=id, status="in_progress")
+    pattern = compile_line_format(line_format)
+
+    # Transcript lines waiting for their audio and vice versa, keyed by
+    # (dataset root, file stem)
+    transcript: dict[tuple[str, str], TranscriptLine] = {}
+    unmatched: dict[tuple[str, str], UUID4] = {}
+
+    try:
+        async with get_sessionmanager().session() as session:
+            service = IngestService(session=session)
+            async for batch in iter_batches(iter_archive_members(archive)):
+                files: list[IngestFile] = []
+                keys: list[tuple[str, str] | None] = []
+                for name, data in batch:
+                    path = PurePosixPath(name)
+                    root = dataset_root(path)
+                    if path.name in TRANSCRIPT_NAMES:
+                        transcript.update(parse_transcript(data, root, pattern))
+                        data.close()
+                        continue
+                    content_type = audio_content_type(name)
+                    if content_type is None:
+                        data.close()
+                        continue
+
+                    key = (root, path.stem)
+                    line = transcript.pop(key, None)
+                    dir_category = (
+                        PurePosixPath(root).name
+                        if divide_by_category and root
+                        else None
+                    )
+                    files.append(
+                        IngestFile(
+                            file_name=path.name,
+                            data=data,
+                            content_type=content_type,
+                            category=(line.category if line else None)
+                            or dir_category
+                            or category,
+                            text=line.text if line else "",
+                        )
+                    )
+                    keys.append(key if line is None else None)
+
+                try:
+                    results = await service.ingest(files)
+                finally:
+                    for file in files:
+                        file.data.close()
+
+                for key, result in zip(keys, results):
+                    if result.status == IngestStatus.CREATED:
+                        message.created += 1
+                        if key is not None and result.binding_id is not None:
+                            unmatched[key] = result.binding_id
+                    elif result.status == IngestStatus.FAILED:
+                        message.failed += 1
+                    else:
+                        message.exists += 1
+                await listener_service.publish(
+                    Channels.IMPORTS.value, message.to_json()
+                )
+
+            # Transcripts that came after their audio in the archive
+            matched = {
+                key: (unmatched[key], line)
+                for key, line in transcript.items()
+                if key in unmatched
+            }
+            async with session.begin():
+                category_ids = await CategoriesQueries(
+                    session=session
+                ).get_or_create_many(
+                    {line.category for _, line in matched.values() if line.category}
+                )
+                await TextsQueries(session=session).update_many(
+                    [
+                        {"id": binding_id, "text": line.text}
+                        for binding_id, line in matched.values()
+                    ]
+                )
+                await BindingsQueries(session=session).update_many(
+                    [
+                        {"id": binding_id, "category_id": category_ids[line.category]}
+                        for binding_id, line in matched.values()
+                        if line.category
+                    ]
+                )
+        message.status = "completed"
+    except Exception as e:
+        print(f"Import {id} failed: {e}")
+        message.status = "failed"
+    await listener_service.publish(Channels.IMPORTS.value, message.to_json())
+
+
+@router.post("", response_model=ImportResponseModel)
+async def import_archive(
+    backgroundTasks: BackgroundTasks,
+    archive: Annotated[UploadFile, File()],
+    line_format: Annotated[str, Form()] = "{file}|{text}",
+    divide_by_category: Annotated[bool, Form()] = True,
+    category: Annotated[str | None, Form()] = None,
+):
+    """
+    Import a ZIP or tar archive of wavs and transcripts, e.g. a previous
+    export or an LJSpeech-style dataset. Progress is published on the
+    `imports` channel.
+    """
+    try:
+        FinaliseConfigModel.validate_line_format(line_format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    id = str(uuid4())
+    backgroundTasks.add_task(
+        import_task,
+        id=id,
+        archive=archive.file,
+        line_format=line_format,
+        divide_by_category=divide_by_category,
+        category=category,
+    )
+    return ImportResponseModel(id=id)
+
+
+@router.get("/stream", response_class=EventSourceResponse)
+async def stream_imports(
+    listener_service: Annotated[ListenerService, Depends(get_listener_service)],
+):
+    async with listener_service.subscribe(Channels.IMPORTS.value):
+        async for message in listener_service.listen():
+            if message["type"] == "message":
+                yield ServerSentEvent(
+                    data=message["data"],
+                    event="item_update",
+                )
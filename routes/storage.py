@@ -0,0 +1,81 @@
+from tempfile import SpooledTemporaryFile
+
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Request
+from fastapi.responses import FileResponse
+
+from services.local_storage_service import LocalStorageService
+from services.storage import storage_service
+from services.storage_gc import GCReport, collect_garbage, is_collecting
+from services.storage_service import AUDIO_FOLDER
+from services.upload_listener import process_uploaded_object
+
+__all__ = ["router"]
+
+router = APIRouter(
+    tags=["Storage"],
+    prefix="/storage",
+    responses={404: {"description": "Not found"}},
+)
+
+# Uploads bigger than this are spooled to disk before being stored
+SPOOL_MAX_SIZE = 1024 * 1024
+
+
+@router.post("/gc", response_model=GCReport)
+async def run_garbage_collection():
+    """
+    Remove audios never uploaded, failed exports and bucket objects no row
+    refers to. Also runs periodically when `STORAGE_GC_INTERVAL` is set.
+    """
+    report = None if is_collecting() else await collect_garbage()
+    if report is None:
+        raise HTTPException(
+            status_code=409, detail="Garbage collection is already running"
+        )
+    return report
+
+
+def signed_local_storage(
+    method: str, object_name: str, expires: int, signature: str
+) -> LocalStorageService:
+    """The local backend, once the presigned URL's signature checks out"""
+    if not isinstance(storage_service, LocalStorageService):
+        raise HTTPException(status_code=404, detail="Not found")
+    if not storage_service.verify(method, object_name, expires, signature):
+        raise HTTPException(status_code=403, detail="Invalid or expired signature")
+    return storage_service
+
+
+@router.get("/files/{object_name:path}")
+async def get_file(object_name: str, expires: int, signature: str):
+    """Presigned downloads of the local storage backend"""
+    storage = signed_local_storage("GET", object_name, expires, signature)
+    path = await storage.local_path(object_name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    stat = await storage.stat_file(object_name)
+    return FileResponse(
+        path, media_type=stat.content_type, headers={"ETag": f'"{stat.etag}"'}
+    )
+
+
+@router.put("/files/{object_name:path}")
+async def put_file(
+    request: Request,
+    backgroundTasks: BackgroundTasks,
+    object_name: str,
+    expires: int,
+    signature: str,
+):
+    """
+    Presigned uploads of the local storage backend. There are no bucket
+    notifications, so uploaded audio is finished here.
+    """
+    storage = signed_local_storage("PUT", object_name, expires, signature)
+    with SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as spooled:
+        async for chunk in request.stream():
+            spooled.write(chunk)
+        spooled.seek(0)
+        await storage.upload_stream(spooled, object_name)
+    if object_name.startswith(f"{AUDIO_FOLDER}/"):
+        backgroundTasks.add_task(process_uploaded_object, object_name)
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import os
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from io import BytesIO
+from tempfile import TemporaryDirectory
+from typing import Any
+
+from database_handle.database import get_sessionmanager
+from database_handle.queries.audios import AudioQueries
+from services.audio_processing import compute_peaks, run_in_process, transcode_preview
+from services.storage import storage_service
+
+__all__ = [
+    "generate_peaks",
+    "on_audio_available",
+    "peaks_object_name",
+    "preview_object_name",
+    "source_object_name",
+]
+
+AUDIO_JOBS_CONCURRENCY = int(os.getenv("AUDIO_JOBS_CONCURRENCY", "4"))
+PREVIEW_RENDITIONS = os.getenv("AUDIO_PREVIEW_RENDITIONS", "false").lower() == "true"
+
+_slots = asyncio.Semaphore(AUDIO_JOBS_CONCURRENCY)
+_tasks: set[asyncio.Task] = set()
+
+
+PEAKS_SUFFIX = ".peaks.json"
+PREVIEW_SUFFIX = ".preview.ogg"
+
+
+def peaks_object_name(object_name: str) -> str:
+    """Waveform peaks are stored next to the audio object"""
+    return f"{object_name}{PEAKS_SUFFIX}"
+
+
+def preview_object_name(object_name: str) -> str:
+    """Playback rendition is stored next to the audio object"""
+    return f"{object_name}{PREVIEW_SUFFIX}"
+
+
+def source_object_name(object_name: str) -> str:
+    """Audio object a derived object was generated from, itself otherwise"""
+    for suffix in (PEAKS_SUFFIX, PREVIEW_SUFFIX):
+        if object_name.endswith(suffix):
+            return object_name.removesuffix(suffix)
+    return object_name
+
+
+@asynccontextmanager
+async def _local_copy(object_name: str) -> AsyncIterator[str]:
+    async with _slots:
+        with TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, os.path.basename(object_name))
+            await storage_service.download_to_file(object_name, path)
+            yield path
+
+
+async def _store_peaks(object_name: str, path: str) -> dict[str, Any]:
+    peaks = await run_in_process(compute_peaks, path)
+    data = json.dumps(peaks, separators=(",", ":")).encode()
+    await storage_service.upload_file(
+        BytesIO(data),
+        peaks_object_name(object_name),
+        len(data),
+        content_type="application/json",
+    )
+    return peaks
+
+
+async def _store_preview(object_name: str, path: str):
+    preview_path = f"{path}.preview.ogg"
+    await run_in_process(transcode_preview, path, preview_path)
+    preview = await asyncio.to_thread(open, preview_path, "rb")
+    try:
+        preview_name = await storage_service.upload_stream(
+            preview, preview_object_name(object_name), content_type="audio/ogg"
+        )
+    finally:
+        preview.close()
+
+    async with get_sessionmanager().session() as session, session.begin():
+        await AudioQueries(session=session).set_preview_url(object_name, preview_name)
+
+
+async def generate_peaks(object_name: str) -> dict[str, Any]:
+    async with _local_copy(object_name) as path:
+        return await _store_peaks(object_name, path)
+
+
+async def _run_jobs(object_name: str):
+    try:
+        async with _local_copy(object_name) as path:
+            jobs = [_store_peaks(object_name, path)]
+            if PREVIEW_RENDITIONS:
+                jobs.append(_store_preview(object_name, path))
+            results = await asyncio.gather(*jobs, return_exceptions=True)
+    except Exception as e:
+        results = [e]
+    for result in results:
+        if isinstance(result, Exception):
+            print(f"Error processing audio {object_name}: {result}")
+
+
+def on_audio_available(object_name: str):
+    """Schedule background processing of an audio that just became available"""
+    task = asyncio.create_task(_run_jobs(object_name))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def cancel_jobs():
+    for task in list(_tasks):
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
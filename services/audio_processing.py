@@ -0,0 +1,311 @@
+import asyncio
+import os
+import shutil
+import struct
+from collections.abc import Awaitable, Callable
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from tempfile import TemporaryDirectory
+from typing import Any, BinaryIO
+
+__all__ = [
+    "AudioMetadata",
+    "compute_peaks",
+    "extract_metadata",
+    "read_header_metadata",
+    "run_in_process",
+    "transcode_preview",
+]
+
+AUDIO_PROCESS_WORKERS = int(os.getenv("AUDIO_PROCESS_WORKERS", "2"))
+
+# Number of min/max pairs computed per waveform, one list per resolution
+PEAK_RESOLUTIONS = (256, 1024, 4096)
+
+# Playback previews are mono Opus; higher compression means lower bitrate
+PREVIEW_SAMPLE_RATE = 24000
+PREVIEW_COMPRESSION = float(os.getenv("AUDIO_PREVIEW_COMPRESSION", "0.9"))
+
+# Tail of an Ogg stream scanned for the last page's granule position
+OGG_TAIL_SIZE = 64 * 1024
+# What reading truncated or malformed headers raises
+HEADER_ERRORS = (struct.error, IndexError, OSError, ZeroDivisionError)
+
+_executor: ProcessPoolExecutor | None = None
+_slots = asyncio.Semaphore(AUDIO_PROCESS_WORKERS * 2)
+
+
+@dataclass
+class AudioMetadata:
+    duration: float
+    sample_rate: int
+    channels: int
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=AUDIO_PROCESS_WORKERS)
+    return _executor
+
+
+async def run_in_process[T](fn: Callable[..., T], *args) -> T:
+    """
+    Run CPU heavy audio work in the shared process pool.
+
+    At most `AUDIO_PROCESS_WORKERS` * 2 jobs are queued at once so callers
+    can't pile up unbounded inputs waiting for a worker.
+    """
+    async with _slots:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_get_executor(), fn, *args)
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(cancel_futures=True)
+        _executor = None
+
+
+def _skip_id3(file: BinaryIO) -> bytes:
+    head = file.read(10)
+    if head[:3] != b"ID3" or len(head) < 10:
+        return head
+    size = 0
+    for byte in head[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    file.seek(size, os.SEEK_CUR)
+    return file.read(10)
+
+
+def _read_wav(file: BinaryIO) -> AudioMetadata | None:
+    riff = file.read(12)
+    if len(riff) < 12 or riff[:4] not in (b"RIFF", b"RF64") or riff[8:] != b"WAVE":
+        return None
+
+    channels = sample_rate = block_align = 0
+    ds64_data_size: int | None = None
+    while True:
+        header = file.read(8)
+        if len(header) < 8:
+            return None
+        chunk_id, chunk_size = header[:4], struct.unpack("<I", header[4:])[0]
+        if chunk_id == b"ds64":
+            body = file.read(chunk_size)
+            ds64_data_size = struct.unpack("<Q", body[8:16])[0]
+        elif chunk_id == b"fmt ":
+            body = file.read(chunk_size)
+            _, channels, sample_rate, _, block_align = struct.unpack(
+                "<HHIIH", body[:14]
+            )
+        elif chunk_id == b"data":
+            if not (channels and sample_rate and block_align):
+                return None
+            if ds64_data_size is not None:
+                chunk_size = ds64_data_size
+            elif chunk_size in (0, 0xFFFFFFFF):
+                # Streamed writers leave the size unset, data runs to EOF
+                start = file.tell()
+                chunk_size = file.seek(0, os.SEEK_END) - start
+            frames = chunk_size // block_align
+            return AudioMetadata(
+                duration=frames / sample_rate,
+                sample_rate=sample_rate,
+                channels=channels,
+            )
+        else:
+            file.seek(chunk_size, os.SEEK_CUR)
+        # Chunks are word aligned
+        if chunk_size % 2:
+            file.seek(1, os.SEEK_CUR)
+
+
+def _read_flac(file: BinaryIO) -> AudioMetadata | None:
+    head = _skip_id3(file)
+    if head[:4] != b"fLaC":
+        return None
+    file.seek(-6, os.SEEK_CUR)
+
+    block_header = file.read(4)
+    if len(block_header) < 4 or block_header[0] & 0x7F != 0:
+        # STREAMINFO is required to be the first metadata block
+        return None
+    streaminfo = file.read(34)
+    if len(streaminfo) < 34:
+        return None
+    packed = int.from_bytes(streaminfo[10:18], "big")
+    sample_rate = packed >> 44
+    channels = ((packed >> 41) & 0x07) + 1
+    total_samples = packed & 0xFFFFFFFFF
+    if not sample_rate or not total_samples:
+        return None
+    return AudioMetadata(
+        duration=total_samples / sample_rate,
+        sample_rate=sample_rate,
+        channels=channels,
+    )
+
+
+def _read_ogg(file: BinaryIO) -> AudioMetadata | None:
+    page = file.read(27)
+    if len(page) < 27 or page[:4] != b"OggS":
+        return None
+    serial = page[14:18]
+    segments = file.read(page[26])
+    packet = file.read(sum(segments))
+
+    if packet[:7] == b"\x01vorbis":
+        channels = packet[11]
+        sample_rate = struct.unpack("<I", packet[12:16])[0]
+        granule_rate, pre_skip = sample_rate, 0
+    elif packet[:8] == b"OpusHead":
+        channels = packet[9]
+        pre_skip = struct.unpack("<H", packet[10:12])[0]
+        sample_rate = struct.unpack("<I", packet[12:16])[0] or 48000
+        # Opus granule positions always count 48 kHz samples
+        granule_rate = 48000
+    else:
+        return None
+
+    end = file.seek(0, os.SEEK_END)
+    file.seek(max(0, end - OGG_TAIL_SIZE))
+    tail = file.read()
+    position = len(tail)
+    while (position := tail.rfind(b"OggS", 0, position)) != -1:
+        if tail[position + 14 : position + 18] == serial:
+            granule = struct.unpack("<q", tail[position + 6 : position + 14])[0]
+            if granule > 0:
+                return AudioMetadata(
+                    duration=max(0, granule - pre_skip) / granule_rate,
+                    sample_rate=sample_rate,
+                    channels=channels,
+                )
+    return None
+
+
+def read_header_metadata(file: BinaryIO) -> AudioMetadata | None:
+    """
+    Read duration, sample rate and channel count from WAV/FLAC/OGG headers
+    without decoding any audio. Returns None when the headers don't say.
+    """
+    for reader in (_read_wav, _read_flac, _read_ogg):
+        file.seek(0)
+        try:
+            metadata = reader(file)
+        except HEADER_ERRORS:
+            metadata = None
+        if metadata is not None:
+            file.seek(0)
+            return metadata
+    file.seek(0)
+    return None
+
+
+def decode_metadata(path: str) -> AudioMetadata:
+    """Fully decode the audio to measure it, meant to run in the process pool"""
+    import librosa
+
+    y, sr = librosa.load(path, sr=None, mono=False)
+    channels = 1 if y.ndim == 1 else y.shape[0]
+    return AudioMetadata(
+        duration=librosa.get_duration(y=y, sr=sr),
+        sample_rate=int(sr),
+        channels=channels,
+    )
+
+
+def _copy_to_path(file: BinaryIO, path: str):
+    with open(path, "wb") as target:
+        shutil.copyfileobj(file, target)
+    file.seek(0)
+
+
+async def extract_metadata(
+    file: BinaryIO,
+    run_io: Callable[..., Awaitable[Any]] = asyncio.to_thread,
+) -> AudioMetadata:
+    """
+    Measure audio from its header, decoding it only when that fails.
+    `run_io` runs the blocking reads, pass the storage executor's for objects.
+    """
+    metadata = await run_io(read_header_metadata, file)
+    if metadata is not None:
+        return metadata
+
+    # Decoded from a local copy, large files aren't pickled to the process pool
+    with TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "audio")
+        await run_io(_copy_to_path, file, path)
+        return await run_in_process(decode_metadata, path)
+
+
+def _load_samples(path: str):
+    import numpy as np
+    import soundfile
+
+    try:
+        y, sr = soundfile.read(path, dtype="float32", always_2d=True)
+        return y.T, sr
+    except soundfile.LibsndfileError:
+        import librosa
+
+        y, sr = librosa.load(path, sr=None, mono=False)
+        return np.atleast_2d(y), sr
+
+
+def compute_peaks(path: str, resolutions=PEAK_RESOLUTIONS) -> dict[str, Any]:
+    """
+    Compute min/max waveform peaks of an audio file at a few resolutions,
+    meant to run in the process pool.
+
+    Channels are mixed down and peaks quantised to int8, so a resolution of
+    N costs 2 * N small integers.
+    """
+    import numpy as np
+
+    y, sr = _load_samples(path)
+    samples = y.mean(axis=0)
+    length = samples.shape[0]
+
+    peaks: dict[str, list[int]] = {}
+    for resolution in resolutions:
+        if length == 0:
+            peaks[str(resolution)] = [0] * (2 * resolution)
+            continue
+        bounds = np.linspace(0, length, resolution, endpoint=False).astype(np.intp)
+        pairs = np.empty((resolution, 2), dtype=np.float32)
+        pairs[:, 0] = np.minimum.reduceat(samples, bounds)
+        pairs[:, 1] = np.maximum.reduceat(samples, bounds)
+        quantised = np.clip(np.round(pairs * 127), -128, 127).astype(np.int8)
+        peaks[str(resolution)] = quantised.ravel().tolist()
+
+    return {
+        "sample_rate": int(sr),
+        "channels": int(y.shape[0]),
+        "duration": length / sr if sr else 0.0,
+        "peaks": peaks,
+    }
+
+
+def transcode_preview(source_path: str, target_path: str):
+    """
+    Write a small mono Opus/OGG rendition of an audio file for playback,
+    meant to run in the process pool.
+    """
+    import soundfile
+
+    y, sr = _load_samples(source_path)
+    samples = y.mean(axis=0)
+    if sr != PREVIEW_SAMPLE_RATE:
+        import librosa
+
+        samples = librosa.resample(samples, orig_sr=sr, target_sr=PREVIEW_SAMPLE_RATE)
+    soundfile.write(
+        target_path,
+        samples,
+        PREVIEW_SAMPLE_RATE,
+        format="OGG",
+        subtype="OPUS",
+        compression_level=PREVIEW_COMPRESSION,
+    )
@@ -0,0 +1,382 @@
+import asyncio
+import datetime
+import os
+import socket
+from typing import NamedTuple
+from uuid import uuid4
+
+from redis.asyncio import Redis
+
+from database_handle.database import get_sessionmanager
+from database_handle.models.exports import ExportStatus
+from database_handle.queries.exports import ExportsQueries
+from routes.finalize.export_jobs import (
+    discard_export_upload,
+    export_is_cancelled,
+    run_export,
+    set_export_status,
+)
+from services.listener_service import Channels, ListenerService, create_redis
+
+__all__ = ["ExportQueue", "ExportWorker", "export_queue"]
+
+# Exports one worker process builds at the same time
+EXPORT_WORKER_CONCURRENCY = int(os.getenv("EXPORT_WORKER_CONCURRENCY", "2"))
+# Seconds a claimed export stays leased without a heartbeat, after that it's
+# considered orphaned and handed to another worker
+EXPORT_LEASE_TTL = int(os.getenv("EXPORT_LEASE_TTL", "60"))
+# Runs an export gets, including ones cut short by a crashed worker
+EXPORT_MAX_ATTEMPTS = int(os.getenv("EXPORT_MAX_ATTEMPTS", "3"))
+EXPORT_QUEUE_POLL_INTERVAL = float(os.getenv("EXPORT_QUEUE_POLL_INTERVAL", "1"))
+# Seconds between scans for orphaned exports
+EXPORT_RECOVERY_INTERVAL = int(os.getenv("EXPORT_RECOVERY_INTERVAL", "60"))
+# Unfinished exports untouched for this long and in no queue are requeued
+EXPORT_ORPHAN_AFTER = int(os.getenv("EXPORT_ORPHAN_AFTER", "300"))
+
+QUEUE_KEY = "exports:queue"
+PROCESSING_KEY = "exports:processing"
+LEASE_PREFIX = "exports:lease:"
+ATTEMPTS_KEY = "exports:attempts"
+RECOVERY_LOCK_KEY = "exports:recovery"
+FINGERPRINT_PREFIX = "exports:fingerprint:"
+# Seconds scheduling an export holds its fingerprint, identical requests in
+# the meantime get that export. After that it's found in the database.
+FINGERPRINT_LOCK_TTL = 60
+
+# Moves the oldest export to the processing list and leases it in one step,
+# so no export is ever in processing without a lease
+_CLAIM = """
+local id = redis.call('RPOPLPUSH', KEYS[1], KEYS[2])
+if not id then
+    return nil
+end
+redis.call('SET', KEYS[3] .. id, ARGV[1], 'EX', ARGV[2])
+return {id, redis.call('HINCRBY', KEYS[4], id, 1)}
+"""
+
+_HEARTBEAT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+_RELEASE_FINGERPRINT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Back to the queue, unless the export is still leased by a live worker
+_REQUEUE_ORPHAN = """
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    return 0
+end
+if redis.call('LREM', KEYS[2], 0, ARGV[1]) > 0 then
+    redis.call('LPUSH', KEYS[1], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+
+class Claim(NamedTuple):
+    id: str
+    attempt: int
+
+
+class ExportQueue:
+    """
+    Exports waiting to be built, kept in Redis so they survive restarts of
+    the web app and of the workers. Only export ids are queued, what to
+    build is read from the `exports` row.
+    """
+
+    _redis: Redis
+
+    def __init__(self):
+        self._redis = create_redis()
+        self._claim = self._redis.register_script(_CLAIM)
+        self._heartbeat = self._redis.register_script(_HEARTBEAT)
+        self._requeue_orphan = self._redis.register_script(_REQUEUE_ORPHAN)
+        self._release_fingerprint = self._redis.register_script(_RELEASE_FINGERPRINT)
+
+    async def enqueue(self, id: str):
+        await self._redis.lpush(QUEUE_KEY, id)
+
+    async def claim(self, worker_id: str) -> Claim | None:
+        claimed = await self._claim(
+            keys=[QUEUE_KEY, PROCESSING_KEY, LEASE_PREFIX, ATTEMPTS_KEY],
+            args=[worker_id, EXPORT_LEASE_TTL],
+        )
+        if claimed is None:
+            return None
+        id, attempt = claimed
+        return Claim(id.decode(), int(attempt))
+
+    async def heartbeat(self, id: str, worker_id: str) -> bool:
+        """Extend the lease, False when the export isn't leased to us anymore"""
+        return bool(
+            await self._heartbeat(
+                keys=[f"{LEASE_PREFIX}{id}"], args=[worker_id, EXPORT_LEASE_TTL]
+            )
+        )
+
+    async def complete(self, id: str):
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.lrem(PROCESSING_KEY, 0, id)
+            pipe.delete(f"{LEASE_PREFIX}{id}")
+            pipe.hdel(ATTEMPTS_KEY, id)
+            await pipe.execute()
+
+    async def release(self, id: str, failed: bool = True):
+        """
+        Give a claimed export back to the queue. Its attempt only counts if
+        it `failed`, not when e.g. the worker is shutting down.
+        """
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.lrem(PROCESSING_KEY, 0, id)
+            pipe.delete(f"{LEASE_PREFIX}{id}")
+            if not failed:
+                pipe.hincrby(ATTEMPTS_KEY, id, -1)
+            pipe.lpush(QUEUE_KEY, id)
+            await pipe.execute()
+
+    async def single_flight(self, fingerprint: str, id: str) -> str:
+        """
+        Claim scheduling the export with the fingerprint as `id`, returns the
+        id of the export that claimed it if another one got there first
+        """
+        key = f"{FINGERPRINT_PREFIX}{fingerprint}"
+        if await self._redis.set(key, id, nx=True, ex=FINGERPRINT_LOCK_TTL):
+            return id
+        owner = await self._redis.get(key)
+        return owner.decode() if owner is not None else id
+
+    async def release_fingerprint(self, fingerprint: str, id: str):
+        """
+        Let go of the fingerprint once the export's row is committed, from
+        then on identical requests find it in the database
+        """
+        await self._release_fingerprint(
+            keys=[f"{FINGERPRINT_PREFIX}{fingerprint}"], args=[id]
+        )
+
+    async def is_leased(self, id: str) -> bool:
+        """Whether a worker is running the export"""
+        return bool(await self._redis.exists(f"{LEASE_PREFIX}{id}"))
+
+    async def cancel(self, id: str):
+        """
+        Drop an export from the queue and tell the worker running it, if
+        any, to stop
+        """
+        await self._redis.lrem(QUEUE_KEY, 0, id)
+        await self._redis.publish(Channels.EXPORT_CANCELLATIONS.value, id)
+
+    async def recover(self) -> int:
+        """
+        Requeue exports whose worker died: claimed ones whose lease expired,
+        and unfinished ones the queue lost track of, e.g. scheduled while
+        Redis was down. Returns how many were requeued.
+        """
+        requeued = 0
+        for id in await self._redis.lrange(PROCESSING_KEY, 0, -1):
+            requeued += await self._requeue_orphan(
+                keys=[QUEUE_KEY, PROCESSING_KEY, f"{LEASE_PREFIX}{id.decode()}"],
+                args=[id],
+            )
+
+        before = datetime.datetime.now(datetime.UTC).replace(
+            tzinfo=None
+        ) - datetime.timedelta(seconds=EXPORT_ORPHAN_AFTER)
+        async with get_sessionmanager().session() as session:
+            unfinished = await ExportsQueries(session=session).get_unfinished_before(
+                before
+            )
+        queued = {
+            id.decode()
+            for key in (QUEUE_KEY, PROCESSING_KEY)
+            for id in await self._redis.lrange(key, 0, -1)
+        }
+        for id in unfinished:
+            if str(id) not in queued:
+                await self.enqueue(str(id))
+                requeued += 1
+        return requeued
+
+    async def try_lock_recovery(self) -> bool:
+        """Only one worker scans for orphans per interval"""
+        return bool(
+            await self._redis.set(
+                RECOVERY_LOCK_KEY, 1, nx=True, ex=EXPORT_RECOVERY_INTERVAL
+            )
+        )
+
+
+export_queue = ExportQueue()
+
+
+class ExportWorker:
+    """
+    Builds queued exports, up to `EXPORT_WORKER_CONCURRENCY` at a time.
+    Runs in `export_worker.py`, or inside the web app with
+    `EXPORT_WORKER_IN_APP`.
+    """
+
+    worker_id: str
+    _tasks: list[asyncio.Task]
+    # Set when the export with the id, running here, is cancelled
+    _cancelled: dict[str, asyncio.Event]
+
+    def __init__(self, concurrency: int = EXPORT_WORKER_CONCURRENCY):
+        self.concurrency = concurrency
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self._tasks = []
+        self._cancelled = {}
+
+    async def _watch(self, id: str, cancelled: asyncio.Event) -> bool:
+        """
+        Renew the lease while the export runs. Returns once the export has
+        to stop, True if it was cancelled and False if the lease was lost.
+        """
+        while True:
+            try:
+                await asyncio.wait_for(cancelled.wait(), EXPORT_LEASE_TTL / 3)
+                return True
+            except TimeoutError:
+                pass
+            try:
+                # In case the cancellation message never got here
+                if await export_is_cancelled(id):
+                    return True
+                if not await export_queue.heartbeat(id, self.worker_id):
+                    print(f"Lost the lease on export {id}, stopping it")
+                    return False
+            except Exception as e:
+                print(f"Error renewing lease on export {id}: {e}")
+
+    async def _discard(self, id: str):
+        """Clean up after an export cancelled while it ran"""
+        print(f"Export {id} was cancelled")
+        await discard_export_upload(id)
+        await export_queue.complete(id)
+
+    async def _process(self, claim: Claim):
+        self._cancelled[claim.id] = asyncio.Event()
+        listener_service = ListenerService()
+        try:
+            await self._run(claim, self._cancelled[claim.id], listener_service)
+        finally:
+            del self._cancelled[claim.id]
+            await listener_service.close()
+
+    async def _run(
+        self,
+        claim: Claim,
+        cancelled: asyncio.Event,
+        listener_service: ListenerService,
+    ):
+        if claim.attempt > EXPORT_MAX_ATTEMPTS:
+            print(f"Export {claim.id} ran out of attempts")
+            await discard_export_upload(claim.id)
+            await set_export_status(listener_service, claim.id, ExportStatus.FAILED)
+            await export_queue.complete(claim.id)
+            return
+
+        job = asyncio.create_task(run_export(claim.id, listener_service))
+        watch = asyncio.create_task(self._watch(claim.id, cancelled))
+        try:
+            await asyncio.wait((job, watch), return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            # Worker shutting down, the export goes back to the queue
+            job.cancel()
+            watch.cancel()
+            await asyncio.gather(job, watch, return_exceptions=True)
+            await export_queue.release(claim.id, failed=False)
+            raise
+        watch.cancel()
+        if not job.done():
+            job.cancel()
+            await asyncio.gather(job, return_exceptions=True)
+            if watch.result():
+                await self._discard(claim.id)
+            # Otherwise whoever holds the lease now owns the export
+            return
+
+        error = job.exception()
+        if error is not None:
+            if cancelled.is_set() or await export_is_cancelled(claim.id):
+                await self._discard(claim.id)
+                return
+            print(f"Export {claim.id} failed on attempt {claim.attempt}: {error}")
+            if claim.attempt < EXPORT_MAX_ATTEMPTS:
+                await set_export_status(
+                    listener_service, claim.id, ExportStatus.PENDING
+                )
+                await export_queue.release(claim.id)
+                return
+            await discard_export_upload(claim.id)
+            await set_export_status(listener_service, claim.id, ExportStatus.FAILED)
+        await export_queue.complete(claim.id)
+
+    async def _slot(self):
+        while True:
+            try:
+                claim = await export_queue.claim(self.worker_id)
+            except Exception as e:
+                print(f"Error claiming export: {e}")
+                claim = None
+            if claim is None:
+                await asyncio.sleep(EXPORT_QUEUE_POLL_INTERVAL)
+                continue
+            try:
+                await self._process(claim)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error finishing export {claim.id}: {e}")
+
+    async def _recover(self):
+        while True:
+            try:
+                if await export_queue.try_lock_recovery():
+                    requeued = await export_queue.recover()
+                    if requeued:
+                        print(f"Requeued {requeued} orphaned exports")
+            except Exception as e:
+                print(f"Error recovering exports: {e}")
+            await asyncio.sleep(EXPORT_RECOVERY_INTERVAL)
+
+    async def _listen_cancellations(self):
+        while True:
+            listener_service = ListenerService()
+            try:
+                async with listener_service.subscribe(
+                    Channels.EXPORT_CANCELLATIONS.value
+                ):
+                    async for message in listener_service.listen():
+                        if message["type"] != "message":
+                            continue
+                        cancelled = self._cancelled.get(message["data"].decode())
+                        if cancelled is not None:
+                            cancelled.set()
+            except Exception as e:
+                print(f"Error listening for cancelled exports: {e}")
+            finally:
+                await listener_service.close()
+            await asyncio.sleep(EXPORT_QUEUE_POLL_INTERVAL)
+
+    def start(self):
+        self._tasks = [
+            asyncio.create_task(self._slot()) for _ in range(self.concurrency)
+        ]
+        self._tasks.append(asyncio.create_task(self._recover()))
+        self._tasks.append(asyncio.create_task(self._listen_cancellations()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
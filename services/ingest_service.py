@@ -0,0 +1,323 @@
+import asyncio
+import mimetypes
+import os
+import tarfile
+import zipfile
+from collections.abc import AsyncIterator, Iterable, Iterator
+from contextlib import ExitStack
+from dataclasses import dataclass
+from enum import StrEnum
+from itertools import islice
+from pathlib import PurePosixPath
+from tempfile import SpooledTemporaryFile
+from typing import BinaryIO
+from uuid import uuid4
+
+from pydantic import UUID4, BaseModel
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database_handle.models.audios import StatusEnum
+from database_handle.queries.audios import AudioQueries
+from database_handle.queries.bindings import BindingsQueries
+from database_handle.queries.categories import CategoriesQueries
+from database_handle.queries.texts import TextsQueries
+from services.audio_jobs import on_audio_available
+from services.audio_processing import AudioMetadata, extract_metadata
+from services.storage import storage_service
+from services.storage_service import AUDIO_FOLDER, DEDUPLICATE_AUDIO, StoredContent
+
+__all__ = [
+    "IngestFile",
+    "IngestResult",
+    "IngestService",
+    "audio_content_type",
+    "iter_archive_audio",
+    "iter_archive_members",
+    "iter_batches",
+]
+
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "16"))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "200"))
+
+# Archive members bigger than this are spooled to disk instead of memory
+SPOOL_MAX_SIZE = 1024 * 1024
+
+
+class IngestStatus(StrEnum):
+    CREATED = "created"
+    EXISTS = "exists"
+    DUPLICATE = "duplicate"
+    FAILED = "failed"
+
+
+class IngestResult(BaseModel):
+    file_name: str
+    status: IngestStatus
+    binding_id: UUID4 | None = None
+    detail: str | None = None
+
+
+@dataclass
+class IngestFile:
+    file_name: str
+    data: BinaryIO
+    content_type: str = "application/octet-stream"
+    category: str | None = None
+    text: str = ""
+
+
+def audio_content_type(file_name: str) -> str | None:
+    """Content type guessed from the extension, None when it isn't audio"""
+    content_type, _ = mimetypes.guess_type(file_name)
+    if content_type is None or not content_type.startswith("audio/"):
+        return None
+    return content_type
+
+
+def _spool(source: BinaryIO) -> BinaryIO:
+    with ExitStack() as stack:
+        spooled = stack.enter_context(SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE))
+        while chunk := source.read(SPOOL_MAX_SIZE):
+            spooled.write(chunk)
+        spooled.seek(0)
+        # Owned by the caller once it's filled
+        stack.pop_all()
+        return spooled
+
+
+def iter_archive_members(archive: BinaryIO) -> Iterator[tuple[str, BinaryIO]]:
+    """
+    Yield (path, spooled file) for every regular file of a ZIP or tar archive.
+
+    Tar archives are read as a stream, entry by entry. Each yielded file is
+    owned by the caller and should be closed once consumed.
+    """
+    if zipfile.is_zipfile(archive):
+        archive.seek(0)
+        with zipfile.ZipFile(archive) as zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                with zf.open(info) as member:
+                    yield info.filename, _spool(member)
+        return
+
+    archive.seek(0)
+    with tarfile.open(fileobj=archive, mode="r|*") as tf:
+        for info in tf:
+            if not info.isfile():
+                continue
+            member = tf.extractfile(info)
+            if member is not None:
+                yield info.name, _spool(member)
+
+
+def iter_archive_audio(
+    archive: BinaryIO, category: str | None = None
+) -> Iterator[IngestFile]:
+    for path, data in iter_archive_members(archive):
+        content_type = audio_content_type(path)
+        if content_type is None:
+            data.close()
+            continue
+        yield IngestFile(
+            file_name=PurePosixPath(path).name,
+            data=data,
+            content_type=content_type,
+            category=category,
+        )
+
+
+async def iter_batches[T](
+    items: Iterable[T], size: int = INGEST_BATCH_SIZE
+) -> AsyncIterator[list[T]]:
+    """Pull batches from a blocking iterator without stalling the event loop"""
+    iterator = iter(items)
+    while batch := await asyncio.to_thread(lambda: list(islice(iterator, size))):
+        yield batch
+
+
+@dataclass
+class IngestService:
+    """
+    Creates bindings for a batch of audio files with set-based inserts and
+    uploads their objects concurrently.
+    """
+
+    session: AsyncSession
+
+    async def _upload(
+        self, sem: asyncio.Semaphore, file: IngestFile
+    ) -> tuple[StoredContent, AudioMetadata | Exception]:
+        """
+        Store the file and measure it. A file that can't be measured comes
+        back with the error, its object is already stored.
+        """
+        async with sem:
+            file.data.seek(0)
+            if DEDUPLICATE_AUDIO:
+                stored = await storage_service.upload_content(
+                    file_data=file.data,
+                    filename=file.file_name,
+                    content_type=file.content_type,
+                    folder=AUDIO_FOLDER,
+                )
+            else:
+                object_name = await storage_service.upload_stream(
+                    file_data=file.data,
+                    filename=file.file_name,
+                    content_type=file.content_type,
+                    folder=AUDIO_FOLDER,
+                )
+                stored = StoredContent(object_name, content_hash="", created=True)
+            file.data.seek(0)
+            try:
+                return stored, await extract_metadata(file.data)
+            except Exception as e:
+                return stored, e
+
+    async def _restore(
+        self, sem: asyncio.Semaphore, file: IngestFile, stored: StoredContent
+    ) -> StoredContent:
+        async with sem:
+            return await storage_service.restore_content(
+                file.data, stored, content_type=file.content_type
+            )
+
+    async def ingest(self, files: list[IngestFile]) -> list[IngestResult]:
+        results: dict[str, IngestResult] = {}
+        unique: dict[str, IngestFile] = {}
+        duplicates: set[int] = set()
+        for index, file in enumerate(files):
+            if file.file_name in unique:
+                duplicates.add(index)
+                continue
+            unique[file.file_name] = file
+
+        audios_queries = AudioQueries(session=self.session)
+        categories_queries = CategoriesQueries(session=self.session)
+        texts_queries = TextsQueries(session=self.session)
+        bindings_queries = BindingsQueries(session=self.session)
+
+        async with self.session.begin():
+            existing = await audios_queries.existing_names(list(unique))
+            for name in existing:
+                results[name] = IngestResult(file_name=name, status=IngestStatus.EXISTS)
+                del unique[name]
+
+            category_ids = await categories_queries.get_or_create_many(
+                {file.category for file in unique.values() if file.category}
+            )
+            pending: dict[UUID4, IngestFile] = {
+                uuid4(): file for file in unique.values()
+            }
+            await texts_queries.create_many(
+                [{"id": id, "text": file.text} for id, file in pending.items()]
+            )
+            await audios_queries.create_many(
+                [
+                    {
+                        "id": id,
+                        "file_name": file.file_name,
+                        # Content-addressed key is only known once uploaded
+                        "url": None
+                        if DEDUPLICATE_AUDIO
+                        else f"{AUDIO_FOLDER}/{file.file_name}",
+                        "audio_status": StatusEnum.waiting,
+                    }
+                    for id, file in pending.items()
+                ]
+            )
+            await bindings_queries.create_many(
+                [
+                    {
+                        "id": id,
+                        "category_id": category_ids.get(file.category)
+                        if file.category
+                        else None,
+                        "audio_id": id,
+                        "text_id": id,
+                    }
+                    for id, file in pending.items()
+                ]
+            )
+
+        sem = asyncio.Semaphore(INGEST_CONCURRENCY)
+        ids = list(pending)
+        uploads = await asyncio.gather(
+            *(self._upload(sem, pending[id]) for id in ids),
+            return_exceptions=True,
+        )
+
+        available: list[dict] = []
+        created: list[str] = []
+        reused: dict[str, tuple[IngestFile, StoredContent]] = {}
+        failed: list[UUID4] = []
+        # Objects stored for files that failed afterwards
+        orphaned: list[str] = []
+        for id, upload in zip(ids, uploads):
+            file_name = pending[id].file_name
+            if isinstance(upload, BaseException):
+                error = upload
+            else:
+                stored, metadata = upload
+                error = metadata if isinstance(metadata, Exception) else None
+                if error is not None and stored.created:
+                    orphaned.append(stored.object_name)
+            if error is not None:
+                failed.append(id)
+                results[file_name] = IngestResult(
+                    file_name=file_name,
+                    status=IngestStatus.FAILED,
+                    detail=str(getattr(error, "detail", error)),
+                )
+                continue
+            assert isinstance(metadata, AudioMetadata)
+            available.append(
+                {
+                    "id": id,
+                    "url": stored.object_name,
+                    "content_hash": stored.content_hash or None,
+                    "audio_status": StatusEnum.available,
+                    "audio_length": metadata.duration,
+                }
+            )
+            if stored.created:
+                created.append(stored.object_name)
+            else:
+                reused[stored.object_name] = (pending[id], stored)
+            results[file_name] = IngestResult(
+                file_name=file_name, status=IngestStatus.CREATED, binding_id=id
+            )
+
+        async with self.session.begin():
+            # Shared objects may have been deleted since they were found
+            await audios_queries.lock_objects([*reused, *orphaned])
+            restored = await asyncio.gather(
+                *(self._restore(sem, file, stored) for file, stored in reused.values())
+            )
+            created.extend(stored.object_name for stored in restored if stored.created)
+            await audios_queries.update_many(available)
+            await audios_queries.copy_preview_urls(
+                list({entry["url"] for entry in available} - set(created))
+            )
+            await bindings_queries.remove_many(failed)
+            await audios_queries.remove_many(failed)
+            await texts_queries.remove_many(failed)
+
+            # Unless identical files of this or another batch share them now
+            shared = await audios_queries.referenced_urls(orphaned)
+            await storage_service.delete_files(
+                [name for name in orphaned if name not in shared]
+            )
+
+        # Objects shared with earlier audios were processed already
+        for object_name in dict.fromkeys(created):
+            on_audio_available(object_name)
+
+        return [
+            IngestResult(file_name=file.file_name, status=IngestStatus.DUPLICATE)
+            if index in duplicates
+            else results[file.file_name]
+            for index, file in enumerate(files)
+        ]
@@ -10,6 +10,17 @@ from redis.typing import EncodableT
 
 class Channels(StrEnum):
     EXPORTS = "exports"
+    # Ids of exports cancelled while queued or running
+    EXPORT_CANCELLATIONS = "export_cancellations"
+    IMPORTS = "imports"
+
+
+def create_redis() -> Redis:
+    """Client for the Redis instance shared by pub/sub and the job queues"""
+    return Redis(
+        host=os.getenv("REDIS_HOST", "redis"),
+        port=int(os.getenv("REDIS_PORT", "6379")),
+    )
 
 
 class ListenerService:
@@ -17,10 +28,7 @@ class ListenerService:
     _pubsub: PubSub
 
     def __init__(self):
-        self._redis = Redis(
-            host=os.getenv("REDIS_HOST", "redis"),
-            port=int(os.getenv("REDIS_PORT", "6379")),
-        )
+        self._redis = create_redis()
 
         self._pubsub = self._redis.pubsub()
 
@@ -40,8 +48,8 @@ class ListenerService:
         return await self._redis.publish(channel, message)
 
     async def close(self):
-        self._pubsub.close()
-        await self._redis.close()
+        await self._pubsub.aclose()
+        await self._redis.aclose()
 
 
 async def get_listener_service():
@@ -0,0 +1,381 @@
+from __future__ import annotations
+
+import hashlib
+import hmac
+import io
+import mimetypes
+import os
+import shutil
+import time
+from collections.abc import AsyncIterator, Iterable, Iterator
+from contextlib import ExitStack
+from datetime import UTC, datetime
+from itertools import batched, islice
+from pathlib import Path, PurePosixPath
+from tempfile import NamedTemporaryFile
+from typing import BinaryIO
+from urllib.parse import quote, urlencode
+
+from fastapi import HTTPException
+from minio.datatypes import Object
+
+from services.storage_service import (
+    REMOVE_BATCH_SIZE,
+    STREAM_CHUNK_SIZE,
+    ObjectWriter,
+    StorageService,
+)
+
+__all__ = ["LocalStorageService"]
+
+LOCAL_STORAGE_DIR = os.getenv("LOCAL_STORAGE_DIR", "storage")
+# Base of the signed URLs, i.e. where this app is reachable from clients
+LOCAL_STORAGE_PUBLIC_URL = os.getenv(
+    "LOCAL_STORAGE_PUBLIC_URL", "http://localhost:8000"
+).rstrip("/")
+# Key presigned URLs are signed with. Required, and the same for every
+# worker, otherwise URLs only work on the one that signed them
+LOCAL_STORAGE_SECRET = os.getenv("LOCAL_STORAGE_SECRET", "")
+
+# Prefix of files being written, they're renamed into place once complete
+UPLOAD_PREFIX = ".upload-"
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class LocalStorageService(StorageService):
+    """
+    Keeps objects as plain files under `LOCAL_STORAGE_DIR/<bucket>`, for
+    tests, benchmarks and single-node deployments. Presigned URLs point at
+    `/storage/files`, which serves and accepts them with HMAC signatures.
+    """
+
+    root: Path
+
+    def __init__(self):
+        if not LOCAL_STORAGE_SECRET:
+            raise ValueError("LOCAL_STORAGE_SECRET is not set")
+        super().__init__(thread_name_prefix="storage-io")
+        self.bucket_name = os.getenv("MINIO_BUCKET_NAME", "categorize-files")
+        self.root = Path(LOCAL_STORAGE_DIR, self.bucket_name).absolute()
+
+    async def start(self):
+        await self.run(self.root.mkdir, parents=True, exist_ok=True)
+
+    def _path(self, object_name: str) -> Path:
+        parts = PurePosixPath(object_name).parts
+        if not parts or parts[0] == "/" or ".." in parts:
+            raise HTTPException(status_code=400, detail="Invalid object name")
+        return self.root.joinpath(*parts)
+
+    def _info(self, object_name: str, stat: os.stat_result) -> Object:
+        etag = hashlib.md5(
+            f"{stat.st_mtime_ns}-{stat.st_size}".encode(), usedforsecurity=False
+        ).hexdigest()
+        content_type, _ = mimetypes.guess_type(object_name)
+        return Object(
+            self.bucket_name,
+            object_name,
+            last_modified=datetime.fromtimestamp(stat.st_mtime, UTC),
+            etag=etag,
+            size=stat.st_size,
+            content_type=content_type or "application/octet-stream",
+        )
+
+    def _write(self, file_data: BinaryIO, object_name: str) -> str:
+        path = self._path(object_name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with NamedTemporaryFile(
+            dir=path.parent, prefix=UPLOAD_PREFIX, delete=False
+        ) as temp:
+            try:
+                shutil.copyfileobj(file_data, temp, COPY_BUFFER_SIZE)
+            except BaseException:
+                os.unlink(temp.name)
+                raise
+        os.replace(temp.name, path)
+        return object_name
+
+    def _copy(self, source: Path, destination: Path):
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        with NamedTemporaryFile(
+            dir=destination.parent, prefix=UPLOAD_PREFIX, delete=False
+        ) as temp:
+            pass
+        try:
+            # Uses copy_file_range/sendfile, the bytes never enter Python
+            shutil.copyfile(source, temp.name)
+        except BaseException:
+            os.unlink(temp.name)
+            raise
+        os.replace(temp.name, destination)
+
+    def sign(self, method: str, object_name: str, expires_at: int) -> str:
+        message = f"{method}\n{object_name}\n{expires_at}".encode()
+        return hmac.new(
+            LOCAL_STORAGE_SECRET.encode(), message, hashlib.sha256
+        ).hexdigest()
+
+    def verify(
+        self, method: str, object_name: str, expires_at: int, signature: str
+    ) -> bool:
+        return expires_at >= time.time() and hmac.compare_digest(
+            self.sign(method, object_name, expires_at), signature
+        )
+
+    def _signed_url(self, method: str, object_name: str, expires_at: int) -> str:
+        query = urlencode(
+            {
+                "expires": expires_at,
+                "signature": self.sign(method, object_name, expires_at),
+            }
+        )
+        return f"{LOCAL_STORAGE_PUBLIC_URL}/storage/files/{quote(object_name)}?{query}"
+
+    async def object_exists(self, object_name: str) -> bool:
+        return await self.run(self._path(object_name).is_file)
+
+    async def get_upload_url(self, object_name: str, expires: int = 3600) -> str:
+        return self._signed_url("PUT", object_name, int(time.time()) + expires)
+
+    async def copy_file(self, source_object_name: str, destination_object_name: str):
+        try:
+            await self.run(
+                self._copy,
+                self._path(source_object_name),
+                self._path(destination_object_name),
+            )
+        except OSError as e:
+            print(f"Error copying file: {e}")
+            raise HTTPException(status_code=500, detail="Failed to copy file")
+
+    async def upload_file(
+        self,
+        file_data: BinaryIO,
+        filename: str,
+        size: int,
+        content_type: str = "application/octet-stream",
+        folder: str = "",
+        metadata: dict[str, str] | None = None,
+    ) -> str:
+        return await self.upload_stream(
+            file_data, filename, content_type, folder, metadata
+        )
+
+    async def upload_stream(
+        self,
+        file_data: BinaryIO,
+        filename: str,
+        content_type: str = "application/octet-stream",
+        folder: str = "",
+        metadata: dict[str, str] | None = None,
+    ) -> str:
+        """
+        Write the stream next to its destination and rename it into place.
+        Content type and metadata aren't kept, types are guessed from names.
+        """
+        object_name = f"{folder}/{filename}" if folder else filename
+        try:
+            return await self.run(self._write, file_data, object_name)
+        except OSError as e:
+            print(f"Error uploading file: {e}")
+            raise HTTPException(status_code=500, detail="Failed to upload file")
+
+    def _reopen(self, path: Path, resume: dict) -> BinaryIO:
+        temp_path = path.parent / resume["path"]
+        if not temp_path.name.startswith(UPLOAD_PREFIX):
+            raise ValueError(f"Not an upload in progress: {temp_path}")
+        with ExitStack() as stack:
+            temp = stack.enter_context(open(temp_path, "r+b"))
+            # Anything written after the checkpoint is dropped
+            temp.truncate(resume["size"])
+            temp.seek(resume["size"])
+            # Owned by the writer from here
+            stack.pop_all()
+            return temp
+
+    async def open_writer(
+        self,
+        object_name: str,
+        content_type: str = "application/octet-stream",
+        resume: dict | None = None,
+    ) -> LocalFileWriter:
+        path = self._path(object_name)
+        try:
+            await self.run(path.parent.mkdir, parents=True, exist_ok=True)
+            if resume is not None:
+                temp = await self.run(self._reopen, path, resume)
+            else:
+                temp = await self.run(
+                    NamedTemporaryFile,
+                    dir=path.parent,
+                    prefix=UPLOAD_PREFIX,
+                    delete=False,
+                )
+        except (OSError, ValueError) as e:
+            print(f"Error starting upload: {e}")
+            raise HTTPException(status_code=500, detail="Failed to upload file")
+        return LocalFileWriter(self, temp, path)
+
+    async def download_file(self, object_name: str) -> bytes:
+        try:
+            return await self.run(self._path(object_name).read_bytes)
+        except OSError as e:
+            print(f"Error downloading file: {e}")
+            raise HTTPException(status_code=404, detail="File not found")
+
+    async def open_object(self, object_name: str) -> io.BufferedReader:
+        try:
+            return await self.run(open, self._path(object_name), "rb")
+        except OSError as e:
+            print(f"Error opening file: {e}")
+            raise HTTPException(status_code=404, detail="File not found")
+
+    async def download_to_file(self, object_name: str, file_path: str):
+        try:
+            await self.run(shutil.copyfile, self._path(object_name), file_path)
+        except OSError as e:
+            print(f"Error downloading file: {e}")
+            raise HTTPException(status_code=404, detail="File not found")
+
+    async def stat_file(self, object_name: str) -> Object:
+        path = self._path(object_name)
+        try:
+            return self._info(object_name, await self.run(path.stat))
+        except OSError as e:
+            print(f"Error reading file info: {e}")
+            raise HTTPException(status_code=404, detail="File not found")
+
+    async def get_object_stream(
+        self, object_name: str, offset: int = 0, length: int = 0
+    ) -> AsyncIterator[bytes]:
+        try:
+            file = await self.run(open, self._path(object_name), "rb")
+        except OSError as e:
+            print(f"Error streaming file: {e}")
+            raise HTTPException(status_code=404, detail="File not found")
+        file.seek(offset)
+
+        async def stream():
+            remaining = length or None
+            try:
+                while remaining is None or remaining > 0:
+                    size = STREAM_CHUNK_SIZE
+                    if remaining is not None:
+                        size = min(size, remaining)
+                        remaining -= size
+                    chunk = await self.run(file.read, size)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                file.close()
+
+        return stream()
+
+    async def local_path(self, object_name: str) -> str | None:
+        path = self._path(object_name)
+        return str(path) if await self.run(path.is_file) else None
+
+    def _delete(self, object_names: tuple[str, ...]) -> list[str]:
+        failed: list[str] = []
+        for object_name in object_names:
+            try:
+                self._path(object_name).unlink(missing_ok=True)
+            except OSError as e:
+                print(f"Error deleting file {object_name}: {e}")
+                failed.append(object_name)
+        return failed
+
+    async def delete_files(self, object_names: Iterable[str]) -> list[str]:
+        failed: list[str] = []
+        for batch in batched(object_names, REMOVE_BATCH_SIZE):
+            failed.extend(await self.run(self._delete, batch))
+        return failed
+
+    async def get_file_urls(
+        self, object_names: list[str], expires: int = 3600
+    ) -> dict[str, tuple[str, int]]:
+        expires_at = int(time.time()) + expires
+        return {
+            object_name: (self._signed_url("GET", object_name, expires_at), expires)
+            for object_name in object_names
+        }
+
+    def _walk(self, prefix: str, recursive: bool) -> Iterator[Object]:
+        directory = prefix.rpartition("/")[0]
+        start = self.root / directory if directory else self.root
+        if not start.is_dir():
+            return
+        if recursive:
+            for dirpath, dirnames, filenames in os.walk(start):
+                dirnames.sort()
+                relative = Path(dirpath).relative_to(self.root).as_posix()
+                for filename in sorted(filenames):
+                    object_name = (
+                        filename if relative == "." else f"{relative}/{filename}"
+                    )
+                    if object_name.startswith(prefix) and not filename.startswith(
+                        UPLOAD_PREFIX
+                    ):
+                        yield self._info(
+                            object_name, os.stat(os.path.join(dirpath, filename))
+                        )
+            return
+        for entry in sorted(os.scandir(start), key=lambda entry: entry.name):
+            object_name = f"{directory}/{entry.name}" if directory else entry.name
+            if not object_name.startswith(prefix) or entry.name.startswith(
+                UPLOAD_PREFIX
+            ):
+                continue
+            if entry.is_dir():
+                yield Object(self.bucket_name, f"{object_name}/")
+            else:
+                yield self._info(object_name, entry.stat())
+
+    async def iter_files(
+        self,
+        prefix: str = "",
+        recursive: bool = True,
+        batch_size: int = REMOVE_BATCH_SIZE,
+    ) -> AsyncIterator[list[Object]]:
+        files = self._walk(prefix, recursive)
+        while batch := await self.run(lambda: list(islice(files, batch_size))):
+            yield batch
+
+
+class LocalFileWriter(ObjectWriter):
+    """Writes next to the destination and renames into place on commit"""
+
+    def __init__(self, service: LocalStorageService, temp: BinaryIO, path: Path):
+        self._service = service
+        self._temp = temp
+        self._path = path
+
+    def write(self, data: bytes) -> int:
+        return self._temp.write(data)
+
+    def tell(self) -> int:
+        return self._temp.tell()
+
+    def copy_range(self, object_name: str, offset: int, length: int):
+        with open(self._service._path(object_name), "rb") as source:
+            source.seek(offset)
+            while length > 0:
+                chunk = source.read(min(length, COPY_BUFFER_SIZE))
+                if not chunk:
+                    raise EOFError(f"{object_name} ended before the copied range")
+                self._temp.write(chunk)
+                length -= len(chunk)
+
+    def checkpoint(self) -> dict:
+        self._temp.flush()
+        os.fsync(self._temp.fileno())
+        return {"path": Path(self._temp.name).name, "size": self._temp.tell()}
+
+    def commit(self):
+        self._temp.close()
+        os.replace(self._temp.name, self._path)
+
+    def abort(self):
+        self._temp.close()
+        Path(self._temp.name).unlink(missing_ok=True)
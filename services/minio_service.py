@@ -1,46 +1,119 @@
-import asyncio
+from __future__ import annotations
+
 import io
 import os
+import threading
+import time
+from collections.abc import AsyncIterator, Callable, Iterable
+from concurrent.futures import Future
 from datetime import timedelta
+from functools import cached_property
+from itertools import batched, islice
 from typing import BinaryIO
 
+import certifi
+import urllib3
 from fastapi import HTTPException
 from minio import Minio
 from minio.commonconfig import CopySource
+from minio.datatypes import Object, Part
+from minio.deleteobjects import DeleteObject
 from minio.error import S3Error
 from minio.helpers import DictType
 
-__all__ = ["minio_service"]
+from services.storage_service import (
+    REMOVE_BATCH_SIZE,
+    STORAGE_IO_WORKERS,
+    STREAM_CHUNK_SIZE,
+    URL_CACHE_MARGIN,
+    ObjectWriter,
+    StorageService,
+)
+from services.ttl_cache import TTLCache
+
+__all__ = ["MinIOService"]
+
+# Multipart part size for uploads of unknown length; MinIO requires >= 5 MiB
+UPLOAD_PART_SIZE = int(os.getenv("MINIO_UPLOAD_PART_SIZE", str(10 * 1024 * 1024)))
+UPLOAD_PARALLEL_PARTS = int(os.getenv("MINIO_UPLOAD_PARALLEL_PARTS", "2"))
+# Parts an `open_writer` upload keeps in flight before writes block
+WRITER_PARALLEL_PARTS = int(os.getenv("MINIO_WRITER_PARALLEL_PARTS", "4"))
+# Largest part S3 copies server-side in one request
+MAX_COPY_PART_SIZE = 5 * 1024 * 1024 * 1024
+# Smallest part S3 accepts, except for the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+URL_CACHE_SIZE = int(os.getenv("MINIO_URL_CACHE_SIZE", "50000"))
+
 
+def _create_http_client() -> urllib3.PoolManager:
+    """
+    Connection pool sized for the storage executor: every worker can hold a
+    connection, plus the extra part uploads a multipart put runs in parallel
+    """
+    timeout = timedelta(minutes=5).seconds
+    return urllib3.PoolManager(
+        timeout=urllib3.Timeout(connect=timeout, read=timeout),
+        maxsize=STORAGE_IO_WORKERS * max(1, UPLOAD_PARALLEL_PARTS),
+        cert_reqs="CERT_REQUIRED",
+        ca_certs=os.environ.get("SSL_CERT_FILE") or certifi.where(),
+        retries=urllib3.Retry(
+            total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]
+        ),
+    )
+
+
+class MinIOService(StorageService):
+    """
+    Nothing here touches the network on construction: the client is created
+    on first use and the bucket is checked by `start()` during app startup.
+    """
 
-class MinIOService:
-    bucket_name: str
-    client: Minio
     endpoint: str
+    supports_notifications = True
+    _url_cache: TTLCache[tuple[str, int], str]
 
     def __init__(self):
+        super().__init__(thread_name_prefix="minio-io")
+        self._url_cache = TTLCache(max_size=URL_CACHE_SIZE)
+        self.bucket_name = os.getenv("MINIO_BUCKET_NAME", "categorize-files")
+        self.endpoint = os.getenv("MINIO_ENDPOINT", "nginx-minio:9010")
 
-        self.client = Minio(
+    @cached_property
+    def client(self) -> Minio:
+        return Minio(
             endpoint="nginx-minio:9010",
             access_key=os.getenv("MINIO_ACCESS_KEY", "minioadmin"),
             secret_key=os.getenv("MINIO_SECRET_KEY", "minioadmin123"),
             secure=os.getenv("MINIO_SECURE", "false").lower() == "true",
+            # Known region keeps presigning a local computation
+            region=os.getenv("MINIO_REGION"),
+            http_client=_create_http_client(),
         )
-        self.bucket_name = os.getenv("MINIO_BUCKET_NAME", "categorize-files")
-        self.endpoint = os.getenv("MINIO_ENDPOINT", "nginx-minio:9010")
-        self._ensure_bucket_exists()
 
-    def listen_to_bucket(self):
+    async def start(self):
+        """Make sure the bucket exists, called once on app startup"""
+        await self.run(self._ensure_bucket_exists)
+
+    def listen_to_bucket(
+        self,
+        prefix: str = "",
+        events: tuple[str, ...] = ("s3:ObjectCreated:*", "s3:ObjectRemoved:*"),
+    ):
         return self.client.listen_bucket_notification(
             self.bucket_name,
-            prefix="",
-            events=("s3:ObjectCreated:*", "s3:ObjectRemoved:*"),
+            prefix=prefix,
+            events=events,
         )
 
-    def file_exists(self, filename):
-        return (
-            self.client.stat_object(self.bucket_name, filename).content_type is not None
-        )
+    async def object_exists(self, object_name: str) -> bool:
+        try:
+            await self.run(self.client.stat_object, self.bucket_name, object_name)
+            return True
+        except S3Error as e:
+            if e.code in ("NoSuchKey", "NoSuchObject"):
+                return False
+            raise
 
     def _ensure_bucket_exists(self):
         """Create bucket if it doesn't exist"""
@@ -52,40 +125,29 @@ class MinIOService:
             print(f"Error creating bucket: {e}")
             raise HTTPException(status_code=500, detail="Failed to initialize storage")
 
-    async def remove_dir(self, dir: str):
-        try:
-            files = await asyncio.to_thread(lambda: self.list_files(dir))
-            file_names = [
-                file.object_name for file in files if file.object_name is not None
-            ]
-            await asyncio.gather(*[self.delete_file(file) for file in file_names])
-
-            print(f"Removed bucket: {self.bucket_name}")
-        except S3Error as e:
-            print(f"Error removing bucket: {e}")
-            raise HTTPException(status_code=500, detail="Failed to remove bucket")
-
-    def get_upload_url(self, object_name: str):
-        return self.client.get_presigned_url("PUT", self.bucket_name, object_name)
-
-    def append_to_text(self, object_name: str, text: str):
+    async def get_upload_url(self, object_name: str, expires: int = 3600) -> str:
+        """
+        Generate presigned URL the client can PUT the object to directly
+        """
         try:
-            self.client.put_object(
-                self.bucket_name, object_name, io.BytesIO(text.encode()), len(text)
+            return await self.run(
+                self.client.presigned_put_object,
+                bucket_name=self.bucket_name,
+                object_name=object_name,
+                expires=timedelta(seconds=expires),
             )
         except S3Error as e:
-            print(f"Error appending text: {e}")
-            raise HTTPException(status_code=500, detail="Failed to append text")
+            print(f"Error generating upload URL: {e}")
+            raise HTTPException(status_code=500, detail="Failed to generate upload URL")
 
     async def copy_file(self, source_object_name: str, destination_object_name: str):
         copy_source = CopySource(self.bucket_name, source_object_name)
         try:
-            await asyncio.to_thread(
-                lambda: self.client.copy_object(
-                    bucket_name=self.bucket_name,
-                    object_name=destination_object_name,
-                    source=copy_source,
-                )
+            await self.run(
+                self.client.copy_object,
+                bucket_name=self.bucket_name,
+                object_name=destination_object_name,
+                source=copy_source,
             )
         except S3Error as e:
             print(f"Error copying file: {e}")
@@ -104,12 +166,12 @@ class MinIOService:
         Upload file to MinIO and return the object name
         """
         try:
-            # TODO: Figure out some better way to handle non-unique filenames
-            # Maybe just require them instead
+            # Non-unique filenames overwrite each other here, see
+            # `upload_content` for content-addressed storage
             object_name = f"{folder}/{filename}" if folder else filename
 
-            # Upload file (run synchronous MinIO operation in thread pool)
-            await asyncio.to_thread(
+            # Upload file (run synchronous MinIO operation on the storage executor)
+            await self.run(
                 self.client.put_object,
                 bucket_name=self.bucket_name,
                 object_name=object_name,
@@ -125,68 +187,472 @@ class MinIOService:
             print(f"Error uploading file: {e}")
             raise HTTPException(status_code=500, detail="Failed to upload file")
 
+    async def upload_stream(
+        self,
+        file_data: BinaryIO,
+        filename: str,
+        content_type: str = "application/octet-stream",
+        folder: str = "",
+        metadata: DictType | None = None,
+    ) -> str:
+        """
+        Upload a stream of unknown length to MinIO as a multipart upload.
+
+        Only `UPLOAD_PART_SIZE` * (`UPLOAD_PARALLEL_PARTS` + 1) bytes are held
+        in memory at once, regardless of the size of the stream.
+        """
+        try:
+            object_name = f"{folder}/{filename}" if folder else filename
+
+            await self.run(
+                self.client.put_object,
+                bucket_name=self.bucket_name,
+                object_name=object_name,
+                data=file_data,
+                length=-1,
+                content_type=content_type,
+                metadata=metadata,
+                part_size=UPLOAD_PART_SIZE,
+                num_parallel_uploads=UPLOAD_PARALLEL_PARTS,
+            )
+
+            return object_name
+
+        except S3Error as e:
+            print(f"Error uploading file: {e}")
+            raise HTTPException(status_code=500, detail="Failed to upload file")
+
+    def _uploaded_parts(
+        self, object_name: str, upload_id: str, count: int
+    ) -> list[Part]:
+        """First `count` parts of an unfinished upload"""
+        parts: list[Part] = []
+        marker = None
+        while True:
+            result = self.client._list_parts(
+                self.bucket_name, object_name, upload_id, part_number_marker=marker
+            )
+            parts.extend(part for part in result.parts if part.part_number <= count)
+            if not result.is_truncated:
+                break
+            marker = result.next_part_number_marker
+        parts.sort(key=lambda part: part.part_number)
+        if [part.part_number for part in parts] != list(range(1, count + 1)):
+            raise ValueError(f"Upload {upload_id} is missing parts")
+        return parts
+
+    async def open_writer(
+        self,
+        object_name: str,
+        content_type: str = "application/octet-stream",
+        resume: dict | None = None,
+    ) -> MultipartUploadWriter:
+        """
+        Start a multipart upload that is fed by writes, so an object can be
+        uploaded while it's still being produced. Resuming keeps the parts
+        uploaded up to the checkpoint, later ones are uploaded again.
+        """
+        try:
+            if resume is not None:
+                upload_id = resume["upload_id"]
+                parts = await self.run(
+                    self._uploaded_parts, object_name, upload_id, resume["parts"]
+                )
+                return MultipartUploadWriter(
+                    self, object_name, upload_id, parts, resume["size"]
+                )
+            upload_id = await self.run(
+                self.client._create_multipart_upload,
+                self.bucket_name,
+                object_name,
+                {"Content-Type": content_type},
+            )
+        except (S3Error, ValueError) as e:
+            print(f"Error starting upload: {e}")
+            raise HTTPException(status_code=500, detail="Failed to upload file")
+        return MultipartUploadWriter(self, object_name, upload_id)
+
     async def download_file(self, object_name: str) -> bytes:
         """
         Download file from MinIO
         """
-        try:
+
+        def download():
             response = self.client.get_object(self.bucket_name, object_name)
-            data = response.read()
-            response.close()
-            response.release_conn()
-            return data
+            try:
+                return response.read()
+            finally:
+                response.close()
+                response.release_conn()
+
+        try:
+            return await self.run(download)
         except S3Error as e:
             print(f"Error downloading file: {e}")
             raise HTTPException(status_code=404, detail="File not found")
 
-    def get_object_stream(self, object_name: str):
+    async def open_object(self, object_name: str) -> io.BufferedReader:
+        """
+        Open object as a seekable file which fetches only the byte ranges read.
+        Reads block, do them off the event loop.
+        """
+        size = (await self.stat_file(object_name)).size
+        return io.BufferedReader(
+            ObjectReader(self, object_name, size or 0), buffer_size=64 * 1024
+        )
+
+    async def download_to_file(self, object_name: str, file_path: str):
+        """
+        Stream object into a local file without holding it in memory
+        """
         try:
-            return self.client.get_object(self.bucket_name, object_name)
+            await self.run(
+                self.client.fget_object, self.bucket_name, object_name, file_path
+            )
         except S3Error as e:
-            print(f"Error streaming file: {e}")
+            print(f"Error downloading file: {e}")
             raise HTTPException(status_code=404, detail="File not found")
 
-    async def delete_file(self, object_name: str) -> bool:
+    async def stat_file(self, object_name: str) -> Object:
         """
-        Delete file from MinIO
+        Get size, ETag and content type of an object without fetching it
         """
         try:
-            await asyncio.to_thread(
-                lambda: self.client.remove_object(self.bucket_name, object_name)
+            return await self.run(
+                self.client.stat_object, self.bucket_name, object_name
             )
-            return True
         except S3Error as e:
-            print(f"Error deleting file: {e}")
-            return False
+            print(f"Error reading file info: {e}")
+            raise HTTPException(status_code=404, detail="File not found")
 
-    async def get_file_url(self, object_name: str, expires: int = 3600) -> str:
+    async def get_object_stream(
+        self, object_name: str, offset: int = 0, length: int = 0
+    ) -> AsyncIterator[bytes]:
         """
-        Generate presigned URL for file access
+        Stream object body in chunks, `length` 0 reads up to the end.
+        The object is opened before this returns so missing files raise here.
         """
         try:
-            url = self.client.presigned_get_object(
-                bucket_name=self.bucket_name,
-                object_name=object_name,
-                expires=timedelta(seconds=expires),
+            response = await self.run(
+                self.client.get_object,
+                self.bucket_name,
+                object_name,
+                offset=offset,
+                length=length,
             )
-            return url
+        except S3Error as e:
+            print(f"Error streaming file: {e}")
+            raise HTTPException(status_code=404, detail="File not found")
+
+        async def stream():
+            try:
+                while chunk := await self.run(response.read, STREAM_CHUNK_SIZE):
+                    yield chunk
+            finally:
+                response.close()
+                response.release_conn()
+
+        return stream()
+
+    def _remove_batch(self, batch: tuple[str, ...]) -> list:
+        return list(
+            self.client.remove_objects(
+                self.bucket_name, [DeleteObject(name) for name in batch]
+            )
+        )
+
+    async def delete_files(self, object_names: Iterable[str]) -> list[str]:
+        """
+        Delete objects with multi-object delete requests of up to
+        `REMOVE_BATCH_SIZE` keys. Returns names that failed to delete,
+        missing objects count as deleted.
+        """
+        failed: list[str] = []
+        for batch in batched(object_names, REMOVE_BATCH_SIZE):
+            try:
+                errors = await self.run(self._remove_batch, batch)
+            except S3Error as e:
+                print(f"Error deleting files: {e}")
+                failed.extend(batch)
+                continue
+            for error in errors:
+                if error.code == "NoSuchKey" or error.name is None:
+                    continue
+                print(f"Error deleting file {error.name}: {error.message}")
+                failed.append(error.name)
+        return failed
+
+    def _presign_urls(
+        self, object_names: list[str], expires: int
+    ) -> dict[str, tuple[str, int]]:
+        result: dict[str, tuple[str, int]] = {}
+        now = time.time()
+        for object_name in object_names:
+            cached = self._url_cache.get((object_name, expires))
+            if cached is None:
+                url = self.client.presigned_get_object(
+                    bucket_name=self.bucket_name,
+                    object_name=object_name,
+                    expires=timedelta(seconds=expires),
+                )
+                cached = (url, now + expires - URL_CACHE_MARGIN)
+                self._url_cache.set((object_name, expires), *cached)
+            url, cache_expires_at = cached
+            result[object_name] = (url, int(cache_expires_at + URL_CACHE_MARGIN - now))
+        return result
+
+    async def get_file_urls(
+        self, object_names: list[str], expires: int = 3600
+    ) -> dict[str, tuple[str, int]]:
+        """
+        Generate presigned URLs for many objects at once.
+
+        Returns object name -> (url, seconds until the url expires). URLs are
+        cached per object until shortly before they expire.
+        """
+        try:
+            return await self.run(self._presign_urls, object_names, expires)
         except S3Error as e:
             print(f"Error generating URL: {e}")
             raise HTTPException(status_code=500, detail="Failed to generate file URL")
 
-    def list_files(self, prefix: str = ""):
+    async def iter_files(
+        self,
+        prefix: str = "",
+        recursive: bool = True,
+        batch_size: int = REMOVE_BATCH_SIZE,
+    ) -> AsyncIterator[list[Object]]:
         """
-        List files in bucket with optional prefix
+        List files in bucket page by page, without holding the whole
+        listing in memory
         """
+        objects = self.client.list_objects(
+            bucket_name=self.bucket_name, prefix=prefix, recursive=recursive
+        )
+        while batch := await self.run(lambda: list(islice(objects, batch_size))):
+            yield batch
+
+
+class ObjectReader(io.RawIOBase):
+    """Read-only, seekable view of a MinIO object backed by range requests"""
+
+    def __init__(self, service: MinIOService, object_name: str, size: int):
+        self._service = service
+        self._object_name = object_name
+        self._size = size
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._position = max(0, offset)
+        return self._position
+
+    def _fetch(self, length: int) -> bytes:
+        response = self._service.client.get_object(
+            self._service.bucket_name,
+            self._object_name,
+            offset=self._position,
+            length=length,
+        )
         try:
-            objects = self.client.list_objects(
-                bucket_name=self.bucket_name, prefix=prefix, recursive=True
+            data = response.read()
+        finally:
+            response.close()
+            response.release_conn()
+        self._position += len(data)
+        return data
+
+    def readinto(self, buffer) -> int:
+        length = min(len(buffer), self._size - self._position)
+        if length <= 0:
+            return 0
+        data = self._fetch(length)
+        buffer[: len(data)] = data
+        return len(data)
+
+    def readall(self) -> bytes:
+        length = self._size - self._position
+        return self._fetch(length) if length > 0 else b""
+
+
+class MultipartUploadWriter(ObjectWriter):
+    """
+    Cuts written bytes into `UPLOAD_PART_SIZE` parts and uploads each one on
+    the storage executor as soon as `MIN_PART_SIZE` more follows it. Writes
+    block while `WRITER_PARALLEL_PARTS` parts are in flight, so memory stays
+    at a few parts whatever the size of the object.
+
+    Multipart calls go through the client's private methods, which is why
+    `minio` is pinned to the exact version they were checked against.
+    """
+
+    def __init__(
+        self,
+        service: MinIOService,
+        object_name: str,
+        upload_id: str,
+        parts: list[Part] | None = None,
+        position: int = 0,
+    ):
+        self._service = service
+        self._object_name = object_name
+        self.upload_id = upload_id
+        self._buffer = bytearray()
+        self._position = position
+        self._parts: list[Future[Part]] = []
+        # Parts uploaded before a resume
+        for part in parts or []:
+            uploaded: Future[Part] = Future()
+            uploaded.set_result(Part(part.part_number, part.etag))
+            self._parts.append(uploaded)
+        self._slots = threading.BoundedSemaphore(WRITER_PARALLEL_PARTS)
+
+    def _upload_part(self, part_number: int, data: bytes) -> Part:
+        try:
+            etag = self._service.client._upload_part(
+                self._service.bucket_name,
+                self._object_name,
+                data,
+                None,
+                self.upload_id,
+                part_number,
             )
-            return objects
-        except S3Error as e:
-            print(f"Error listing files: {e}")
-            raise HTTPException(status_code=500, detail="Failed to list files")
+            return Part(part_number, etag)
+        finally:
+            self._slots.release()
+
+    def _copy_part(
+        self, part_number: int, object_name: str, offset: int, length: int
+    ) -> Part:
+        try:
+            headers = CopySource(
+                self._service.bucket_name, object_name
+            ).gen_copy_headers()
+            headers["x-amz-copy-source-range"] = f"bytes={offset}-{offset + length - 1}"
+            etag, _ = self._service.client._upload_part_copy(
+                self._service.bucket_name,
+                self._object_name,
+                self.upload_id,
+                part_number,
+                headers,
+            )
+            return Part(part_number, etag)
+        finally:
+            self._slots.release()
 
+    def _read_range(self, object_name: str, offset: int, length: int) -> bytes:
+        response = self._service.client.get_object(
+            self._service.bucket_name, object_name, offset=offset, length=length
+        )
+        try:
+            return response.read()
+        finally:
+            response.close()
+            response.release_conn()
+
+    def _submit(self, upload: Callable[..., Part], *args):
+        self._slots.acquire()
+        # Fail the write rather than the commit when a part didn't make it
+        for part in self._parts:
+            error = part.exception() if part.done() else None
+            if error is not None:
+                self._slots.release()
+                raise error
+        self._parts.append(
+            self._service._executor.submit(upload, len(self._parts) + 1, *args)
+        )
+
+    def write(self, data: bytes) -> int:
+        self._buffer += data
+        self._position += len(data)
+        # At least `MIN_PART_SIZE` stays buffered, so a checkpoint can always
+        # upload the buffer as a part of its own
+        while len(self._buffer) >= UPLOAD_PART_SIZE + MIN_PART_SIZE:
+            self._submit(self._upload_part, bytes(self._buffer[:UPLOAD_PART_SIZE]))
+            del self._buffer[:UPLOAD_PART_SIZE]
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
 
-# Create singleton instance
-minio_service = MinIOService()
+    def copy_range(self, object_name: str, offset: int, length: int):
+        """
+        Copy with UploadPartCopy, so the bytes never pass through here. Parts
+        can't be smaller than `MIN_PART_SIZE` unless they're the last, so
+        the edges of the range are downloaded and join the parts next to
+        them.
+        """
+        if self._buffer:
+            size = min(length, max(UPLOAD_PART_SIZE - len(self._buffer), 0))
+            if size:
+                self._buffer += self._read_range(object_name, offset, size)
+                self._position += size
+                offset += size
+                length -= size
+            if not length:
+                return
+            self._submit(self._upload_part, bytes(self._buffer))
+            self._buffer.clear()
+        while length >= UPLOAD_PART_SIZE:
+            size = min(length, MAX_COPY_PART_SIZE)
+            self._submit(self._copy_part, object_name, offset, size)
+            self._position += size
+            offset += size
+            length -= size
+        if length:
+            self.write(self._read_range(object_name, offset, length))
+
+    def checkpoint(self) -> dict | None:
+        """
+        Upload what's buffered as a part of its own and wait for every part.
+        Only the last part may be under `MIN_PART_SIZE`, so a smaller buffer
+        waits for more writes.
+        """
+        if 0 < len(self._buffer) < MIN_PART_SIZE:
+            return None
+        if self._buffer:
+            self._submit(self._upload_part, bytes(self._buffer))
+            self._buffer.clear()
+        for part in self._parts:
+            part.result()
+        return {
+            "upload_id": self.upload_id,
+            "parts": len(self._parts),
+            "size": self._position,
+        }
+
+    def commit(self):
+        # The last part may be smaller than the minimum, or the only one empty
+        if self._buffer or not self._parts:
+            self._submit(self._upload_part, bytes(self._buffer))
+            self._buffer.clear()
+        parts = [part.result() for part in self._parts]
+        self._service.client._complete_multipart_upload(
+            self._service.bucket_name, self._object_name, self.upload_id, parts
+        )
+
+    def abort(self):
+        for part in self._parts:
+            part.cancel()
+        for part in self._parts:
+            if not part.cancelled():
+                part.exception()
+        self._buffer.clear()
+        try:
+            self._service.client._abort_multipart_upload(
+                self._service.bucket_name, self._object_name, self.upload_id
+            )
+        except S3Error as e:
+            print(f"Error aborting upload: {e}")
@@ -0,0 +1,164 @@
+import asyncio
+import fcntl
+import hashlib
+import os
+import tempfile
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+from services.storage import storage_service
+
+__all__ = ["object_cache"]
+
+OBJECT_CACHE_DIR = Path(
+    os.getenv(
+        "OBJECT_CACHE_DIR",
+        os.path.join(tempfile.gettempdir(), "categorise-object-cache"),
+    )
+)
+# Byte budget of the cache, 0 disables it
+OBJECT_CACHE_MAX_BYTES = int(
+    os.getenv("OBJECT_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024))
+)
+# Partial downloads older than this were left by a process that died
+STALE_DOWNLOAD_AGE = 3600
+
+
+class ObjectCache:
+    """
+    Read-through cache of stored objects on local disk.
+
+    Entries are keyed by object name and ETag, so an overwritten object is
+    fetched again instead of served stale. Least recently used entries are
+    deleted once the cached files exceed `max_bytes`.
+
+    Every process of the app shares the directory, so nothing is indexed in
+    memory: sizes and recency are read from the files themselves and
+    eviction runs under a lock file.
+    """
+
+    _pending: dict[str, asyncio.Task[Path]]
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._pending = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        with open(self.directory / ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _evict(self):
+        """Delete the least recently used files until the cache fits its budget"""
+        found: list[tuple[float, int, Path]] = []
+        now = time.time()
+        with self._locked():
+            for path in self.directory.glob("*/*"):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                if path.suffix:
+                    # Download in progress, maybe in another process
+                    if stat.st_mtime < now - STALE_DOWNLOAD_AGE:
+                        path.unlink(missing_ok=True)
+                    continue
+                found.append((stat.st_mtime, stat.st_size, path))
+            size = sum(size for _, size, _ in found)
+            for _, file_size, path in sorted(found):
+                if size <= self.max_bytes:
+                    break
+                # Readers holding the file open keep reading it after the unlink
+                path.unlink(missing_ok=True)
+                size -= file_size
+
+    async def start(self):
+        if self.enabled:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            await asyncio.to_thread(self._evict)
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / key
+
+    async def _fetch(self, key: str, object_name: str) -> Path:
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Written next to the target and renamed once complete
+        await storage_service.download_to_file(object_name, str(path))
+        await asyncio.to_thread(self._evict)
+        return path
+
+    async def _lookup(
+        self, object_name: str, etag: str | None, size: int | None
+    ) -> tuple[Path | None, str | None]:
+        """Local copy of the object if there is one, and its key if cacheable"""
+        if local := await storage_service.local_path(object_name):
+            return Path(local), None
+        if not self.enabled:
+            return None, None
+        if etag is None or size is None:
+            stat = await storage_service.stat_file(object_name)
+            etag, size = stat.etag, stat.size
+        if size is None or size > self.max_bytes:
+            return None, None
+
+        key = hashlib.sha256(f"{object_name}\0{etag}".encode()).hexdigest()
+        path = self._path(key)
+        try:
+            # The modification time orders entries for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None, key
+        return path, key
+
+    def _download(self, key: str, object_name: str) -> asyncio.Task[Path]:
+        # Concurrent misses for the same object share one download
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.create_task(self._fetch(key, object_name))
+            self._pending[key] = task
+
+            def done(task: asyncio.Task[Path]):
+                self._pending.pop(key, None)
+                if not task.cancelled() and task.exception() is not None:
+                    print(f"Error caching {object_name}: {task.exception()}")
+
+            task.add_done_callback(done)
+        return task
+
+    async def get(
+        self, object_name: str, etag: str | None = None, size: int | None = None
+    ) -> Path | None:
+        """
+        Path of a local copy of the object, downloading it on a miss.
+        None when the cache is disabled or the object doesn't fit in it.
+        Objects the storage keeps on local disk already are used in place.
+        """
+        path, key = await self._lookup(object_name, etag, size)
+        if path is not None or key is None:
+            return path
+        return await asyncio.shield(self._download(key, object_name))
+
+    async def peek(
+        self, object_name: str, etag: str | None = None, size: int | None = None
+    ) -> Path | None:
+        """
+        Like `get`, but a miss returns None right away while the object is
+        downloaded into the cache in the background, for callers that can
+        read it from the storage meanwhile
+        """
+        path, key = await self._lookup(object_name, etag, size)
+        if path is None and key is not None:
+            self._download(key, object_name)
+        return path
+
+
+object_cache = ObjectCache(OBJECT_CACHE_DIR, OBJECT_CACHE_MAX_BYTES)
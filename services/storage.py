@@ -0,0 +1,23 @@
+import os
+
+from services.storage_service import StorageService
+
+__all__ = ["STORAGE_BACKEND", "storage_service"]
+
+# "minio" or "local", see services/local_storage_service.py
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "minio").lower()
+
+
+def create_storage_service() -> StorageService:
+    if STORAGE_BACKEND == "local":
+        from services.local_storage_service import LocalStorageService
+
+        return LocalStorageService()
+    if STORAGE_BACKEND == "minio":
+        from services.minio_service import MinIOService
+
+        return MinIOService()
+    raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+
+
+storage_service = create_storage_service()
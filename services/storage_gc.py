@@ -0,0 +1,220 @@
+import asyncio
+import datetime
+import os
+from collections.abc import AsyncIterator, Awaitable, Callable
+from contextlib import asynccontextmanager
+
+from pydantic import BaseModel
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database_handle.database import get_sessionmanager
+from database_handle.queries.audios import AudioQueries
+from database_handle.queries.bindings import BindingsQueries
+from database_handle.queries.exports import ExportsQueries
+from database_handle.queries.texts import TextsQueries
+from routes.finalize.constants import OUTPUT_ARCHIVE
+from routes.finalize.export_jobs import discard_export_upload
+from services.audio_jobs import (
+    peaks_object_name,
+    preview_object_name,
+    source_object_name,
+)
+from services.storage import storage_service
+from services.storage_service import AUDIO_FOLDER
+
+__all__ = ["GCReport", "GarbageCollector", "collect_garbage", "is_collecting"]
+
+# Seconds between periodic runs, 0 disables them
+GC_INTERVAL = int(os.getenv("STORAGE_GC_INTERVAL", "0"))
+# Objects and rows younger than this are never collected, so uploads in
+# flight aren't mistaken for garbage
+GC_GRACE_PERIOD = int(os.getenv("STORAGE_GC_GRACE_PERIOD", str(24 * 3600)))
+
+# Advisory lock held by the process collecting, so app processes and
+# workers sharing the database never collect at the same time
+GC_LOCK_KEY = "storage:gc"
+
+_running = asyncio.Lock()
+
+
+class GCReport(BaseModel):
+    removed_objects: int = 0
+    failed_objects: int = 0
+    removed_audios: int = 0
+    removed_exports: int = 0
+
+
+async def _delete_objects(names: list[str], report: GCReport):
+    failed = await storage_service.delete_files(names)
+    report.removed_objects += len(names) - len(failed)
+    report.failed_objects += len(failed)
+
+
+async def _remove_stale_rows(before: datetime.datetime, report: GCReport):
+    """
+    Audios never uploaded and exports that failed or were cancelled, with
+    their objects
+    """
+    async with get_sessionmanager().session() as session:
+        failed_exports = await ExportsQueries(session=session).get_failed_before(before)
+    # Unfinished uploads are only found through the checkpoints deleted below
+    for id, _ in failed_exports:
+        await discard_export_upload(str(id))
+
+    async with get_sessionmanager().session() as session, session.begin():
+        audios_queries = AudioQueries(session=session)
+        # Bindings of these have no transcript, the row is all there is
+        waiting = await audios_queries.get_waiting_before(before)
+        ids = [id for id, _ in waiting]
+        text_ids = await BindingsQueries(session=session).remove_for_audios(ids)
+        await audios_queries.remove_many(ids)
+        await TextsQueries(session=session).remove_many(text_ids)
+
+        # Deduplicated objects may still be shared with other audios
+        urls = [url for _, url in waiting if url]
+        await audios_queries.lock_objects(urls)
+        shared = await audios_queries.referenced_urls(urls)
+
+        await ExportsQueries(session=session).delete_many(
+            [id for id, _ in failed_exports]
+        )
+
+        # Deleted before the commit releases the locks
+        await _delete_objects(
+            [
+                name
+                for url in urls
+                if url not in shared
+                for name in (url, peaks_object_name(url), preview_object_name(url))
+            ],
+            report,
+        )
+
+    report.removed_audios += len(waiting)
+    report.removed_exports += len(failed_exports)
+    await _delete_objects([url for _, url in failed_exports if url], report)
+
+
+async def _remove_orphans(
+    prefix: str,
+    recursive: bool,
+    is_candidate: Callable[[str], bool],
+    referenced: Callable[[AsyncSession, list[str]], Awaitable[set[str]]],
+    before: datetime.datetime,
+    report: GCReport,
+):
+    """Delete objects under `prefix` no row refers to, a listing page at a time"""
+    before = before.replace(tzinfo=datetime.UTC)
+    async for objects in storage_service.iter_files(prefix, recursive=recursive):
+        names = [
+            obj.object_name
+            for obj in objects
+            if obj.object_name is not None
+            and not obj.is_dir
+            and obj.last_modified is not None
+            and obj.last_modified < before
+            and is_candidate(obj.object_name)
+        ]
+        if not names:
+            continue
+        async with get_sessionmanager().session() as session, session.begin():
+            kept = await referenced(
+                session, [source_object_name(name) for name in names]
+            )
+            # Deleted before the commit releases locks `referenced` took
+            await _delete_objects(
+                [name for name in names if source_object_name(name) not in kept],
+                report,
+            )
+
+
+async def _referenced_audio(session: AsyncSession, urls: list[str]) -> set[str]:
+    queries = AudioQueries(session=session)
+    await queries.lock_objects(urls)
+    return await queries.referenced_urls(urls)
+
+
+async def _referenced_archives(session: AsyncSession, urls: list[str]) -> set[str]:
+    return await ExportsQueries(session=session).referenced_archives(urls)
+
+
+@asynccontextmanager
+async def _collecting() -> AsyncIterator[bool]:
+    """
+    Hold the collection lock of every process sharing the database for the
+    block, yields False when another process holds it
+    """
+    async with _running, get_sessionmanager().connect() as connection:
+        if connection.dialect.name != "postgresql":
+            yield True
+            return
+        # Released when the connection's transaction ends, even if we crash
+        yield await connection.scalar(
+            select(func.pg_try_advisory_xact_lock(func.hashtext(GC_LOCK_KEY)))
+        )
+
+
+async def collect_garbage() -> GCReport | None:
+    """
+    Reconcile the bucket with the `audios` and `exports` tables: drop rows
+    whose upload or export never finished, then objects no row refers to.
+    Returns None without collecting when another process is at it.
+    """
+    report = GCReport()
+    async with _collecting() as acquired:
+        if not acquired:
+            return None
+        before = datetime.datetime.now(datetime.UTC).replace(
+            tzinfo=None
+        ) - datetime.timedelta(seconds=GC_GRACE_PERIOD)
+        await _remove_stale_rows(before, report)
+        await _remove_orphans(
+            f"{AUDIO_FOLDER}/",
+            True,
+            lambda name: True,
+            _referenced_audio,
+            before,
+            report,
+        )
+        # Export archives are stored in the bucket root
+        await _remove_orphans(
+            "",
+            False,
+            lambda name: name.endswith(f"_{OUTPUT_ARCHIVE}"),
+            _referenced_archives,
+            before,
+            report,
+        )
+    print(f"Storage garbage collection finished: {report.model_dump()}")
+    return report
+
+
+def is_collecting() -> bool:
+    return _running.locked()
+
+
+class GarbageCollector:
+    """Runs `collect_garbage` every `GC_INTERVAL` seconds"""
+
+    _task: asyncio.Task | None
+
+    def __init__(self):
+        self._task = None
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(GC_INTERVAL)
+            try:
+                await collect_garbage()
+            except Exception as e:
+                print(f"Storage garbage collection failed: {e}")
+
+    def start(self):
+        if GC_INTERVAL > 0:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
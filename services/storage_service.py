@@ -0,0 +1,361 @@
+import asyncio
+import hashlib
+import io
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections.abc import AsyncIterator, Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import PurePosixPath
+from typing import BinaryIO, NamedTuple, TypedDict
+
+from minio.datatypes import Object
+
+__all__ = [
+    "AUDIO_FOLDER",
+    "DEDUPLICATE_AUDIO",
+    "MAX_URL_EXPIRES",
+    "MIN_URL_EXPIRES",
+    "FileInfo",
+    "ObjectWriter",
+    "StorageService",
+    "StoredContent",
+]
+
+# Folder audio objects are uploaded to
+AUDIO_FOLDER = "audio"
+# Store audio by content so byte-identical uploads share one object
+DEDUPLICATE_AUDIO = os.getenv("AUDIO_DEDUPLICATE", "false").lower() == "true"
+# Subfolder of content-addressed objects, named by the SHA-256 of their bytes
+CONTENT_FOLDER = "sha256"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Threads dedicated to blocking storage calls, separate from the default executor
+STORAGE_IO_WORKERS = int(
+    os.getenv("STORAGE_IO_WORKERS", os.getenv("MINIO_IO_WORKERS", "32"))
+)
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Most keys a single delete batch holds
+REMOVE_BATCH_SIZE = 1000
+
+# Presigned URLs are dropped from the cache this many seconds before expiring
+URL_CACHE_MARGIN = int(os.getenv("MINIO_URL_CACHE_MARGIN", "60"))
+# Lifetimes a signed URL can be asked for, S3 signatures last at most a week
+MIN_URL_EXPIRES = URL_CACHE_MARGIN + 1
+MAX_URL_EXPIRES = 7 * 24 * 3600
+
+# Name, size, ETag, content type and modification time of a stored object;
+# every backend describes its objects with MinIO's type
+type FileInfo = Object
+
+
+class StoredContent(NamedTuple):
+    object_name: str
+    content_hash: str
+    # False when an identical object was already stored
+    created: bool
+
+
+class StorageStats(TypedDict):
+    workers: int
+    queued: int
+    in_flight: int
+
+
+def content_hash(file: BinaryIO) -> str:
+    """SHA-256 of the rest of a seekable file, which is rewound afterwards"""
+    start = file.tell()
+    digest = hashlib.sha256()
+    while chunk := file.read(HASH_CHUNK_SIZE):
+        digest.update(chunk)
+    file.seek(start)
+    return digest.hexdigest()
+
+
+class ObjectWriter(ABC):
+    """
+    Blocking, write-only file object that stores an object front to back,
+    e.g. an archive as it's being built. Nothing is visible in storage
+    until `commit`; `abort` discards what was written. Not seekable, call
+    it off the event loop.
+    """
+
+    @abstractmethod
+    def write(self, data: bytes) -> int: ...
+
+    @abstractmethod
+    def tell(self) -> int: ...
+
+    @abstractmethod
+    def copy_range(self, object_name: str, offset: int, length: int):
+        """
+        Append `length` bytes of a stored object starting at `offset`, copied
+        inside the storage where the backend can
+        """
+
+    def flush(self):
+        pass
+
+    def checkpoint(self) -> dict | None:
+        """
+        Make everything written so far durable and return what `open_writer`
+        needs to carry on writing from here, None if the writer can't do it
+        at this point
+        """
+        return None
+
+    @abstractmethod
+    def commit(self): ...
+
+    @abstractmethod
+    def abort(self): ...
+
+
+class StorageService(ABC):
+    """
+    Object storage the app keeps audio, derived files and exports in.
+
+    Backends implement blocking operations and run them on a dedicated
+    executor through `run`, so no call blocks the event loop. Objects are
+    addressed by slash separated names inside `bucket_name`.
+    """
+
+    bucket_name: str
+    # Whether `listen_to_bucket` reports objects uploaded via presigned URLs
+    supports_notifications = False
+    _executor: ThreadPoolExecutor
+
+    def __init__(self, thread_name_prefix: str):
+        self._executor = ThreadPoolExecutor(
+            max_workers=STORAGE_IO_WORKERS, thread_name_prefix=thread_name_prefix
+        )
+        self._stats_lock = threading.Lock()
+        self._queued = 0
+        self._in_flight = 0
+
+    async def run[T](self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """Run a blocking storage call on the storage executor"""
+
+        def call():
+            with self._stats_lock:
+                self._queued -= 1
+                self._in_flight += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._stats_lock:
+                    self._in_flight -= 1
+
+        with self._stats_lock:
+            self._queued += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, call)
+
+    def stats(self) -> StorageStats:
+        with self._stats_lock:
+            return StorageStats(
+                workers=STORAGE_IO_WORKERS,
+                queued=self._queued,
+                in_flight=self._in_flight,
+            )
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    @abstractmethod
+    async def start(self):
+        """Prepare the storage, called once on app startup"""
+
+    def listen_to_bucket(
+        self,
+        prefix: str = "",
+        events: tuple[str, ...] = ("s3:ObjectCreated:*", "s3:ObjectRemoved:*"),
+    ):
+        raise NotImplementedError("Storage backend has no bucket notifications")
+
+    async def file_exists(self, filename: str) -> bool:
+        return (await self.stat_file(filename)).content_type is not None
+
+    @abstractmethod
+    async def object_exists(self, object_name: str) -> bool: ...
+
+    async def remove_dir(self, dir: str):
+        async for files in self.iter_files(dir):
+            await self.delete_files(
+                [file.object_name for file in files if file.object_name is not None]
+            )
+
+    @abstractmethod
+    async def get_upload_url(self, object_name: str, expires: int = 3600) -> str:
+        """URL the client can PUT the object to directly"""
+
+    async def append_to_text(self, object_name: str, text: str):
+        data = text.encode()
+        await self.upload_file(io.BytesIO(data), object_name, len(data))
+
+    @abstractmethod
+    async def copy_file(
+        self, source_object_name: str, destination_object_name: str
+    ): ...
+
+    @abstractmethod
+    async def upload_file(
+        self,
+        file_data: BinaryIO,
+        filename: str,
+        size: int,
+        content_type: str = "application/octet-stream",
+        folder: str = "",
+        metadata: dict[str, str] | None = None,
+    ) -> str:
+        """Store `size` bytes of `file_data` and return the object name"""
+
+    @abstractmethod
+    async def upload_stream(
+        self,
+        file_data: BinaryIO,
+        filename: str,
+        content_type: str = "application/octet-stream",
+        folder: str = "",
+        metadata: dict[str, str] | None = None,
+    ) -> str:
+        """Store a stream of unknown length and return the object name"""
+
+    async def upload_content(
+        self,
+        file_data: BinaryIO,
+        filename: str,
+        content_type: str = "application/octet-stream",
+        folder: str = AUDIO_FOLDER,
+    ) -> StoredContent:
+        """
+        Store a file under a key derived from its content, so identical files
+        share one object. `file_data` must be seekable; it's hashed locally
+        first, so a duplicate is never uploaded at all.
+        """
+        digest = await asyncio.to_thread(content_hash, file_data)
+        suffix = PurePosixPath(filename).suffix.lower()
+        object_name = f"{folder}/{CONTENT_FOLDER}/{digest[:2]}/{digest}{suffix}"
+        if await self.object_exists(object_name):
+            return StoredContent(object_name, digest, created=False)
+
+        await self.upload_stream(
+            file_data,
+            object_name.removeprefix(f"{folder}/"),
+            content_type=content_type,
+            folder=folder,
+        )
+        return StoredContent(object_name, digest, created=True)
+
+    async def restore_content(
+        self,
+        file_data: BinaryIO,
+        stored: StoredContent,
+        content_type: str = "application/octet-stream",
+    ) -> StoredContent:
+        """
+        Upload a deduplicated object again when it was deleted since
+        `upload_content` found it. Call it holding
+        `AudioQueries.lock_objects` for the object, in the transaction that
+        starts referencing it.
+        """
+        if stored.created or await self.object_exists(stored.object_name):
+            return stored
+        file_data.seek(0)
+        await self.upload_stream(
+            file_data, stored.object_name, content_type=content_type
+        )
+        return stored._replace(created=True)
+
+    @abstractmethod
+    async def open_writer(
+        self,
+        object_name: str,
+        content_type: str = "application/octet-stream",
+        resume: dict | None = None,
+    ) -> ObjectWriter:
+        """
+        Start writing an object whose size isn't known up front, or reopen
+        an unfinished one at a `checkpoint` of its writer
+        """
+
+    @abstractmethod
+    async def download_file(self, object_name: str) -> bytes: ...
+
+    @abstractmethod
+    async def open_object(self, object_name: str) -> io.BufferedReader:
+        """
+        Open object as a seekable file. Reads block, do them off the event loop.
+        """
+
+    @abstractmethod
+    async def download_to_file(self, object_name: str, file_path: str):
+        """Copy object into a local file without holding it in memory"""
+
+    @abstractmethod
+    async def stat_file(self, object_name: str) -> FileInfo:
+        """Size, ETag and content type of an object without fetching it"""
+
+    @abstractmethod
+    async def get_object_stream(
+        self, object_name: str, offset: int = 0, length: int = 0
+    ) -> AsyncIterator[bytes]:
+        """
+        Stream object body in chunks, `length` 0 reads up to the end.
+        The object is opened before this returns so missing files raise here.
+        """
+
+    async def local_path(self, object_name: str) -> str | None:
+        """
+        Path of the object on this machine when the backend keeps it in the
+        local filesystem, so it can be served with zero-copy file responses
+        """
+        return None
+
+    async def delete_file(self, object_name: str) -> bool:
+        return not await self.delete_files([object_name])
+
+    @abstractmethod
+    async def delete_files(self, object_names: Iterable[str]) -> list[str]:
+        """
+        Delete objects in batches of up to `REMOVE_BATCH_SIZE`. Returns names
+        that failed to delete, missing objects count as deleted.
+        """
+
+    @abstractmethod
+    async def get_file_urls(
+        self, object_names: list[str], expires: int = 3600
+    ) -> dict[str, tuple[str, int]]:
+        """
+        Signed URLs for many objects at once, object name -> (url, seconds
+        until the url expires)
+        """
+
+    async def get_file_url(self, object_name: str, expires: int = 3600) -> str:
+        """
+        Generate presigned URL for file access
+        """
+        urls = await self.get_file_urls([object_name], expires)
+        return urls[object_name][0]
+
+    async def list_files(self, prefix: str = "") -> list[FileInfo]:
+        """
+        List files in bucket with optional prefix
+        """
+        files: list[FileInfo] = []
+        async for batch in self.iter_files(prefix):
+            files.extend(batch)
+        return files
+
+    @abstractmethod
+    def iter_files(
+        self,
+        prefix: str = "",
+        recursive: bool = True,
+        batch_size: int = REMOVE_BATCH_SIZE,
+    ) -> AsyncIterator[list[FileInfo]]:
+        """
+        List files in bucket page by page, without holding the whole
+        listing in memory
+        """
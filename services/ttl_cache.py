@@ -0,0 +1,44 @@
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Hashable
+
+__all__ = ["TTLCache"]
+
+
+class TTLCache[K: Hashable, V]:
+    """
+    Size-bounded in-process cache whose entries carry their own expiry time.
+
+    Oldest entries are dropped first once `max_size` is reached. Safe to use
+    from the event loop and worker threads alike.
+    """
+
+    _entries: OrderedDict[K, tuple[V, float]]
+
+    def __init__(self, max_size: int = 10_000):
+        self._max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: K) -> tuple[V, float] | None:
+        """Return (value, expires_at) or None when missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self._entries[key]
+                return None
+            return entry
+
+    def set(self, key: K, value: V, expires_at: float):
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key: K):
+        with self._lock:
+            self._entries.pop(key, None)
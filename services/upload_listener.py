@@ -0,0 +1,195 @@
+import asyncio
+import os
+import socket
+import threading
+from urllib.parse import unquote_plus
+from uuid import uuid4
+
+from fastapi import HTTPException
+from pydantic import UUID4
+from redis.asyncio import Redis
+
+from database_handle.database import get_sessionmanager
+from database_handle.models.audios import StatusEnum
+from database_handle.queries.audios import AudioQueries
+from services.audio_jobs import on_audio_available
+from services.audio_processing import extract_metadata
+from services.listener_service import create_redis
+from services.storage import storage_service
+from services.storage_service import AUDIO_FOLDER
+
+__all__ = ["UploadListener"]
+
+LISTEN_UPLOADS = os.getenv("MINIO_LISTEN_UPLOADS", "true").lower() == "true"
+
+# Seconds to wait before reconnecting a dropped notification stream
+RECONNECT_DELAY = 5
+
+LISTENER_LOCK_KEY = "uploads:listener"
+# Seconds the listening process holds the lock without renewing it
+LISTENER_LOCK_TTL = 30
+
+_RENEW_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+_RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+async def mark_uploaded(audio_id: UUID4, object_name: str):
+    """Measure an object uploaded through a presigned URL and make it available"""
+    reader = await storage_service.open_object(object_name)
+    try:
+        metadata = await extract_metadata(reader, run_io=storage_service.run)
+    finally:
+        reader.close()
+
+    async with get_sessionmanager().session() as session, session.begin():
+        await AudioQueries(session=session).update_audio(
+            audio_id=audio_id,
+            status=StatusEnum.available,
+            audio_length=metadata.duration,
+        )
+    on_audio_available(object_name)
+
+
+async def process_uploaded_object(object_name: str):
+    async with get_sessionmanager().session() as session:
+        audio_id = await AudioQueries(session=session).get_waiting_id_by_url(
+            object_name
+        )
+    if audio_id is not None:
+        await mark_uploaded(audio_id, object_name)
+
+
+class UploadListener:
+    """
+    Consumes `s3:ObjectCreated:*` bucket notifications for the audio folder and
+    finishes presigned uploads in the background, so audio bytes never pass
+    through the API workers.
+
+    Every app process starts one, but only the one holding the listener lock
+    in Redis listens, the others take over once its lock expires.
+    """
+
+    listener_id: str
+    _queue: asyncio.Queue[str]
+    _task: asyncio.Task | None
+
+    def __init__(self):
+        self.listener_id = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    def _listen(self, loop: asyncio.AbstractEventLoop, stop: threading.Event):
+        """
+        Blocking notification stream, runs in its own thread. A stopped
+        thread exits on the next notification without queueing it, by then
+        whoever holds the lock listens.
+        """
+        while not stop.is_set():
+            try:
+                with storage_service.listen_to_bucket(
+                    prefix=f"{AUDIO_FOLDER}/", events=("s3:ObjectCreated:*",)
+                ) as events:
+                    for event in events:
+                        if stop.is_set():
+                            break
+                        for record in event.get("Records", []):
+                            key = unquote_plus(record["s3"]["object"]["key"])
+                            loop.call_soon_threadsafe(self._queue.put_nowait, key)
+            except Exception as e:
+                if stop.is_set():
+                    break
+                print(f"Bucket notification stream failed: {e}")
+                stop.wait(RECONNECT_DELAY)
+
+    async def _catch_up(self):
+        """Finish uploads whose notifications were sent while nobody listened"""
+        async with get_sessionmanager().session() as session:
+            waiting = await AudioQueries(session=session).get_waiting_with_url()
+        for audio_id, object_name in waiting:
+            try:
+                await mark_uploaded(audio_id, object_name)
+            except HTTPException:
+                # Not uploaded yet, its notification will arrive later
+                continue
+            except Exception as e:
+                print(f"Error processing uploaded object {object_name}: {e}")
+
+    async def _consume(self):
+        await self._catch_up()
+        while True:
+            object_name = await self._queue.get()
+            try:
+                await process_uploaded_object(object_name)
+            except Exception as e:
+                print(f"Error processing uploaded object {object_name}: {e}")
+
+    async def _lead(self, redis: Redis):
+        """Listen for as long as the listener lock is renewed"""
+        renew = redis.register_script(_RENEW_LOCK)
+        release = redis.register_script(_RELEASE_LOCK)
+        stop = threading.Event()
+        threading.Thread(
+            target=self._listen,
+            args=(asyncio.get_running_loop(), stop),
+            name="upload-listener",
+            daemon=True,
+        ).start()
+        consume = asyncio.create_task(self._consume())
+        try:
+            while True:
+                await asyncio.wait({consume}, timeout=LISTENER_LOCK_TTL / 3)
+                if consume.done():
+                    # Raises what stopped it, another process may take over
+                    consume.result()
+                if not await renew(
+                    keys=[LISTENER_LOCK_KEY],
+                    args=[self.listener_id, LISTENER_LOCK_TTL],
+                ):
+                    print("Lost the upload listener lock, stopping")
+                    return
+        finally:
+            stop.set()
+            consume.cancel()
+            await asyncio.gather(consume, return_exceptions=True)
+            self._queue = asyncio.Queue()
+            try:
+                await release(keys=[LISTENER_LOCK_KEY], args=[self.listener_id])
+            except Exception as e:
+                print(f"Error releasing the upload listener lock: {e}")
+
+    async def _run(self):
+        redis = create_redis()
+        try:
+            while True:
+                try:
+                    if await redis.set(
+                        LISTENER_LOCK_KEY,
+                        self.listener_id,
+                        nx=True,
+                        ex=LISTENER_LOCK_TTL,
+                    ):
+                        await self._lead(redis)
+                except Exception as e:
+                    print(f"Error listening for uploads: {e}")
+                await asyncio.sleep(LISTENER_LOCK_TTL / 2)
+        finally:
+            await redis.aclose()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)